@@ -13,66 +13,264 @@
 The organization of this code is as follows:
 
 1. Script parameters (at the top, preceded by a "#@") that gather information for the dialogue box
-2. Import statements for all the modules needed
+2. Import statements for all the modules needed, followed by the pipeline settings that are not in the dialogue box
 3. All of the main functions for processing data
-4. The run_it() function, which sets up the error logging, and then calls all of the other processing functions. It should eventually just be in it's own file, but I like having everything where you can see it.
+4. The process_scan() function, which calls all of the other processing functions for a single scan
+5. The run_it() function, which sets up the error logging, and then runs process_scan() for every scan. It should eventually just be in it's own file, but I like having everything where you can see it.
 
-If you want to know the general flow of events, check the order of calls in the run_it() function. If you want to skip certain steps, comment them out in the run_it() function. Although, be aware that some functions pass arguments to each other, and commenting out certain functions can result in errors. It's best to read the particular function before you comment it out to make sure you avoid this.
+If you want to know the general flow of events, check the order of calls in the process_scan() function. If you want to skip certain steps, comment them out in the process_scan() function. Although, be aware that some functions pass arguments to each other, and commenting out certain functions can result in errors. It's best to read the particular function before you comment it out to make sure you avoid this.
 
 For more information and up-to-date changes, visit the GitHub repository: https://github.com/anivarj/anilyzer
 
 """
 
 # Importing modules and other shit
-import os, sys, traceback, shutil, glob
-from ij import IJ, WindowManager, ImagePlus
-from ij.gui import GenericDialog
-from ij.plugin import ImageCalculator
+import os, sys, traceback, shutil, glob, re, time, math
+from ij import IJ, ImagePlus, ImageStack, VirtualStack, CompositeImage
+from ij.plugin import LutLoader
+from ij.process import Blitter, ShortProcessor, ByteProcessor, FloatProcessor, ImageProcessor, LUT
+from ij.plugin.filter import RankFilters
+from ij.io import FileSaver
+from loci.plugins import BF
+from loci.plugins.in import ImporterOptions
+from java.util.concurrent import Executors, Callable, ThreadFactory, Semaphore
+from java.lang import Runtime, Thread
+from java.io import RandomAccessFile, FileOutputStream, ByteArrayOutputStream
+from java.util.zip import Deflater, Inflater
+from java.nio import ByteBuffer, ByteOrder
+from java.nio.channels import FileChannel
+from java.nio.file import Files, Paths, FileAlreadyExistsException
+from java.lang.management import ManagementFactory
+from StringIO import StringIO
+import jarray
 import datetime
-import fnmatch
+import json
+import threading
+import uuid
+
+# command_line_parameters reads the dialogue box parameters from the command line, as name=value pairs with the same names as the script parameters at the top
+# For example: ImageJ-linux64 --headless anilyze-data.py experimentFolder=/data/experiment differenceNumber=4 ch1color=Green ch2color=Magenta
+# Parameters that are left out get the same defaults as in the dialogue box. Any other name=value pairs change the pipeline settings below (e.g. sharedQueue=True), and are returned as a dictionary
+def command_line_parameters(args):
+	parameters = {"experimentFolder": None, "differenceNumber": 4, "ch1color": "Select", "ch2color": "Select", "ch3color": "Select"}
+	settings = {}
+	for arg in args:
+		name, equals, value = arg.partition("=")
+		if equals == "":
+			raise SystemExit("Unknown argument " + arg + ". Use name=value with any of: " + ", ".join(sorted(parameters)) + ", or a setting from the top of anilyze-data.py")
+		if name in parameters:
+			parameters[name] = value.strip('"')
+		else:
+			settings[name] = value.strip('"')
+	if parameters["experimentFolder"] is None:
+		raise SystemExit("Please give the input directory as experimentFolder=/path/to/experiment")
+	return parameters["experimentFolder"], int(parameters["differenceNumber"]), parameters["ch1color"], parameters["ch2color"], parameters["ch3color"], settings
+
+# setting_value reads a setting given on the command line as the same type as the setting's value at the top of this file (lists are written like ["MAX","AVG"])
+def setting_value(name, text):
+	default = globals().get(name)
+	if isinstance(default, bool):
+		return text.lower() in ("true", "1", "yes")
+	if isinstance(default, int):
+		return int(text)
+	if isinstance(default, float):
+		return float(text)
+	if isinstance(default, list):
+		return json.loads(text)
+	if isinstance(default, str):
+		return text
+	raise SystemExit("Unknown argument " + name + "=" + text + ". Use name=value with one of the dialogue box parameters, or a setting from the top of anilyze-data.py")
+
+commandLineSettings = {}
+
+try:
+	experimentFolder # set by the dialogue box, or by --run "experimentFolder='...',differenceNumber=4,..." on the command line
+except NameError: # the script was run without its parameters (e.g. ImageJ --headless anilyze-data.py ...), so they come from the command line instead
+	experimentFolder, differenceNumber, ch1color, ch2color, ch3color, commandLineSettings = command_line_parameters(sys.argv[1:])
 
 experimentFolder = str(experimentFolder) # Converts the input directory you chose to a path string that can be used later on
 
-# Microscope_check assesses the file structure of the experimentFolder and assigns a "microscope type" which gets passed to other functions. This helps with determining where certain files and directories should be located.
-def microscope_check(experimentFolder):
-	#If it finds .oif files inside the main folder, it calls the microscope "Olympus"
-	if any(File.endswith(".oif") for File in os.listdir(experimentFolder)):
-		print(".oif files present, running Olympus pipeline")
-		microscopeType = "Olympus"
-		return microscopeType #returns microscopeType to run_it()
-	else:
-		#If there are no .oif files in the main folder, it calls the microscope "Bruker"
-		print("No .oif files present, running Bruker pipeline")
-		microscopeType = "Bruker"
-		return microscopeType #returns microscopeType to run_it()
-
-# list_scans gets a list of all scan folders inside the experimentFolder you selected, and saves them as a list called scanList.
-def list_scans(experimentFolder, microscopeType):
-	scanList = [] # Makes an empty list
-
-	# This section screens out text files and other things that might be in the main experimentFolder, and only makes a list of the actual scan directories
-	# For Bruker microscopes, the scan directories are plain, so os.isdir is used to look for them
-	if microscopeType == "Bruker":
-		for File in sorted(os.listdir(experimentFolder)):
-			dirpath = os.path.join(experimentFolder, File) # Makes a complete path to the file
-			if os.path.isdir(dirpath): # If the dirpath is a directory, print it and add it to scanList. If it's a file, do not add it.
-				print "dirpath is " + dirpath
-				scanList.append(dirpath)
-		return scanList # Returns scanList to run_it()
-
-	# If the microscope is "Olympus" type, the directories end in .oif.files, so .endswith needs to be used to find them
-	if microscopeType == "Olympus":
-		oifList = [] # This doesn't look like it was used, so I should delete it in the future once I have verified this.
-		for File in sorted(os.listdir(experimentFolder)):
-			if File.endswith(".oif.files"): # If the item ends with .oif.files, make the complete path and append it to scanList
-				dirpath = os.path.join(experimentFolder, File)
-				print "dirpath is " + dirpath
-				scanList.append(dirpath)
-		return scanList # Returns scanList to run_it()
-
-
-# make_directories takes an individual scan (passed from the run_it() function) and checks to see if a "processed" directory already exist inside the scan folder. If so, it overwrites it.
-def make_directories(scan):
+# Pipeline settings that are not in the dialogue box. Change them here if you need to.
+parallelWorkers = 1 # How many scans are processed at the same time. 1 processes the scans one after another. Every scan needs its own memory, so only raise this if your RAM can hold that many scans at once
+differenceOffsets = [] # Extra offsets for difference movies, e.g. [2, 4, 8] makes Diff2, Diff4 and Diff8 movies in one pass. The number from the dialogue box is always included
+differenceOutput = "clipped" # "clipped" keeps the bit depth of the data, so negative changes become 0 (like the old ImageCalculator subtraction). "signed" saves 32-bit difference movies that keep negative changes
+makeFiltered = False # True also makes median filtered movies (filteredMAX and its merge for z-stacks, filtered and its merge for single plane data). Off by default, since it is a full extra pass over every scan
+medianRadius = 1 # Radius of the median filter. 1 is a 3x3 median, which uses a fast sorting network. Other radii use ImageJ's median filter
+saveFilteredStacks = False # For z-stacks, True also saves the full filtered hyperstacks. False filters each plane on its way into filteredMAX, so the filtered hyperstacks are never kept in memory or saved
+filterThreads = 0 # How many threads the median filter uses. 0 uses one per core
+brukerReader = "native" # "native" reads Bruker TIFs directly, which is much faster than Bio-formats (it skips the OME-XML in every file). "bioformats" always uses the Bio-formats importer
+projections = ["MAX"] # Projections to make of z-stack data, in one pass over each z-stack. Choose from "MAX", "AVG", "SUM", "STD" and "MIN", e.g. ["MAX", "AVG", "STD"]. MAX is always made (it's used for the merges and difference movies), the others go in their own folders next to rawMAX (MAX/rawAVG, MAX/rawSTD, ...)
+processingMode = "auto" # How scans are processed. "auto" estimates each scan's memory footprint from its dimensions before it is imported, and processes it in "memory" if it fits in the memory budget, as a "virtual" stack if only the outputs fit, and in "chunked" timepoints otherwise. Set it to one of those three to use it for every scan
+chunkFrames = 0 # How many timepoints are processed at a time in "chunked" mode. 0 picks as many as fit in a third of the memory budget
+memoryBudget = 0.8 # The part of Fiji's memory (Edit > Options > Memory & Threads) that scans are planned to use. Scans running at the same time share it, so a scan waits if the ones running leave too little
+streamingProjection = False # True reads each scan as a virtual stack and projects it one timepoint at a time, so only about one z-stack per channel is in memory. Use this for scans that don't fit in memory. It reads the data from disk twice (once for raw, once for MAX), so it is slower for scans that do fit
+prefetchScans = 1 # While a scan is processed, this many of the next scans are imported in the background (only if they fit in the free memory), so reading from a network share overlaps with processing. 0 turns it off. Only used when parallelWorkers = 1
+rawOutput = "copy" # "copy" saves the raw channel hyperstacks in processed/raw. "links" saves a small list of the scan's own TIFs instead (C1-name_raw.planes.json), for Bruker scans that are read natively, so the raw data isn't written a second time. Other scans are still copied
+asyncWrites = True # Saves the outputs on a background thread while the next ones are made. Every stage waits for its files to be written before it is marked as done in the manifest
+outputFormat = "tiff" # "tiff" saves every output as an ImageJ TIF. "zarr" saves them as OME-Zarr folders (name.ome.zarr): compressed without loss, cut into chunks, with smaller copies for quick viewing, so one timepoint can be read without reading the whole movie
+zarrChunkSize = 512 # The size of the OME-Zarr chunks in pixels (zarrChunkSize x zarrChunkSize, one plane deep)
+zarrLevels = 0 # How many resolution levels OME-Zarr outputs get (full size, half, quarter, ...). 0 keeps halving until the smallest level fits in 256 x 256
+zarrCompression = 5 # zlib compression level of the OME-Zarr chunks, from 1 (fastest) to 9 (smallest)
+zarrThreads = 0 # How many threads compress and write OME-Zarr chunks. 0 uses one per core
+resumeScans = True # Keeps track of what was made for every scan in processed/manifest.json. Scans that are up to date are skipped, and half-finished scans pick up where they stopped. False remakes everything from scratch
+watchFolder = False # Keeps watching the experiment folder while scans are being acquired, and processes each scan as soon as it is finished. Stops after watchTimeout, or when a file called stop-watching is put in the experiment folder
+watchInterval = 30 # How often watch mode looks for new and finished scans, in seconds
+scanQuietTime = 120 # How long a scan's files have to stay the same before watch mode counts it as finished, in seconds. Bruker scans also need PrairieView to have closed their .xml, and Olympus scans need their .oif file
+watchTimeout = 3600 # Watch mode stops once no new data has come in for this many seconds. 0 keeps watching until the stop-watching file shows up
+watchRetries = 2 # In watch mode, how many more times a scan that failed is processed (once its files have stayed the same for scanQuietTime again). 0 never tries again
+liveMAX = False # In watch mode, makes the MAX projections of z-stack scans while they are still being acquired, adding each timepoint as it comes in (in processed/live). They are replaced by the normal outputs once the scan is finished
+scanIndex = True # Remembers where the scans are in scan-index.json in the experiment folder, so next time only the folders that changed are searched again (batch-opener.py uses it too). False searches the whole experiment folder every time
+discoveryThreads = 16 # How many folders are looked at the same time when searching for scans. Network shares answer many requests at once much faster than one after another
+sharedQueue = False # Lets several Fiji processes (on this computer, or on any computer that sees the same folder) work through one experiment folder together. Each scan is claimed by one worker at a time, so no scan is processed twice. Needs resumeScans
+workerName = "" # This worker's name in the shared queue. "" uses the computer name and process number
+claimTimeout = 600 # In seconds. Workers renew their claims four times in this time, so a claim that hasn't been renewed for this long was left by a worker that crashed, and is taken over. The computers' clocks need to agree
+renderOnly = False # Re-renders the scans from the outputs they already have instead of processing them: the LUTs and merges are made again if the channel colors changed, and the difference movies if differenceNumber, differenceOffsets or differenceOutput changed. Nothing is imported. Scans that need more than that are logged and left for a normal run
+renderWorkers = 0 # How many scans are re-rendered at the same time with renderOnly. 0 uses one per core. They share the memory budget, like parallelWorkers
+
+# Settings given on the command line (e.g. ImageJ-linux64 --headless anilyze-data.py experimentFolder=/data sharedQueue=True workerName=node1) replace the ones above
+for name, value in commandLineSettings.items():
+	globals()[name] = setting_value(name, value)
+
+# Scan discovery. The experiment folder is searched for scans at any depth (day/animal/scan folders are fine), and the microscope is worked out for each scan on its own, so Bruker and Olympus scans can share a folder
+# Bruker scans are folders with a .xml of the same name (or PrairieView TIFs in them), and Olympus scans are the .oif.files folders. Processed folders and the insides of scans are never searched
+# What was found is kept in scan-index.json in the experiment folder, along with the modification time of every folder that was searched. Adding or removing anything in a folder changes its time, so only the folders that changed are searched again next time
+# anilyze-data.py and batch-opener.py use the same index (batch-opener.py loads these functions from this file), so it only has to be made once
+indexName = "scan-index.json"
+brukerTifNames = re.compile(r"_Cycle\d+_Ch\d+_\d+\.ome\.tif$")
+notFolders = (".tif", ".tiff", ".xml", ".oif", ".txt", ".json", ".jsonl", ".csv", ".env", ".cfg", ".png", ".jpg", ".pdf") # names that are never searched, so a folder full of files doesn't need a check for every file
+
+# look_in looks at one path while searching for scans. Returns (microscopeType, [], None) for a scan, (None, its subfolders, its modification time) for a folder to search further, and (None, [], None) for anything else
+def look_in(path):
+	name = os.path.basename(path)
+	if name.endswith(".oif.files"):
+		return "Olympus", [], None
+	if os.path.isfile(os.path.join(path, name + ".xml")):
+		return "Bruker", [], None
+	try:
+		mtime = os.stat(path).st_mtime # taken before listing, so anything added while listing is caught next time
+		entries = os.listdir(path)
+	except OSError: # a file, or it was deleted
+		return None, [], None
+	if any(brukerTifNames.search(f) for f in entries):
+		return "Bruker", [], None
+	children = [os.path.join(path, f) for f in sorted(entries) if not (f.startswith(".") or f == "processed" or os.path.splitext(f)[1].lower() in notFolders)]
+	return None, children, mtime
+
+# folder_time returns the modification time of a folder, or None if it's gone
+def folder_time(path):
+	try:
+		return os.stat(path).st_mtime
+	except OSError:
+		return None
+
+# search_folders searches roots and every folder under them for scans, one level at a time, with the folders of a level looked at in parallel on pool
+# Returns {scan: microscopeType} and {folder: modification time} for the folders that were searched
+def search_folders(roots, pool):
+	scans = {}
+	folders = {}
+	level = list(roots)
+	while len(level) > 0:
+		futures = [pool.submit(Task(look_in, path)) for path in level]
+		children = []
+		for path, future in zip(level, futures):
+			microscopeType, subfolders, mtime = future.get()
+			if microscopeType is not None:
+				scans[path] = microscopeType
+			elif mtime is not None:
+				folders[path] = mtime
+				children.extend(subfolders)
+		level = children
+	return scans, folders
+
+# read_index loads scan-index.json, with its paths made absolute again. Returns None if there isn't one (or it can't be read)
+def read_index(experimentFolder):
+	try:
+		indexFile = open(os.path.join(experimentFolder, indexName), "r")
+		try:
+			index = json.load(indexFile)
+		finally:
+			indexFile.close()
+		scans = dict((os.path.normpath(os.path.join(experimentFolder, path)), microscopeType) for path, microscopeType in index["scans"].items())
+		folders = dict((os.path.normpath(os.path.join(experimentFolder, path)), mtime) for path, mtime in index["folders"].items())
+		return scans, folders
+	except (IOError, ValueError, KeyError, AttributeError):
+		return None
+
+# write_index saves scan-index.json, with paths relative to the experiment folder so it still works if the folder is moved or mounted somewhere else
+# It is written to a temporary file first, so the other script never reads half an index. A folder that can't be written to just doesn't get an index
+def write_index(experimentFolder, scans, folders):
+	index = {"scans": dict((os.path.relpath(path, experimentFolder), microscopeType) for path, microscopeType in scans.items()),
+		"folders": dict((os.path.relpath(path, experimentFolder), mtime) for path, mtime in folders.items())}
+	indexPath = os.path.join(experimentFolder, indexName)
+	tempPath = indexPath + "." + uuid.uuid4().hex + ".tmp" # every process has its own, in case several save it at once
+	try:
+		indexFile = open(tempPath, "w")
+		json.dump(index, indexFile, indent = 1, sort_keys = True)
+		indexFile.close()
+		if os.path.exists(indexPath):
+			os.remove(indexPath)
+		os.rename(tempPath, indexPath)
+	except (IOError, OSError):
+		print "Couldn't save", indexPath + ", the folder will be searched again next time"
+
+# forget_path takes a path that is gone (or has become a scan) out of the scans and folders found before, along with everything inside it
+def forget_path(path, scans, folders):
+	for found in (scans, folders):
+		for other in [other for other in found if other == path or other.startswith(path + os.sep)]:
+			del found[other]
+
+# find_scans returns the scans in the experiment folder as a sorted list of (scan, microscopeType)
+# With scanIndex, the folders in scan-index.json are checked for changes (all at once), and only the folders that changed are looked at again. Their new subfolders are searched, and the ones that are gone are forgotten
+# With verbose = False the scans aren't printed (watch mode finds them over and over)
+def find_scans(experimentFolder, verbose = True):
+	start = time.time()
+	experimentFolder = os.path.normpath(experimentFolder)
+	pool = Executors.newFixedThreadPool(max(discoveryThreads, 1), DaemonThreads())
+	try:
+		index = None
+		if scanIndex:
+			index = read_index(experimentFolder)
+		if index is None:
+			scans, folders = search_folders([experimentFolder], pool)
+			searched = len(folders)
+		else:
+			scans, folders = index
+			paths = sorted(folders)
+			times = [future.get() for future in [pool.submit(Task(folder_time, path)) for path in paths]]
+			changed = [path for path, mtime in zip(paths, times) if mtime != folders[path]]
+			looks = [future.get() for future in [pool.submit(Task(look_in, path)) for path in changed]]
+			added = []
+			for path, (microscopeType, subfolders, mtime) in zip(changed, looks):
+				old = [other for other in scans.keys() + folders.keys() if os.path.dirname(other) == path]
+				if mtime is None: # it's gone, or it's a scan now
+					forget_path(path, scans, folders)
+					if microscopeType is not None:
+						scans[path] = microscopeType
+					continue
+				folders[path] = mtime
+				for other in old:
+					if other not in subfolders:
+						forget_path(other, scans, folders)
+				added.extend([subfolder for subfolder in subfolders if subfolder not in old])
+			newScans, newFolders = search_folders(added, pool)
+			scans.update(newScans)
+			folders.update(newFolders)
+			searched = len(changed) + len(newFolders)
+	finally:
+		pool.shutdown()
+	if index is None or searched > 0:
+		write_index(experimentFolder, scans, folders)
+
+	scanList = sorted(scans.items())
+	if verbose:
+		for scan, microscopeType in scanList:
+			print microscopeType, "scan:", scan
+		print "Found", len(scanList), "scan(s) in %.1f s," % (time.time() - start), "looked in", searched, "of", len(folders), "folder(s)"
+	return scanList
+
+# make_directories takes an individual scan (passed from the process_scan() function) and checks to see if a "processed" directory already exist inside the scan folder. If so and overwrite is True, it overwrites it.
+# Otherwise it only makes the directories that are missing, so the outputs of a finished stage are kept
+def make_directories(scan, overwrite):
 	print "Checking for output directories in ", scan
 	processed = os.path.join(scan, "processed") # makes full path to processed folder, inside the scan folder
 	raw = os.path.join(processed, "raw") # makes full path to raw folder, inside processed
@@ -84,23 +282,1202 @@ def make_directories(scan):
 	directories = [processed, raw, diff, filteredMAX, rawMAX, filtered] # a list of all the full paths you just made
 
 	#If a processed folder exists, it will erase and remake fresh folders
-	if os.path.exists(processed):
+	if os.path.exists(processed) and overwrite:
 		print "The directory", processed, "already exists! Overwriting..."
 		shutil.rmtree(processed)
-		for d in directories:
-			os.makedirs(d)
-			print d, "created"
-	else:
-		for d in directories:
+
+	for d in directories:
+		if not os.path.exists(d): # clean_up() removes empty folders, so they might need to be made again
 			os.makedirs(d)
 			print d, "created"
 
 	print "Finished creating directories!"
-	return directories # returns directories list to run_it()
+	return directories # returns directories list to process_scan()
 
+# The stages that are tracked in each scan's manifest, in the order they run, and which stages' outputs each of them is made from
+stageOrder = ["split", "MAX", "merge", "filtered", "diff"]
+stageNeeds = {"split": [], "MAX": ["split"], "merge": ["MAX"], "filtered": ["split"], "diff": ["MAX"]}
 
-# Make_hyperstack uses Bio-formats importer to import a hyperstack from an initiator file
-def make_hyperstack(basename, scan, microscopeType): # basename is defined in run_it() and is the name of the scan (not the full path)
+scanState = threading.local() # Keeps track of the files saved by the scan that is running on this thread (each worker thread runs one scan at a time)
+
+# in_writer runs a function on this scan's writer thread, after everything that is already waiting there (see asyncWrites at the top). Without a writer thread it runs right away
+def in_writer(function, *args):
+	writer = getattr(scanState, "writer", None)
+	if writer is None:
+		function(*args)
+	else:
+		scanState.writes.append(writer.submit(Task(function, *args)))
+
+# wait_for_writes waits until the writer thread has saved everything it was given. If a save failed, the error is raised here
+def wait_for_writes():
+	writes = getattr(scanState, "writes", [])
+	scanState.writes = []
+	for future in writes:
+		future.get()
+
+# escaped writes the non-ASCII letters of a description value (like the micro sign of a micron unit) as \u escapes, like FileSaver does
+def escaped(text):
+	return text.encode("ascii", "backslashreplace").replace("\\x", "\\u00")
+
+# AppendableTiff writes an ImageJ TIF a few planes at a time, for chunked processing (see processingMode at the top). It is made from the first block of an image, and every block is added with append()
+# The pixels are written one after another straight to the file, and the per-plane directories go at the end once close() knows how many planes there are, so ImageJ opens it just like a TIF saved in one go
+# The description has the same fields FileSaver writes (dimensions, calibration, frame interval and display range), so a scan processed in blocks gets the same files as one processed in memory
+# The first directory (with the ImageJ description and the channel display ranges and LUTs) sits at the start of the file with room to spare, so files over 4 GB still open in ImageJ (like ImageJ's own big TIFs, only the first directory is used for those)
+# A single channel image with a LUT keeps it as the TIF's color map, like ImageJ saves it
+class AppendableTiff(object):
+	descriptionSpace = 1024 # bytes kept for the description, which is only known at the end
+
+	def __init__(self, path, imp):
+		if imp.getBitDepth() == 24:
+			raise IOError("RGB images can't be written in blocks: " + path)
+		self.path = path
+		self.width, self.height = imp.getWidth(), imp.getHeight()
+		self.bitDepth = imp.getBitDepth()
+		self.channels, self.slices = imp.getNChannels(), imp.getNSlices()
+		self.calibration = imp.getCalibration().copy()
+		self.mode = None
+		self.luts = []
+		self.ranges = []
+		if imp.isComposite(): # merges keep their channel colors and display ranges
+			self.mode = imp.getModeAsString()
+			self.luts = list(imp.getLuts())
+			self.ranges = [value for lut in self.luts for value in (lut.min, lut.max)]
+		ip = imp.getProcessor()
+		self.displayRange = None
+		if self.bitDepth != 8 or ip.getMin() != 0 or ip.getMax() != 255: # like FileSaver: always for 16-bit and 32-bit, and for 8-bit only if it was changed
+			self.displayRange = (ip.getMin(), ip.getMax())
+		self.colorMap = None
+		if not imp.isComposite() and not imp.getProcessor().isDefaultLut():
+			self.colorMap = imp.getProcessor().getLut()
+		self.metaCounts = []
+		if len(self.luts) > 0:
+			self.metaCounts = [4 + 8 * 2, 8 * len(self.ranges)] + [768] * len(self.luts) # ImageJ's metadata: a header ("IJIJ", then the type and count of each kind of entry), the display ranges of the channels, then one LUT per channel
+		self.planeBytes = self.width * self.height * self.bitDepth / 8
+		self.planes = 0
+
+		# The file starts with the header, the first directory and everything it points to (with a blank description), then the pixels
+		self.firstIfd = 8
+		self.descriptionOffset = self.resolutionOffset = self.metaCountsOffset = self.metaOffset = self.colorMapOffset = 0 # only the number of entries matters for ifd_size()
+		self.descriptionOffset = self.firstIfd + self.ifd_size(True)
+		self.resolutionOffset = self.descriptionOffset + self.descriptionSpace
+		self.metaCountsOffset = self.resolutionOffset + 16
+		self.metaOffset = self.metaCountsOffset + 4 * len(self.metaCounts)
+		self.colorMapOffset = self.metaOffset + sum(self.metaCounts)
+		self.dataOffset = self.colorMapOffset
+		if self.colorMap is not None:
+			self.dataOffset += 768 * 2 # 256 reds, greens and blues, as 16-bit numbers
+
+		buf = ByteBuffer.allocate(self.dataOffset).order(ByteOrder.BIG_ENDIAN)
+		buf.put(ord("M")).put(ord("M")).putShort(42).putInt(self.firstIfd)
+		buf.position(self.resolutionOffset)
+		scale = 1000000
+		xscale = 1.0 / self.calibration.pixelWidth
+		yscale = 1.0 / self.calibration.pixelHeight
+		if max(xscale, yscale) > 1000.0:
+			scale = 1000
+		buf.putInt(int(xscale * scale)).putInt(scale).putInt(int(yscale * scale)).putInt(scale)
+		for count in self.metaCounts:
+			buf.putInt(count)
+		if len(self.luts) > 0:
+			buf.putInt(0x494a494a).putInt(0x72616e67).putInt(1).putInt(0x6c757473).putInt(len(self.luts)) # "IJIJ", "rang", "luts"
+			for value in self.ranges:
+				buf.putDouble(value)
+			for lut in self.luts:
+				for getter in (lut.getReds, lut.getGreens, lut.getBlues):
+					colors = jarray.zeros(256, "b")
+					getter(colors)
+					buf.put(colors)
+		if self.colorMap is not None:
+			buf.position(self.colorMapOffset)
+			for getter in (self.colorMap.getReds, self.colorMap.getGreens, self.colorMap.getBlues):
+				colors = jarray.zeros(256, "b")
+				getter(colors)
+				for color in colors:
+					buf.putShort(signed((color & 255) << 8, 16))
+		buf.position(0)
+
+		self.raf = RandomAccessFile(path, "rw")
+		self.raf.setLength(0)
+		self.channel = self.raf.getChannel()
+		self.write_at(buf, 0)
+
+	# ifd_entries lists the (tag, type, count, value) of a plane's directory. Types: 1 = BYTE, 2 = ASCII, 3 = SHORT, 4 = LONG, 5 = RATIONAL
+	def ifd_entries(self, first, offset, descriptionLength):
+		photometric = 1 # black is zero
+		if self.colorMap is not None:
+			photometric = 3 # palette
+		entries = [(254, 4, 1, 0), (256, 4, 1, self.width), (257, 4, 1, self.height), (258, 3, 1, self.bitDepth), (259, 3, 1, 1), (262, 3, 1, photometric)]
+		if first:
+			entries.append((270, 2, descriptionLength, self.descriptionOffset))
+		entries += [(273, 4, 1, offset), (277, 3, 1, 1), (278, 4, 1, self.height), (279, 4, 1, self.planeBytes)]
+		entries += [(282, 5, 1, self.resolutionOffset), (283, 5, 1, self.resolutionOffset + 8), (296, 3, 1, 1)]
+		if self.colorMap is not None:
+			entries.append((320, 3, 768, self.colorMapOffset))
+		if self.bitDepth == 32:
+			entries.append((339, 3, 1, 3)) # floating point
+		if first and len(self.metaCounts) > 0:
+			entries += [(50838, 4, len(self.metaCounts), self.metaCountsOffset), (50839, 1, sum(self.metaCounts), self.metaOffset)]
+		return entries
+
+	def ifd_size(self, first):
+		return 2 + 12 * len(self.ifd_entries(first, 0, 0)) + 4
+
+	# ifd makes the directory of a plane. Java only has signed numbers, so unsigned values are wrapped around to fit
+	def ifd(self, first, offset, nextIfd, descriptionLength = 0):
+		entries = self.ifd_entries(first, offset, descriptionLength)
+		buf = ByteBuffer.allocate(2 + 12 * len(entries) + 4).order(ByteOrder.BIG_ENDIAN)
+		buf.putShort(len(entries))
+		for (tag, fieldType, count, value) in entries:
+			buf.putShort(signed(tag, 16)).putShort(fieldType).putInt(count)
+			if fieldType == 3 and count == 1:
+				buf.putShort(value).putShort(0) # a single SHORT sits at the start of the value field
+			else:
+				buf.putInt(signed(value, 32))
+		buf.putInt(signed(nextIfd, 32))
+		buf.position(0)
+		return buf
+
+	def write_at(self, buf, position):
+		while buf.hasRemaining():
+			position += self.channel.write(buf, position)
+
+	# append adds every plane of an image (a block of timepoints) to the end of the file
+	def append(self, imp):
+		stack = imp.getStack()
+		for n in range(1, stack.getSize() + 1):
+			buf = ByteBuffer.allocate(self.planeBytes).order(ByteOrder.BIG_ENDIAN)
+			if self.bitDepth == 8:
+				buf.put(stack.getPixels(n))
+			elif self.bitDepth == 16:
+				buf.asShortBuffer().put(stack.getPixels(n))
+			else:
+				buf.asFloatBuffer().put(stack.getPixels(n))
+			buf.position(0)
+			self.write_at(buf, self.dataOffset + self.planes * self.planeBytes)
+			self.planes += 1
+
+	# description is the ImageJ description, with the dimensions that are known now that all the planes are written. The fields and their order are the ones FileSaver writes
+	def description(self):
+		cal = self.calibration
+		frames = max(self.planes / (self.channels * self.slices), 1)
+		lines = ["ImageJ=" + IJ.getVersion()]
+		if self.planes > 1:
+			lines.append("images=" + str(self.planes))
+		if self.channels > 1:
+			lines.append("channels=" + str(self.channels))
+		if self.slices > 1:
+			lines.append("slices=" + str(self.slices))
+		if frames > 1:
+			lines.append("frames=" + str(frames))
+		if self.planes > 1:
+			lines.append("hyperstack=true")
+		if self.mode is not None:
+			lines.append("mode=" + self.mode)
+		if cal.scaled():
+			lines.append("unit=" + escaped(cal.getUnit()))
+		if self.planes > 1:
+			if cal.pixelDepth != 1.0:
+				lines.append("spacing=" + str(cal.pixelDepth))
+			lines.append("loop=false")
+			if cal.frameInterval != 0:
+				if int(cal.frameInterval) == cal.frameInterval:
+					lines.append("finterval=" + str(int(cal.frameInterval)))
+				else:
+					lines.append("finterval=" + str(cal.frameInterval))
+			if cal.getTimeUnit() != "sec":
+				lines.append("tunit=" + escaped(cal.getTimeUnit()))
+		if self.displayRange is not None:
+			lines.append("min=" + str(float(self.displayRange[0])))
+			lines.append("max=" + str(float(self.displayRange[1])))
+		return "\n".join(lines) + "\n\0"
+
+	# write_directories writes the description and the directories of the planes written so far, so the file can be opened as it is. More planes can still be added after it (they go over the directories, which are written again after them)
+	# ImageJ only reads the first directory and the description, so it can open the file at any time and sees the planes that were there at the last write_directories()
+	def write_directories(self):
+		description = self.description()
+		if len(description) > self.descriptionSpace:
+			raise IOError("The description of " + self.path + " is too long")
+		self.write_at(ByteBuffer.wrap(jarray.array([ord(ch) for ch in description], "b")), self.descriptionOffset)
+
+		end = self.dataOffset + self.planes * self.planeBytes
+		ifdSize = self.ifd_size(False)
+		nextIfd = 0
+		if self.planes > 1 and end + ifdSize * self.planes < 0xffffffffL: # past 4 GB the offsets don't fit, and ImageJ only needs the first directory
+			nextIfd = end
+			for i in range(1, self.planes):
+				following = 0
+				if i < self.planes - 1:
+					following = end + ifdSize * i
+				self.write_at(self.ifd(False, self.dataOffset + i * self.planeBytes, following), end + ifdSize * (i - 1))
+		self.write_at(self.ifd(True, self.dataOffset, nextIfd, len(description)), self.firstIfd)
+
+	# close writes the final description and the directories of all the planes, and closes the file
+	def close(self):
+		self.write_directories()
+		self.raf.close()
+
+zarrDtypes = {8: "|u1", 16: ">u2", 32: ">f4"} # the OME-Zarr data types of 8-bit, 16-bit and 32-bit images (big endian)
+
+# signed wraps an unsigned number around so it fits in a Java short (bits = 16) or int (bits = 32)
+def signed(value, bits):
+	if value >= 1 << (bits - 1):
+		return int(value - (1 << bits))
+	return int(value)
+
+# ZarrWriter saves an image as an OME-Zarr folder (see outputFormat at the top). Every plane is cut into chunks of up to zarrChunkSize x zarrChunkSize pixels, and each chunk is compressed (zlib) into its own file, 0/t/c/z/y/x
+# Smaller copies of every plane (each half the size of the one before, averaged) go in 1/, 2/, ..., so a viewer can show a whole movie without reading it at full size
+# The chunks are compressed and written on the zarr_pool() threads while the next planes come in. Like AppendableTiff, it is made from the first block of an image and every block is added with append(). close() writes the metadata once the number of timepoints is known
+class ZarrWriter(object):
+	def __init__(self, path, imp):
+		if imp.getBitDepth() == 24:
+			raise IOError("RGB images can't be saved as OME-Zarr: " + path)
+		if os.path.isdir(path):
+			shutil.rmtree(path) # chunks from an earlier, bigger image would be read as part of this one
+		os.makedirs(path)
+		self.path = path
+		self.name = imp.getTitle()
+		self.width, self.height = imp.getWidth(), imp.getHeight()
+		self.bitDepth = imp.getBitDepth()
+		self.channels, self.slices = imp.getNChannels(), imp.getNSlices()
+		self.calibration = imp.getCalibration().copy()
+		self.mode = None
+		if imp.isComposite():
+			self.mode = imp.getModeAsString()
+		self.luts = list(imp.getLuts())
+		self.levels = [(self.width, self.height)]
+		while (zarrLevels > 0 and len(self.levels) < zarrLevels) or (zarrLevels <= 0 and max(self.levels[-1]) > 256):
+			width, height = self.levels[-1]
+			if width < 2 or height < 2:
+				break
+			self.levels.append((width / 2, height / 2))
+		self.chunks = [(min(zarrChunkSize, levelWidth), min(zarrChunkSize, levelHeight)) for (levelWidth, levelHeight) in self.levels]
+		self.planes = 0
+		self.pending = []
+
+	# append hands every plane of an image (a block of timepoints) to the zarr_pool() threads. Only a few planes per thread are kept waiting, so a big image isn't copied into the queue
+	def append(self, imp):
+		pool, threads = zarr_pool()
+		stack = imp.getStack()
+		for n in range(1, stack.getSize() + 1):
+			self.pending.append(pool.submit(Task(self.write_plane, stack.getProcessor(n), self.planes)))
+			self.planes += 1
+			while len(self.pending) > 2 * threads:
+				self.pending.pop(0).get() # raises the error if a plane couldn't be written
+
+	# write_plane writes the chunks of plane index (counted in CZT order, like an ImageJ hyperstack) at every level
+	def write_plane(self, ip, index):
+		c = index % self.channels
+		z = (index / self.channels) % self.slices
+		t = index / (self.channels * self.slices)
+		for level, (width, height) in enumerate(self.levels):
+			if level > 0:
+				ip.resetRoi()
+				ip.setInterpolationMethod(ImageProcessor.BILINEAR)
+				ip = ip.resize(width, height, True) # averages the pixels it shrinks together
+			chunkWidth, chunkHeight = self.chunks[level]
+			for y in range((height + chunkHeight - 1) / chunkHeight):
+				for x in range((width + chunkWidth - 1) / chunkWidth):
+					ip.setRoi(x * chunkWidth, y * chunkHeight, chunkWidth, chunkHeight)
+					tile = ip.crop()
+					if tile.getWidth() != chunkWidth or tile.getHeight() != chunkHeight: # chunks at the edges are padded with zeros
+						padded = tile.createProcessor(chunkWidth, chunkHeight)
+						padded.insert(tile, 0, 0)
+						tile = padded
+					self.write_chunk(os.path.join(self.path, str(level), str(t), str(c), str(z), str(y)), str(x), tile)
+
+	def write_chunk(self, directory, name, tile):
+		pixels = tile.getPixels()
+		buf = ByteBuffer.allocate(len(pixels) * self.bitDepth / 8) # big endian, like the dtypes
+		if self.bitDepth == 8:
+			buf.put(pixels)
+		elif self.bitDepth == 16:
+			buf.asShortBuffer().put(pixels)
+		else:
+			buf.asFloatBuffer().put(pixels)
+		if not os.path.isdir(directory):
+			try:
+				os.makedirs(directory)
+			except OSError: # another thread made it at the same time
+				pass
+		out = FileOutputStream(os.path.join(directory, name))
+		try:
+			out.write(deflate(buf.array()))
+		finally:
+			out.close()
+
+	# close waits for every chunk to be written, then writes the metadata: a .zarray for every level, and the OME-Zarr multiscales (axes and pixel sizes) and channel colors in .zattrs
+	def close(self):
+		for future in self.pending:
+			future.get()
+		self.pending = []
+		frames = max(self.planes / (self.channels * self.slices), 1)
+		write_json(os.path.join(self.path, ".zgroup"), {"zarr_format": 2})
+		for level, (width, height) in enumerate(self.levels):
+			chunkWidth, chunkHeight = self.chunks[level]
+			write_json(os.path.join(self.path, str(level), ".zarray"), {"zarr_format": 2, "shape": [frames, self.channels, self.slices, height, width],
+				"chunks": [1, 1, 1, chunkHeight, chunkWidth], "dtype": zarrDtypes[self.bitDepth], "compressor": {"id": "zlib", "level": zarrCompression},
+				"fill_value": 0, "order": "C", "filters": None, "dimension_separator": "/"})
+
+		cal = self.calibration
+		unit = {"micron": "micrometer", u"\u00b5m": "micrometer", "um": "micrometer", "nm": "nanometer", "mm": "millimeter"}.get(cal.getUnit())
+		axes = [{"name": "t", "type": "time"}, {"name": "c", "type": "channel"}]
+		for name in ("z", "y", "x"):
+			axes.append({"name": name, "type": "space"})
+			if unit is not None:
+				axes[-1]["unit"] = unit
+		datasets = [{"path": str(level), "coordinateTransformations": [{"type": "scale", "scale": [cal.frameInterval or 1.0, 1.0, cal.pixelDepth,
+			cal.pixelHeight * self.height / float(height), cal.pixelWidth * self.width / float(width)]}]} for level, (width, height) in enumerate(self.levels)]
+		channels = []
+		for lut in self.luts[:self.channels]:
+			channels.append({"color": "%02X%02X%02X" % (lut.getRed(255), lut.getGreen(255), lut.getBlue(255)), "active": True,
+				"window": {"start": lut.min, "end": lut.max, "min": 0, "max": (1 << self.bitDepth) - 1 if self.bitDepth < 32 else lut.max}})
+		write_json(os.path.join(self.path, ".zattrs"), {"multiscales": [{"version": "0.4", "name": self.name, "axes": axes, "datasets": datasets}],
+			"omero": {"name": self.name, "channels": channels, "rdefs": {"model": "color"}}, "imagej": {"mode": self.mode}})
+
+zarrPool = [] # the thread pool that compresses and writes OME-Zarr chunks, made the first time it's needed and shared by all scans
+zarrPoolLock = threading.Lock()
+
+# zarr_pool returns the OME-Zarr writing thread pool (zarrThreads threads, or one per core) and how many threads it has
+def zarr_pool():
+	zarrPoolLock.acquire()
+	try:
+		if len(zarrPool) == 0:
+			threads = zarrThreads
+			if threads < 1:
+				threads = Runtime.getRuntime().availableProcessors()
+			zarrPool.append((Executors.newFixedThreadPool(threads, DaemonThreads()), threads))
+		return zarrPool[0]
+	finally:
+		zarrPoolLock.release()
+
+# deflate compresses a byte array with zlib (see zarrCompression at the top)
+def deflate(data):
+	deflater = Deflater(zarrCompression)
+	deflater.setInput(data)
+	deflater.finish()
+	out = ByteArrayOutputStream(len(data) / 2 + 64)
+	buf = jarray.zeros(65536, "b")
+	while not deflater.finished():
+		out.write(buf, 0, deflater.deflate(buf))
+	deflater.end()
+	return out.toByteArray()
+
+# inflate uncompresses a zlib compressed byte array into length bytes
+def inflate(data, length):
+	inflater = Inflater()
+	inflater.setInput(data)
+	out = jarray.zeros(length, "b")
+	done = 0
+	while done < length and not inflater.finished():
+		done += inflater.inflate(out, done, length - done)
+	inflater.end()
+	return out
+
+# write_json saves a small JSON file, like the OME-Zarr metadata
+def write_json(path, value):
+	directory = os.path.dirname(path)
+	if not os.path.isdir(directory):
+		os.makedirs(directory)
+	jsonFile = open(path, "w")
+	json.dump(value, jsonFile, indent = 1, sort_keys = True)
+	jsonFile.close()
+
+# read_json loads a small JSON file
+def read_json(path):
+	jsonFile = open(path, "r")
+	try:
+		return json.load(jsonFile)
+	finally:
+		jsonFile.close()
+
+# ZarrStack is a virtual stack of one level of an OME-Zarr folder that ZarrWriter saved. A plane is only read (and uncompressed) when it is asked for, so one timepoint, or a small level of a big movie, can be looked at without reading the rest
+class ZarrStack(VirtualStack):
+	def __init__(self, path, level):
+		array = read_json(os.path.join(path, str(level), ".zarray"))
+		self.frames, self.channels, self.slices, height, width = array["shape"]
+		self.chunkHeight, self.chunkWidth = array["chunks"][3], array["chunks"][4]
+		VirtualStack.__init__(self, width, height, None, None)
+		self.setBitDepth(dict((dtype, bits) for bits, dtype in zarrDtypes.items())[array["dtype"]])
+		self.directory = os.path.join(path, str(level))
+
+	def getSize(self):
+		return self.frames * self.channels * self.slices
+
+	def getSliceLabel(self, n):
+		return None
+
+	def getProcessor(self, n):
+		c = (n - 1) % self.channels
+		z = ((n - 1) / self.channels) % self.slices
+		t = (n - 1) / (self.channels * self.slices)
+		width, height, bitDepth = self.getWidth(), self.getHeight(), self.getBitDepth()
+		if bitDepth == 8:
+			ip = ByteProcessor(width, height)
+		elif bitDepth == 16:
+			ip = ShortProcessor(width, height)
+		else:
+			ip = FloatProcessor(width, height)
+		length = self.chunkWidth * self.chunkHeight * bitDepth / 8
+		for y in range((height + self.chunkHeight - 1) / self.chunkHeight):
+			for x in range((width + self.chunkWidth - 1) / self.chunkWidth):
+				chunkPath = os.path.join(self.directory, str(t), str(c), str(z), str(y), str(x))
+				if not os.path.exists(chunkPath): # missing chunks are all zeros
+					continue
+				buf = ByteBuffer.wrap(inflate(Files.readAllBytes(Paths.get(chunkPath)), length))
+				if bitDepth == 8:
+					tile = ByteProcessor(self.chunkWidth, self.chunkHeight, buf.array(), None)
+				elif bitDepth == 16:
+					pixels = jarray.zeros(self.chunkWidth * self.chunkHeight, "h")
+					buf.asShortBuffer().get(pixels)
+					tile = ShortProcessor(self.chunkWidth, self.chunkHeight, pixels, None)
+				else:
+					pixels = jarray.zeros(self.chunkWidth * self.chunkHeight, "f")
+					buf.asFloatBuffer().get(pixels)
+					tile = FloatProcessor(self.chunkWidth, self.chunkHeight, pixels, None)
+				ip.insert(tile, x * self.chunkWidth, y * self.chunkHeight)
+		return ip
+
+	def getPixels(self, n):
+		return self.getProcessor(n).getPixels()
+
+# open_zarr opens one level of an OME-Zarr folder that ZarrWriter saved as a hyperstack, with its pixel size and channel colors (level 0 is full size, every level after it is half the size)
+# With virtual = True the planes are only read when they are needed, otherwise they are all read now
+def open_zarr(path, level, virtual):
+	attributes = read_json(os.path.join(path, ".zattrs"))
+	multiscales = attributes["multiscales"][0]
+	zarr = ZarrStack(path, level)
+	stack = zarr
+	if not virtual:
+		stack = ImageStack(zarr.getWidth(), zarr.getHeight())
+		for n in range(1, zarr.getSize() + 1):
+			stack.addSlice(None, zarr.getProcessor(n))
+
+	imp = ImagePlus(multiscales["name"], stack)
+	imp.setDimensions(zarr.channels, zarr.slices, zarr.frames)
+	imp.setOpenAsHyperStack(True)
+	scale = multiscales["datasets"][level]["coordinateTransformations"][0]["scale"]
+	cal = imp.getCalibration()
+	cal.frameInterval, cal.pixelDepth, cal.pixelHeight, cal.pixelWidth = scale[0], scale[2], scale[3], scale[4]
+	if multiscales["axes"][-1].get("unit") == "micrometer":
+		cal.setUnit("micron")
+
+	luts = []
+	for channel in attributes.get("omero", {}).get("channels", []):
+		color = int(channel["color"], 16)
+		ramps = [jarray.array([signed(i * ((color >> shift) & 255) / 255, 8) for i in range(256)], "b") for shift in (16, 8, 0)]
+		lut = LUT(ramps[0], ramps[1], ramps[2])
+		lut.min, lut.max = channel["window"]["start"], channel["window"]["end"]
+		luts.append(lut)
+	if zarr.channels > 1:
+		modes = {"composite": CompositeImage.COMPOSITE, "color": CompositeImage.COLOR, "grayscale": CompositeImage.GRAYSCALE}
+		imp = CompositeImage(imp, modes.get(attributes.get("imagej", {}).get("mode"), CompositeImage.COMPOSITE))
+		if len(luts) == zarr.channels:
+			imp.setLuts(luts)
+	elif len(luts) == 1:
+		imp.setLut(luts[0])
+		imp.setDisplayRange(luts[0].min, luts[0].max)
+	return imp
+
+# write_tiff saves an image as a TIF
+def write_tiff(imp, path):
+	if not FileSaver(imp).saveAsTiff(path):
+		raise IOError("Could not save " + path)
+
+# write_zarr saves an image as an OME-Zarr folder
+def write_zarr(imp, path):
+	writer = ZarrWriter(path, imp)
+	writer.append(imp)
+	writer.close()
+
+# save_tiff saves an image as a TIF named after its title (or as an OME-Zarr folder, see outputFormat at the top), and remembers the file so process_scan() can list it in the manifest
+# With asyncWrites the image is saved on the writer thread, so it has to be closed with close_images() (which waits for the save) and not with flush(), and it can't be changed until the save is done (applyLut() waits for it)
+# Virtual stacks are saved before save_tiff returns, since the next stage reads the same files (and a Bio-formats reader can't be read from two threads at once)
+# During chunked processing (see process_chunked()), each block is added to the end of the file the first block started
+def save_tiff(imp, directory):
+	path = os.path.join(directory, imp.getTitle())
+	if path.lower().endswith(".tif"):
+		path = path[:-4]
+	if outputFormat == "zarr":
+		path = path + ".ome.zarr"
+		Writer = ZarrWriter
+	else:
+		path = path + ".tif"
+		Writer = AppendableTiff
+	appending = getattr(scanState, "appending", None)
+	if appending is not None:
+		if path in appending:
+			in_writer(appending[path].append, imp)
+			return path
+		appending[path] = Writer(path, imp)
+		in_writer(appending[path].append, imp)
+	elif outputFormat == "zarr":
+		in_writer(write_zarr, imp, path)
+	else:
+		in_writer(write_tiff, imp, path)
+	if imp.getStack().isVirtual():
+		wait_for_writes()
+	if hasattr(scanState, "outputs"):
+		scanState.outputs.append(path)
+	return path
+
+# The event log (events.jsonl in the experiment folder) gets one JSON record per scan per stage: when it started and ended, how long it took, the heap before and after, the scan's dimensions, the bytes written and any error
+# run_it() opens it once per run and sums it up at the end. Scans running at the same time take turns writing to it
+eventLog = {"file": None, "run": None, "records": []}
+eventLock = threading.Lock()
+
+# log_event adds a record to the event log
+def log_event(record):
+	eventLock.acquire()
+	try:
+		eventLog["records"].append(record)
+		if eventLog["file"] is not None:
+			eventLog["file"].write(json.dumps(record, sort_keys = True) + "\n")
+			eventLog["file"].flush()
+	finally:
+		eventLock.release()
+
+# begin_event starts timing a stage of the scan that is running on this thread. Stages can be inside each other (the import is part of the split stage, and every stage is part of the scan)
+def begin_event(stage):
+	if not hasattr(scanState, "events"):
+		scanState.events = []
+	scanState.events.append({"stage": stage, "start": time.time(), "heapBefore": IJ.currentMemory()})
+
+# end_event finishes the stage that was started last, and logs it along with the files it saved and the scan's dimensions (once the probe has found them). Returns the bytes it saved
+# The stages' files are only listed until the stage finishes, so the scan adds up what its stages saved (see finish_stage())
+def end_event(error = None, bytesRead = None):
+	event = scanState.events.pop()
+	end = time.time()
+	bytesWritten = sum([output_size(path) for path in getattr(scanState, "outputs", [])])
+	if event["stage"] == "scan":
+		bytesWritten += getattr(scanState, "scanBytes", 0)
+	log_event({"run": eventLog["run"], "scan": getattr(scanState, "scan", None), "stage": event["stage"],
+		"start": datetime.datetime.fromtimestamp(event["start"]).isoformat(), "end": datetime.datetime.fromtimestamp(end).isoformat(), "seconds": round(end - event["start"], 3),
+		"heapBefore": event["heapBefore"], "heapAfter": IJ.currentMemory(), "dims": getattr(scanState, "dims", None),
+		"bytesWritten": bytesWritten, "bytesRead": bytesRead, "error": error})
+	return bytesWritten
+
+# output_size returns the size of an output in bytes: a TIF, or all the chunks of an OME-Zarr folder
+def output_size(path):
+	if os.path.isdir(path):
+		return sum([os.path.getsize(os.path.join(root, f)) for root, dirs, files in os.walk(path) for f in files])
+	if os.path.exists(path):
+		return os.path.getsize(path)
+	return 0
+
+# end_all_events ends every stage that is still running on this thread, for when a scan stops with an error
+def end_all_events(error):
+	while len(getattr(scanState, "events", [])) > 0:
+		end_event(error)
+
+# event_summary sums up the event log of this run: the slowest scans, and the total time of each stage over all scans
+def event_summary(records, top):
+	lines = []
+	scans = sorted([r for r in records if r["stage"] == "scan"], key = lambda r: -r["seconds"])
+	if len(scans) > 0:
+		lines.append("Slowest scans:")
+		for r in scans[:top]:
+			lines.append("  %-40s %9.1f s%s" % (r["scan"], r["seconds"], "  (error)" if r["error"] else ""))
+	stageTotals = {}
+	for r in records:
+		if r["stage"] != "scan":
+			stageTotals[r["stage"]] = stageTotals.get(r["stage"], 0) + r["seconds"]
+	if len(stageTotals) > 0:
+		lines.append("Time spent in each stage (all scans):")
+		for stage in sorted(stageTotals, key = lambda s: -stageTotals[s]):
+			lines.append("  %-40s %9.1f s" % (stage, stageTotals[stage]))
+	slowest = sorted([r for r in records if r["stage"] != "scan"], key = lambda r: -r["seconds"])
+	if len(slowest) > 0:
+		lines.append("Slowest stages:")
+		for r in slowest[:top]:
+			lines.append("  %-40s %9.1f s" % (r["scan"] + " " + r["stage"], r["seconds"]))
+	return "\n".join(lines) + "\n"
+
+# input_files lists every raw data file of a scan with its size and modification time. If any of these change, the scan is processed from scratch
+def input_files(scan, microscopeType):
+	paths = []
+	for root, dirs, files in os.walk(scan):
+		if root == scan and "processed" in dirs:
+			dirs.remove("processed") # the outputs are not inputs
+		for f in files:
+			if not f.startswith(claimName): # shared queue claims are not inputs either
+				paths.append(os.path.join(root, f))
+	if microscopeType == "Olympus":
+		paths.append(os.path.splitext(scan)[0]) # the .oif file sits next to the .oif.files folder
+
+	inputs = {}
+	for path in paths:
+		stat = os.stat(path)
+		inputs[os.path.relpath(path, os.path.dirname(scan))] = [stat.st_size, int(stat.st_mtime)]
+	return inputs
+
+# stage_parameters returns the settings a stage's outputs depend on. If any of them change, the stage (and the stages made from it) are redone
+def stage_parameters(stage):
+	colors = [str(ch1color), str(ch2color), str(ch3color)]
+	if stage == "MAX":
+		parameters = {"projections": sorted(projections)}
+	elif stage == "merge":
+		parameters = {"colors": colors}
+	elif stage == "filtered":
+		parameters = {"makeFiltered": makeFiltered, "medianRadius": medianRadius, "saveFilteredStacks": saveFilteredStacks, "colors": colors, "projections": sorted(projections)}
+	elif stage == "diff":
+		parameters = {"differenceNumber": int(differenceNumber), "differenceOffsets": sorted(differenceOffsets), "differenceOutput": differenceOutput}
+	elif stage == "split" and rawOutput != "copy": # like outputFormat, only listed when it's changed
+		parameters = {"rawOutput": rawOutput}
+	else:
+		parameters = {}
+	if outputFormat != "tiff": # only listed when it's changed, so manifests from before it was a setting are still up to date
+		parameters["outputFormat"] = outputFormat
+	return parameters
+
+# read_manifest loads processed/manifest.json for a scan. Returns None if there isn't one (or it can't be read)
+def read_manifest(scan):
+	manifestPath = os.path.join(scan, "processed", "manifest.json")
+	if not os.path.exists(manifestPath):
+		return None
+	try:
+		manifestFile = open(manifestPath, "r")
+		manifest = json.load(manifestFile)
+		manifestFile.close()
+		return manifest
+	except ValueError:
+		print "Could not read", manifestPath, "- processing from scratch"
+		return None
+
+# write_manifest saves the manifest. It is written to a temporary file first, so a crash never leaves half a manifest behind
+def write_manifest(directories, manifest):
+	manifestPath = os.path.join(directories[0], "manifest.json")
+	tempPath = manifestPath + ".tmp"
+	manifestFile = open(tempPath, "w")
+	json.dump(manifest, manifestFile, indent = 1, sort_keys = True)
+	manifestFile.close()
+	if os.path.exists(manifestPath):
+		os.remove(manifestPath)
+	os.rename(tempPath, manifestPath)
+
+# stages_to_run compares the manifest to the current settings and returns the stages that still have to be made, in order
+# A stage is redone if it never finished, its settings changed, one of its outputs is missing, or a stage it is made from is being redone
+def stages_to_run(manifest, directories):
+	todo = []
+	for stage in stageOrder:
+		record = manifest["stages"].get(stage)
+		upToDate = record is not None and record["done"] and record["parameters"] == stage_parameters(stage)
+		if upToDate:
+			upToDate = all(os.path.exists(os.path.join(directories[0], f)) for f in record["outputs"])
+		if not upToDate or any(s in todo for s in stageNeeds[stage]):
+			todo.append(stage)
+	return todo
+
+# start_stage deletes the outputs from the last time a stage was made (so old Diff movies don't hang around) and starts collecting the new ones
+def start_stage(manifest, directories, stage):
+	record = manifest["stages"].get(stage)
+	if record is not None:
+		for f in record["outputs"]:
+			path = os.path.join(directories[0], f)
+			if os.path.isdir(path): # an OME-Zarr folder
+				shutil.rmtree(path)
+			elif os.path.exists(path):
+				os.remove(path)
+	manifest["stages"][stage] = {"done": False, "parameters": stage_parameters(stage), "outputs": []}
+	write_manifest(directories, manifest)
+	scanState.outputs = []
+	begin_event(stage)
+
+# finish_stage marks a stage as done in the manifest, along with the files it made
+def finish_stage(manifest, directories, stage):
+	record = manifest["stages"][stage]
+	record["outputs"] = [os.path.relpath(path, directories[0]) for path in scanState.outputs]
+	record["done"] = True
+	record["finished"] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+	wait_for_writes() # a stage is only done once its files are on disk
+	write_manifest(directories, manifest)
+	scanState.scanBytes = getattr(scanState, "scanBytes", 0) + end_event()
+	scanState.outputs = []
+
+# open_outputs opens the images a finished stage saved whose names start with prefix, so a scan can pick up where it stopped without importing it again
+# With virtual = True they are opened as virtual stacks
+def open_outputs(manifest, directories, stage, prefix, virtual):
+	imps = []
+	for f in manifest["stages"][stage]["outputs"]:
+		if not os.path.basename(f).startswith(prefix):
+			continue
+		if f.endswith(".ome.zarr"):
+			imps.append(open_zarr(os.path.join(directories[0], f), 0, virtual))
+		elif f.endswith(".planes.json"): # always virtual, the planes are read from the scan's TIFs when they are used
+			imps.append(open_plane_links(os.path.join(directories[0], f)))
+		elif virtual:
+			imps.append(IJ.openVirtual(os.path.join(directories[0], f)))
+		else:
+			imps.append(IJ.openImage(os.path.join(directories[0], f)))
+	return imps
+
+
+# bruker_files sorts the PrairieView TIFs of a scan by their names: basename_Cycle00001_Ch1_000001.ome.tif is cycle 1, channel 1, plane 1
+# Returns a dictionary of (cycle, channel, plane): file name. The dimensions of the scan come from these names, so no image metadata has to be read
+def bruker_files(scan, basename):
+	pattern = re.compile("^" + re.escape(basename) + r"_Cycle(\d+)_Ch(\d+)_(\d+)\.ome\.tif$")
+	planes = {}
+	for f in os.listdir(scan):
+		match = pattern.match(f)
+		if match:
+			planes[tuple([int(n) for n in match.groups()])] = f
+	return planes
+
+# bruker_xml_header reads the start of the PrairieView .xml for the sequence type, the pixel size, the z step and the time between frames
+# Only the first frames are read: the first two (or, for a Z-series, the whole first cycle and the start of the second). The rest of the .xml (one entry per frame) is never read, which is what makes initiating Bio-formats from the .xml so slow
+# zStep is how far the stage or piezo moved between the first two frames (positionCurrent of the ZAxis, adding up all the z devices). planeInterval is the time between the first two frames of the first cycle, and cycleInterval the time between the starts of the first two cycles. Any of them is None if the .xml doesn't have it
+def bruker_xml_header(scan, basename):
+	header = {"sequenceType": None, "micronsPerPixel": {}, "zStep": None, "planeInterval": None, "cycleInterval": None}
+	xmlPath = os.path.join(scan, basename + ".xml")
+	if not os.path.exists(xmlPath):
+		return header
+	xmlFile = open(xmlPath, "r")
+	inPixelSize = False
+	inZAxis = False
+	sequences = 0
+	frames = [] # the frames read so far: {"sequence", "relativeTime", "absoluteTime", "z"}
+	for line in xmlFile:
+		if "<Sequence " in line:
+			sequences += 1
+			match = re.search(r'type="([^"]+)"', line)
+			if match and header["sequenceType"] is None:
+				header["sequenceType"] = match.group(1)
+		elif "<Frame " in line:
+			frame = {"sequence": sequences, "relativeTime": None, "absoluteTime": None, "z": None}
+			for key in ("relativeTime", "absoluteTime"):
+				match = re.search(key + r'="([0-9.eE+-]+)"', line)
+				if match:
+					frame[key] = float(match.group(1))
+			frames.append(frame)
+			if sequences > 1: # the start of the second cycle is all that is needed from it
+				break
+		elif "</Frame>" in line and len(frames) >= 2 and "ZSeries" not in (header["sequenceType"] or "ZSeries"):
+			break
+		elif len(frames) == 0: # before the first frame: the settings of the whole scan
+			if 'key="micronsPerPixel"' in line:
+				inPixelSize = True
+			elif inPixelSize:
+				match = re.search(r'index="(\w+)" value="([0-9.eE+-]+)"', line)
+				if match:
+					header["micronsPerPixel"][match.group(1)] = float(match.group(2))
+				elif "</PVStateValue>" in line:
+					inPixelSize = False
+		else: # inside a frame: its z position, either <Key key="positionCurrent_ZAxis" value=.../> (older PrairieView) or one <SubindexedValue value=.../> per z device
+			match = re.search(r'value="([0-9.eE+-]+)"', line)
+			if 'key="positionCurrent_ZAxis"' in line and match:
+				frames[-1]["z"] = float(match.group(1))
+			elif '<SubindexedValues index="ZAxis"' in line:
+				inZAxis = True
+			elif inZAxis and match:
+				frames[-1]["z"] = (frames[-1]["z"] or 0.0) + float(match.group(1))
+			elif "</SubindexedValues>" in line:
+				inZAxis = False
+	xmlFile.close()
+
+	first = [entry for entry in frames if entry["sequence"] <= 1][:2]
+	if len(first) == 2:
+		if first[0]["z"] is not None and first[1]["z"] is not None and first[0]["z"] != first[1]["z"]:
+			header["zStep"] = abs(first[1]["z"] - first[0]["z"])
+		if first[0]["relativeTime"] is not None and first[1]["relativeTime"] is not None:
+			header["planeInterval"] = first[1]["relativeTime"] - first[0]["relativeTime"]
+	starts = [[entry for entry in frames if entry["sequence"] == n][:1] for n in (1, 2)]
+	if starts[0] and starts[1] and starts[0][0]["absoluteTime"] is not None and starts[1][0]["absoluteTime"] is not None:
+		header["cycleInterval"] = starts[1][0]["absoluteTime"] - starts[0][0]["absoluteTime"]
+	return header
+
+# read_buffer reads length bytes at position from a file channel
+def read_buffer(channel, position, length, order):
+	buf = ByteBuffer.allocate(length)
+	while buf.hasRemaining():
+		if channel.read(buf, position + buf.position()) < 0:
+			break
+	buf.flip()
+	buf.order(order)
+	return buf
+
+# tiff_layout reads the first image directory of a TIF and returns the tags needed to find the pixels (size, bit depth, compression and strips)
+# The image description, where the OME-XML lives, is skipped
+def tiff_layout(channel):
+	header = read_buffer(channel, 0, 8, ByteOrder.LITTLE_ENDIAN)
+	if header.get(0) == ord("I"):
+		order = ByteOrder.LITTLE_ENDIAN
+	else:
+		order = ByteOrder.BIG_ENDIAN
+	header.order(order)
+	if header.getShort(2) != 42:
+		raise ValueError("Not a plain TIF (BigTIFF or not a TIF at all)")
+	ifdOffset = header.getInt(4) & 0xffffffffL
+	count = read_buffer(channel, ifdOffset, 2, order).getShort(0) & 0xffff
+	entries = read_buffer(channel, ifdOffset + 2, count * 12, order)
+
+	tags = {}
+	for i in range(count):
+		tag = entries.getShort(i * 12) & 0xffff
+		if tag not in (256, 257, 258, 259, 273, 277, 279): # width, height, bits per sample, compression, strip offsets, samples per pixel, strip byte counts
+			continue
+		fieldType = entries.getShort(i * 12 + 2) & 0xffff
+		n = entries.getInt(i * 12 + 4)
+		size = 2 if fieldType == 3 else 4 # SHORT or LONG
+		if n * size <= 4: # small values are stored in the entry itself
+			values = read_buffer(channel, ifdOffset + 2 + i * 12 + 8, 4, order)
+		else:
+			values = read_buffer(channel, entries.getInt(i * 12 + 8) & 0xffffffffL, n * size, order)
+		if size == 2:
+			tags[tag] = [values.getShort(j * 2) & 0xffff for j in range(n)]
+		else:
+			tags[tag] = [values.getInt(j * 4) & 0xffffffffL for j in range(n)]
+	return tags, order
+
+# read_tiff_plane reads the pixels of a single plane TIF straight into a pixel array. If the pixels are stored in one piece (they are for PrairieView), the file is memory-mapped
+def read_tiff_plane(path):
+	raf = RandomAccessFile(path, "r")
+	try:
+		channel = raf.getChannel()
+		tags, order = tiff_layout(channel)
+		width, height = tags[256][0], tags[257][0]
+		bits = tags.get(258, [1])[0]
+		if tags.get(259, [1])[0] != 1 or tags.get(277, [1])[0] != 1 or bits not in (8, 16):
+			raise ValueError(os.path.basename(path) + " is compressed, RGB or not 8/16-bit")
+		nBytes = width * height * bits / 8
+		offsets, lengths = tags[273], tags[279]
+
+		if all(offsets[i] + lengths[i] == offsets[i + 1] for i in range(len(offsets) - 1)):
+			buf = channel.map(FileChannel.MapMode.READ_ONLY, offsets[0], nBytes) # one piece, so it can be mapped
+			buf.order(order)
+		else:
+			buf = ByteBuffer.allocate(nBytes)
+			for i in range(len(offsets)):
+				buf.put(read_buffer(channel, offsets[i], min(lengths[i], buf.remaining()), order))
+			buf.flip()
+			buf.order(order)
+
+		if bits == 16:
+			pixels = jarray.zeros(width * height, "h")
+			buf.asShortBuffer().get(pixels)
+		else:
+			pixels = jarray.zeros(width * height, "b")
+			buf.get(pixels)
+	finally:
+		raf.close()
+	return width, height, pixels, nBytes
+
+# TifPlaneStack is a virtual stack of single plane TIFs. Each plane is only read from disk when it is asked for (see streamingProjection at the top)
+class TifPlaneStack(VirtualStack):
+	def __init__(self, width, height, bitDepth, paths):
+		VirtualStack.__init__(self, width, height, None, None)
+		self.setBitDepth(bitDepth)
+		self.paths = paths
+
+	def getSize(self):
+		return len(self.paths)
+
+	def getSliceLabel(self, n):
+		return os.path.basename(self.paths[n - 1])
+
+	def getPixels(self, n):
+		return read_tiff_plane(self.paths[n - 1])[2]
+
+	def getProcessor(self, n):
+		width, height, pixels, nBytes = read_tiff_plane(self.paths[n - 1])
+		if self.getBitDepth() == 16:
+			return ShortProcessor(width, height, pixels, None)
+		return ByteProcessor(width, height, pixels, None)
+
+# StackView is a virtual stack that shows some of the planes of another stack (for example, one channel of a hyperstack) without copying them
+class StackView(VirtualStack):
+	def __init__(self, source, indices):
+		VirtualStack.__init__(self, source.getWidth(), source.getHeight(), None, None)
+		self.setBitDepth(source.getBitDepth())
+		self.source = source
+		self.indices = indices
+
+	def getSize(self):
+		return len(self.indices)
+
+	def getSliceLabel(self, n):
+		return self.source.getSliceLabel(self.indices[n - 1])
+
+	def getPixels(self, n):
+		return self.source.getPixels(self.indices[n - 1])
+
+	def getProcessor(self, n):
+		return self.source.getProcessor(self.indices[n - 1])
+
+# MergedView is a virtual stack that interleaves the planes of single channel stacks into one hyperstack (channels change fastest, like XYCZT) without copying them
+class MergedView(VirtualStack):
+	def __init__(self, sources):
+		VirtualStack.__init__(self, sources[0].getWidth(), sources[0].getHeight(), None, None)
+		self.setBitDepth(sources[0].getBitDepth())
+		self.sources = sources
+
+	def getSize(self):
+		return len(self.sources) * self.sources[0].getSize()
+
+	def getSliceLabel(self, n):
+		return self.sources[(n - 1) % len(self.sources)].getSliceLabel((n - 1) / len(self.sources) + 1)
+
+	def getPixels(self, n):
+		return self.sources[(n - 1) % len(self.sources)].getPixels((n - 1) / len(self.sources) + 1)
+
+	def getProcessor(self, n):
+		return self.sources[(n - 1) % len(self.sources)].getProcessor((n - 1) / len(self.sources) + 1)
+
+# bruker_layout works out the hyperstack of a Bruker scan from the file names and the start of the .xml, without reading any pixels
+# Returns the channels, the timepoints (each a list of (cycle, plane)) and which timepoints have a file for every channel and plane
+def bruker_layout(scan, basename):
+	files = bruker_files(scan, basename)
+	if len(files) == 0:
+		raise ValueError("No " + basename + "_Cycle*_Ch*_*.ome.tif files found")
+	header = bruker_xml_header(scan, basename)
+	cycles = sorted(set([key[0] for key in files]))
+	channelList = sorted(set([key[1] for key in files]))
+
+	# For Z-series, every cycle is a timepoint and the planes are the z-slices. Otherwise every plane is a timepoint
+	if header["sequenceType"] is not None:
+		zSeries = "ZSeries" in header["sequenceType"]
+	else:
+		zSeries = len(cycles) > 1
+	if zSeries:
+		planeList = sorted(set([key[2] for key in files if key[0] == cycles[0]]))
+		timepoints = [[(cycle, p) for p in planeList] for cycle in cycles]
+	else:
+		timepoints = [[(cycle, p)] for cycle in cycles for p in sorted(set([key[2] for key in files if key[0] == cycle]))]
+
+	complete = [t for t in timepoints if all((cycle, c, p) in files for (cycle, p) in t for c in channelList)]
+	return files, header, channelList, timepoints, complete
+
+# open_bruker_native builds the hyperstack (XYCZT) of a Bruker scan by reading the TIFs directly, without Bio-formats
+# With virtual = True the planes are only read when they are needed, instead of all at once
+# Incomplete timepoints (from stopping an acquisition early, or missing files) are left out. Raises ValueError if the files can't be read this way, so make_hyperstack() can use Bio-formats instead
+def open_bruker_native(scan, basename, virtual):
+	files, header, channelList, timepoints, complete = bruker_layout(scan, basename)
+	if len(complete) == 0:
+		raise Exception("No complete timepoints in " + basename)
+
+	paths = [os.path.join(scan, files[(cycle, c, p)]) for t in complete for (cycle, p) in t for c in channelList] # XYCZT order: channels change fastest, then z, then time
+	if virtual:
+		width, height, pixels, nBytes = read_tiff_plane(paths[0]) # checks that the files can be read directly, and gets the size
+		stack = TifPlaneStack(width, height, nBytes * 8 / (width * height), paths)
+	else:
+		start = time.time()
+		stack = None
+		totalBytes = 0
+		for path in paths:
+			width, height, pixels, nBytes = read_tiff_plane(path)
+			if stack is None:
+				stack = ImageStack(width, height)
+			stack.addSlice(os.path.basename(path), pixels)
+			totalBytes += nBytes
+		seconds = max(time.time() - start, 0.001)
+		print "Read", stack.getSize(), "planes (%.1f MB) in %.1f s: %.1f MB/s" % (totalBytes / 1048576.0, seconds, totalBytes / 1048576.0 / seconds)
+
+	imp = ImagePlus(basename, stack)
+	imp.setDimensions(len(channelList), len(complete[0]), len(complete))
+	imp.setOpenAsHyperStack(True)
+	imp.setProperty("planePaths", paths) # the TIF of every plane, so split_channels() can link to them (see rawOutput at the top)
+	cal = imp.getCalibration()
+	if "XAxis" in header["micronsPerPixel"]:
+		cal.pixelWidth = header["micronsPerPixel"]["XAxis"]
+		cal.pixelHeight = header["micronsPerPixel"].get("YAxis", cal.pixelWidth)
+		cal.setUnit("micron")
+	if len(complete[0]) > 1 and header["zStep"] is not None:
+		cal.pixelDepth = header["zStep"]
+	# With z-slices every cycle is a timepoint, otherwise every plane is (unless there is only one plane per cycle)
+	if len(complete[0]) > 1 or header["planeInterval"] is None:
+		interval = header["cycleInterval"]
+	else:
+		interval = header["planeInterval"]
+	if interval is not None and interval > 0:
+		cal.frameInterval = interval
+		cal.setTimeUnit("sec")
+	return imp
+
+# read_oif reads an Olympus .oif file (an .ini style text file, usually UTF-16) into a dictionary of {section: {key: value}}
+def read_oif(path):
+	oifFile = open(path, "rb")
+	text = oifFile.read()
+	oifFile.close()
+	if text[:2] in ("\xff\xfe", "\xfe\xff") or "\x00" in text[:100]:
+		text = text.decode("utf-16")
+	sections = {}
+	section = None
+	for line in text.splitlines():
+		line = line.strip()
+		if line.startswith("[") and line.endswith("]"):
+			section = sections.setdefault(line[1:-1], {})
+		elif section is not None and "=" in line:
+			key, value = line.split("=", 1)
+			section[key.strip()] = value.strip().strip('"')
+	return sections
+
+# The names of the plane TIFs in an Olympus .oif.files folder: s_C001Z001T001.tif is channel 1, z-slice 1, timepoint 1 (single z-slice and single timepoint scans leave out Z and T)
+olympusPlaneNames = re.compile(r"^s_C(\d+)(?:Z(\d+))?(?:T(\d+))?\.tif$", re.IGNORECASE)
+
+# probe_olympus gets the dimensions of an Olympus scan from the .oif file, and the partial timepoints from the names of the TIFs in the .oif.files folder (s_C001Z001T001.tif)
+def probe_olympus(scan):
+	oifPath = os.path.splitext(scan)[0]
+	if not os.path.exists(oifPath):
+		raise Exception("No .oif file next to " + os.path.basename(scan))
+	oif = read_oif(oifPath)
+
+	sizes = {}
+	for section in oif:
+		if section.startswith("Axis ") and section.endswith("Parameters Common") and "AxisCode" in oif[section]:
+			sizes[oif[section]["AxisCode"]] = max(int(float(oif[section].get("MaxSize", "0"))), 1) # unused axes have a size of 0
+	if "X" not in sizes or "Y" not in sizes:
+		raise Exception("The .oif file of " + os.path.basename(scan) + " has no image size. Check metadata for completeness.")
+	bitDepth = 8 * int(oif.get("Reference Image Parameter", {}).get("ImageDepth", "2"))
+
+	# Every plane is its own TIF, so a timepoint is complete if it has a TIF for every channel and z-slice
+	planes = {}
+	for f in os.listdir(scan):
+		match = olympusPlaneNames.match(f)
+		if match:
+			t = int(match.group(3) or 1)
+			planes[t] = planes.get(t, 0) + 1
+	planesPerFrame = sizes.get("C", 1) * sizes.get("Z", 1)
+	frames = 0
+	while planes.get(frames + 1, 0) >= planesPerFrame: # Bio-formats can only leave out timepoints at the end
+		frames += 1
+
+	return {"width": sizes["X"], "height": sizes["Y"], "channels": sizes.get("C", 1), "slices": sizes.get("Z", 1), "frames": frames,
+		"partialFrames": len(planes) - frames, "bitDepth": bitDepth}
+
+# probe_bruker gets the dimensions of a Bruker scan from the file names and the start of the .xml, and the image size from the header of the first TIF
+def probe_bruker(scan, basename):
+	files, header, channelList, timepoints, complete = bruker_layout(scan, basename)
+	if len(complete) == 0:
+		raise Exception("No complete timepoints in " + basename)
+	raf = RandomAccessFile(os.path.join(scan, files[min(files)]), "r")
+	try:
+		tags, order = tiff_layout(raf.getChannel())
+	finally:
+		raf.close()
+	return {"width": tags[256][0], "height": tags[257][0], "channels": len(channelList), "slices": len(complete[0]), "frames": len(complete),
+		"partialFrames": len(timepoints) - len(complete), "bitDepth": tags.get(258, [16])[0]}
+
+# probe_scan reads only the metadata of a scan (no pixels) and returns its dimensions, bit depth and size in bytes, and how many timepoints are incomplete
+# It raises an error for scans that can't be processed, so they are skipped before gigabytes of pixels are imported
+def probe_scan(scan, microscopeType):
+	basename = os.path.basename(scan)
+	if microscopeType == "Olympus":
+		probe = probe_olympus(scan)
+	else:
+		probe = probe_bruker(scan, basename)
+	if probe["frames"] == 0:
+		raise Exception("No complete timepoints in " + basename)
+	probe["bytes"] = probe["width"] * probe["height"] * (probe["bitDepth"] / 8) * probe["channels"] * probe["slices"] * probe["frames"]
+	print basename, "is %(channels)d channel(s), %(slices)d z-slice(s), %(frames)d timepoint(s) of %(width)dx%(height)d at %(bitDepth)d-bit" % probe, "(%.1f MB)" % (probe["bytes"] / 1048576.0)
+	if probe["partialFrames"] > 0:
+		print "Leaving out", probe["partialFrames"], "incomplete timepoint(s) of", basename
+	return probe
+
+# scan_footprints estimates how much memory a scan of the probed size needs, in bytes, when it is processed in memory and as a virtual stack
+# In memory, the raw hyperstack is held along with everything made from it (projections, merges, filtered data and difference movies). As a virtual stack, only one z-stack per channel is read at a time, but the outputs are still held
+def scan_footprints(probe):
+	planeBytes = probe["width"] * probe["height"] * probe["bitDepth"] / 8
+	floatBytes = probe["width"] * probe["height"] * 4
+	channels, slices, frames = probe["channels"], probe["slices"], probe["frames"]
+	offsets = len(set([k for k in [int(differenceNumber)] + list(differenceOffsets) if k > 0]))
+
+	projectionBytes = 0 # per channel and timepoint
+	if slices > 1:
+		for projType in set(["MAX"] + list(projections)):
+			if projType in ("MAX", "MIN"):
+				projectionBytes += planeBytes
+			else:
+				projectionBytes += floatBytes
+	if makeFiltered:
+		projectionBytes *= 2 # filteredMAX (and the other filtered projections)
+	diffBytes = offsets * floatBytes if differenceOutput == "signed" else offsets * planeBytes
+	outputBytes = channels * (projectionBytes + diffBytes) + floatBytes # the merges are RGB, 4 bytes per pixel
+	if makeFiltered and (slices == 1 or saveFilteredStacks):
+		outputBytes += channels * slices * planeBytes # filtered hyperstacks that are saved are made in memory
+	zStackBytes = channels * slices * planeBytes
+
+	return {"memory": frames * (zStackBytes + outputBytes), "virtual": frames * outputBytes + zStackBytes}
+
+# plan_scan picks how a scan is processed (see processingMode at the top): "memory" if everything fits in the memory budget, a "virtual" stack if only the outputs fit, and "chunked" if not even those do
+# Returns the mode and the memory it is expected to need. Scans without a probe (from before probing was added) use the mode the settings ask for
+def plan_scan(probe):
+	budget = IJ.maxMemory() * memoryBudget
+	if streamingProjection:
+		mode = "virtual"
+	elif processingMode != "auto":
+		mode = processingMode
+	else:
+		mode = "memory"
+	if probe is None:
+		return {"mode": mode, "footprint": 0, "budget": budget}
+
+	footprints = scan_footprints(probe)
+	footprints["chunked"] = footprints["memory"] / max(probe["frames"], 1) * chunk_frames(probe) * 2 # the block being processed and the one being written
+	if processingMode == "auto" and not streamingProjection:
+		if footprints["memory"] <= budget:
+			mode = "memory"
+		elif footprints["virtual"] <= budget:
+			mode = "virtual"
+		else:
+			mode = "chunked"
+	return {"mode": mode, "footprint": footprints[mode], "budget": budget, "footprints": footprints}
+
+# chunk_frames picks how many timepoints chunked processing works on at a time (see chunkFrames at the top): as many as fit in a third of the memory budget, since one block is processed while the one before it is written
+def chunk_frames(probe):
+	if chunkFrames > 0:
+		return chunkFrames
+	frameBytes = scan_footprints(probe)["memory"] / float(max(probe["frames"], 1))
+	return max(1, int(IJ.maxMemory() * memoryBudget / 3 / frameBytes))
+
+# The memory budget is shared by the scans that run at the same time (see parallelWorkers), in MB. A scan waits until there's enough left over for its footprint
+memoryPermitCount = max(1, int(IJ.maxMemory() * memoryBudget / 1048576))
+memoryPermits = Semaphore(memoryPermitCount, True)
+
+# reserve_memory waits until footprint bytes of the memory budget are free and takes them. A scan bigger than the whole budget takes all of it, so it runs on its own. Returns what was taken, for release_memory()
+def reserve_memory(footprint):
+	permits = min(max(1, int(math.ceil(footprint / 1048576.0))), memoryPermitCount)
+	memoryPermits.acquire(permits)
+	return permits
+
+def release_memory(permits):
+	if permits > 0:
+		memoryPermits.release(permits)
+
+# needs_import checks whether process_scan() will have to import a scan (it's new, changed, or its split stage isn't done), without importing anything
+def needs_import(scan, microscopeType):
+	if not resumeScans:
+		return True
+	manifest = read_manifest(scan)
+	if manifest is None or manifest["inputs"] != input_files(scan, microscopeType):
+		return True
+	return "split" in stages_to_run(manifest, [os.path.join(scan, "processed")])
+
+# prefetch_scan imports a scan in the background (see prefetchScans at the top) and returns (probe, hyperstack), or None if the scan wasn't imported
+# It waits for the scan before it to be imported first (previousImported), and only imports scans that plan_scan() would process in memory and whose footprint fits in the memory that is free then, with a quarter of the heap left over for the scan being processed
+# Once the scan is imported, imported is set, so the scan after it can be prefetched too. Errors are left for process_scan(), which imports the scan itself if the prefetch didn't, and logs them as usual
+def prefetch_scan(scan, microscopeType, previousImported, imported):
+	basename = os.path.basename(scan)
+	try:
+		previousImported.wait()
+		if streamingProjection or not needs_import(scan, microscopeType):
+			return None
+		probe = probe_scan(scan, microscopeType)
+		plan = plan_scan(probe)
+		free = IJ.maxMemory() - IJ.currentMemory()
+		if plan["mode"] != "memory" or plan["footprint"] > free - IJ.maxMemory() / 4:
+			print "Not enough free memory to prefetch", basename
+			return None
+		print "Prefetching", basename
+		imp = make_hyperstack(basename, scan, microscopeType, False, probe)
+		imported.set()
+		return probe, imp
+	except:
+		print "Could not prefetch", basename, "- it will be imported when it is processed"
+		return None
+
+# Make_hyperstack uses Bio-formats importer to import a hyperstack from an initiator file (or reads Bruker TIFs directly, see brukerReader at the top)
+# The hyperstack is never shown in a window. It is returned to process_scan() so every scan works on its own image, even when several scans run at the same time
+# With virtual = True the hyperstack is a virtual stack: planes are read from disk when they are used, so the scan doesn't have to fit in memory
+# probe is what probe_scan() found out about the scan. Incomplete timepoints at the end of Olympus scans are left out of the import
+def make_hyperstack(basename, scan, microscopeType, virtual, probe): # basename is defined in process_scan() and is the name of the scan (not the full path)
 
 	# Defines an "initator file" to give bioformats importer, and also modifies basename (which has an .oif.files extension) to make the scan name
 	if microscopeType == "Olympus":
@@ -108,13 +1485,20 @@ def make_hyperstack(basename, scan, microscopeType): # basename is defined in ru
 		basename = os.path.splitext(initiatorFileName) [0] # Removes .oif extension from initiatorFile to get the name of the scan (for naming windows and stuff)
 		print "basename is ", basename
 		print ".oif file is ",  initiatorFileName # This is the file that will get passed to bioformats importer
-		initiatorFilePath = os.path.join(experimentFolder, initiatorFileName) # Gets the full path to the initiatorFile
+		initiatorFilePath = os.path.join(os.path.dirname(scan), initiatorFileName) # Gets the full path to the initiatorFile, which sits next to the .oif.files folder
 		print "Opening file ", initiatorFilePath
 
 	elif microscopeType == "Bruker": # With Bruker microscopes, you can initiate from the .xml file, or from a single TIF. I have found that initiation from the .xml file slows down the import on windows computers, so I got rid of .xml initiation (commented out below)
 		#xmlFile = basename + ".xml"
 		#xmlFile = os.path.join(scan, xmlFile) # Makes path to the xml file
 		print "basename is ", basename # The basename doesn't need to be modified here, because there is no .oif.files suffix to remove (Thanks Bruker!)
+		if brukerReader == "native": # Reads the TIFs directly. If that doesn't work for this scan, it falls back to Bio-formats below
+			try:
+				imp = open_bruker_native(scan, basename, virtual)
+				imp.setTitle(basename + "_raw.tif")
+				return imp
+			except ValueError as e:
+				print "Can't read", basename, "directly (" + str(e) + "), using Bio-formats instead"
 		initiatorFileName = basename + "_Cycle00001_Ch?_000001.ome.tif" # Defines the pattern to look for. The Ch? is because if you have one color, it's not always on CH1
 		initiatorFilePath = os.path.join(scan, initiatorFileName) # Gets the full path to the initiator file
 		print "initiatorFilePath ", initiatorFilePath
@@ -122,39 +1506,44 @@ def make_hyperstack(basename, scan, microscopeType): # basename is defined in ru
 		initiatorFilePath = initiatorFilePath[0] # Takes the first item in the list. This is the file that will get passed to bioformats importer
 		print "Opening file", initiatorFilePath
 
-	IJ.run("Bio-Formats Importer", "open=[" + initiatorFilePath + "] color_mode=Grayscale concatenate_series open_all_series quiet rois_import=[ROI manager] view=Hyperstack stack_order=XYCZT")
+	# Same settings as the "Bio-Formats Importer" command, but the images are returned instead of opened in windows
+	options = ImporterOptions()
+	options.setId(initiatorFilePath)
+	options.setColorMode(ImporterOptions.COLOR_MODE_GRAYSCALE)
+	options.setConcatenate(True)
+	options.setOpenAllSeries(True)
+	options.setQuiet(True)
+	options.setStackOrder(ImporterOptions.ORDER_XYCZT)
+	options.setVirtual(virtual)
+	if microscopeType == "Olympus" and probe["partialFrames"] > 0: # only import the complete timepoints
+		options.setSpecifyRanges(True)
+		options.setTEnd(0, probe["frames"] - 1)
+	imps = BF.openImagePlus(options)
 	print "File opened"
 
-	# Get a list of the windows that are open
-	try:
-		image_titles = [WindowManager.getImage(id).getTitle() for id in WindowManager.getIDList()]
-	except TypeError:
-		raise TypeError("No windows open! Bio-formats failed. Check metadata for completeness.")
-		return
+	if imps is None or len(imps) == 0:
+		raise TypeError("No images opened! Bio-formats failed. Check metadata for completeness.")
 
-	#Checks to see if multiple windows are open. There should only be one hyperstack. If there are multiple, it will close windows with a single frame (because it sees them as partial slices).
+	#Checks to see if multiple images were opened. There should only be one hyperstack. If there are multiple, it will close images with a single frame (because it sees them as partial slices).
 	# If you have single z-stack data but somehow also have a partial slice, this might close everything (seems like a rare situation though).
-
-	if len(image_titles) > 1:
-		for i in image_titles:
-			print i
-			imp = WindowManager.getImage(i)
-			if imp.getNFrames() == 1: # If it is a partial slice, will close it
-				imp.close()
-	try:
-		image_titles = [WindowManager.getImage(id).getTitle() for id in WindowManager.getIDList()]
-	except TypeError:
-		raise Exception("No windows open! Is this a single slice acquisition?")
-		return
-
-	imp = IJ.getImage()
+	imps = list(imps)
+	if len(imps) > 1:
+		for i in list(imps):
+			print i.getTitle()
+			if i.getNFrames() == 1: # If it is a partial slice, will close it
+				i.flush()
+				imps.remove(i)
+
+	if len(imps) == 0:
+		raise Exception("No images left! Is this a single slice acquisition?")
+
+	imp = imps[-1] # The last image opened is the hyperstack (this is the one IJ.getImage() used to pick)
 	imp.setTitle(basename + "_raw.tif")
-	return basename
+	return imp
 
 # checks for single plane acquisition. Don't need since you ask up front
-def single_plane_check():
+def single_plane_check(imp):
 	print "Checking for z-planes..."
-	imp = IJ.getImage()
 	if imp.getNSlices() > 1:
 		print "The number of z-planes is ", imp.getNSlices()
 		singleplane = False
@@ -165,165 +1554,453 @@ def single_plane_check():
 
 	return singleplane
 
-# Runs the channel splitter if it detects multiple channels.
-def split_channels(directories, channels):
-	imp = IJ.getImage()
+# channel_plane_paths returns the TIF every plane of each channel of a hyperstack is in, for hyperstacks that open_bruker_native() read. Returns None for the ones Bio-formats imported
+def channel_plane_paths(imp):
+	paths = imp.getProperty("planePaths")
+	if paths is None:
+		return None
+	return [[paths[imp.getStackIndex(c, z, t) - 1] for t in range(1, imp.getNFrames() + 1) for z in range(1, imp.getNSlices() + 1)] for c in range(1, imp.getNChannels() + 1)]
+
+# write_plane_links saves a raw channel hyperstack as a list of the TIFs its planes are in (see rawOutput at the top), along with its dimensions and pixel size, so open_plane_links() can open it again. Returns the path
+def write_plane_links(imp, directory, paths):
+	path = os.path.join(directory, imp.getTitle())
+	if path.lower().endswith(".tif"):
+		path = path[:-4]
+	path = path + ".planes.json"
+	cal = imp.getCalibration()
+	links = {"width": imp.getWidth(), "height": imp.getHeight(), "bitDepth": imp.getBitDepth(), "slices": imp.getNSlices(), "frames": imp.getNFrames(),
+		"pixelWidth": cal.pixelWidth, "pixelHeight": cal.pixelHeight, "pixelDepth": cal.pixelDepth, "frameInterval": cal.frameInterval, "unit": cal.getUnit(),
+		"planes": [os.path.relpath(plane, directory) for plane in paths]} # relative, so it still works if the experiment folder is moved
+	in_writer(write_json, path, links)
+	if hasattr(scanState, "outputs"):
+		scanState.outputs.append(path)
+	return path
+
+# open_plane_links opens a raw channel hyperstack that write_plane_links() saved, as a virtual stack of the TIFs it lists
+def open_plane_links(path):
+	links = read_json(path)
+	paths = [os.path.normpath(os.path.join(os.path.dirname(path), plane)) for plane in links["planes"]]
+	imp = ImagePlus(os.path.basename(path)[:-len(".planes.json")] + ".tif", TifPlaneStack(links["width"], links["height"], links["bitDepth"], paths))
+	imp.setDimensions(1, links["slices"], links["frames"])
+	imp.setOpenAsHyperStack(True)
+	imp.setProperty("planePaths", paths)
+	cal = imp.getCalibration()
+	cal.pixelWidth, cal.pixelHeight, cal.pixelDepth, cal.frameInterval = links["pixelWidth"], links["pixelHeight"], links["pixelDepth"], links["frameInterval"]
+	cal.setUnit(links["unit"])
+	return imp
+
+# save_raw saves the raw channel hyperstacks in the raw folder: as TIFs, or as links to the scan's own TIFs if rawOutput = "links" and the planes come from them. paths is what channel_plane_paths() returned
+def save_raw(channelImps, directories, paths):
+	for c, imp in enumerate(channelImps):
+		if rawOutput == "links" and paths is not None:
+			write_plane_links(imp, directories[1], paths[c])
+		else:
+			save_tiff(imp, directories[1])
+
+# channel_image returns channel c of a hyperstack as its own hyperstack, named like "Split Channels" does (C1-, C2-...), without copying it
+# For a hyperstack in memory, the channel shares its pixel arrays. A virtual hyperstack gets a view of the channel (a StackView), so nothing is loaded
+def channel_image(imp, c):
+	source = imp.getStack()
+	indices = [imp.getStackIndex(c, z, t) for t in range(1, imp.getNFrames() + 1) for z in range(1, imp.getNSlices() + 1)]
+	if source.isVirtual():
+		stack = StackView(source, indices)
+	else:
+		stack = ImageStack(imp.getWidth(), imp.getHeight())
+		for n in indices:
+			stack.addSlice(source.getSliceLabel(n), source.getPixels(n)) # the same pixel array, not a copy
+	channelImp = ImagePlus("C" + str(c) + "-" + imp.getTitle(), stack)
+	channelImp.setDimensions(1, imp.getNSlices(), imp.getNFrames())
+	channelImp.setCalibration(imp.getCalibration().copy())
+	channelImp.setOpenAsHyperStack(True)
+	return channelImp
+
+# Splits the hyperstack into its channels if it has more than one (see channel_image()). Returns a list of the channel hyperstacks (C1, C2, C3)
+# Nothing is copied, so splitting doesn't need any memory of its own. Saving a view of a virtual hyperstack reads it one plane at a time
+def split_channels(imp, directories, channels):
+	paths = channel_plane_paths(imp)
 	if channels >1:
-		IJ.run("Split Channels")
+		channelImps = [channel_image(imp, c) for c in range(1, channels + 1)]
 	else:
 		print "Only one channel, bypassing channel splitter..."
-		imp = IJ.getImage()
 		windowName = imp.getTitle()
-		imp = imp.setTitle("C1-" + windowName) #just renames the window for continuity
+		imp.setTitle("C1-" + windowName) #just renames the image for continuity
+		channelImps = [imp]
 
 	# Saving the hyperstacks
-	image_titles = [WindowManager.getImage(id).getTitle() for id in WindowManager.getIDList()]
-	for i in image_titles:
-		imp = WindowManager.getImage(i)
-		windowName = imp.getTitle()
-		IJ.saveAsTiff(imp, os.path.join(directories[1], windowName)) # Save in raw folder
-
-# make_MAX checks for multi-z plane images and makes MAX projections if it finds them.
-def make_MAX(directories, x, singleplane): # singleplane is Boolean True/False
-	image_titles = [WindowManager.getImage(id).getTitle() for id in WindowManager.getIDList()]
-
-	for i in image_titles:
-		imp = WindowManager.getImage(i)
+	save_raw(channelImps, directories, paths) # Save in raw folder
+
+	return channelImps # returns the channel hyperstacks to process_scan()
+
+# project_stack makes the projections listed in projTypes ("MAX", "MIN", "SUM", "AVG" and/or "STD") of every timepoint of a single channel hyperstack, all in one pass over the z-planes
+# Every plane is read once and added to each projection, and only the projections are kept. For virtual stacks only one z-plane is read into memory at a time
+# The results match "Z Project..." with the same projection and "all": MAX and MIN keep the bit depth, SUM, AVG and STD (standard deviation) are 32-bit. Returns a dictionary of projection type: image
+def project_stack(imp, projTypes):
+	stack = imp.getStack()
+	width, height, slices, frames = imp.getWidth(), imp.getHeight(), imp.getNSlices(), imp.getNFrames()
+	projStacks = dict((projType, ImageStack(width, height)) for projType in projTypes)
+	for t in range(1, frames + 1):
+		proj = {}
+		for z in range(1, slices + 1):
+			plane = stack.getProcessor(imp.getStackIndex(1, z, t))
+			if "MAX" in projTypes:
+				if z == 1:
+					proj["MAX"] = plane.duplicate()
+				else:
+					proj["MAX"].copyBits(plane, 0, 0, Blitter.MAX) # keeps the brighter pixel
+			if "MIN" in projTypes:
+				if z == 1:
+					proj["MIN"] = plane.duplicate()
+				else:
+					proj["MIN"].copyBits(plane, 0, 0, Blitter.MIN) # keeps the dimmer pixel
+			if "SUM" in projTypes or "AVG" in projTypes or "STD" in projTypes:
+				fp = plane.convertToFloat() # 32-bit data comes back as is, so it is only read, never changed
+				if "SUM" in projTypes or "AVG" in projTypes:
+					if z == 1:
+						proj["SUM"] = fp.duplicate()
+					else:
+						proj["SUM"].copyBits(fp, 0, 0, Blitter.ADD)
+				if "STD" in projTypes: # sums of the difference to the first plane, which keeps 32-bit sums of squares accurate
+					if z == 1:
+						proj["first"] = fp.duplicate()
+						proj["shifted"] = FloatProcessor(width, height)
+						proj["squares"] = FloatProcessor(width, height)
+					else:
+						d = fp.duplicate()
+						d.copyBits(proj["first"], 0, 0, Blitter.SUBTRACT)
+						proj["shifted"].copyBits(d, 0, 0, Blitter.ADD)
+						d.sqr()
+						proj["squares"].copyBits(d, 0, 0, Blitter.ADD)
+
+		if "AVG" in projTypes:
+			proj["AVG"] = proj["SUM"].duplicate()
+			proj["AVG"].multiply(1.0 / slices)
+		if "STD" in projTypes:
+			if slices > 1: # variance = (sum of squares - sum * sum / n) / (n - 1)
+				meanSquare = proj["shifted"].duplicate()
+				meanSquare.sqr()
+				meanSquare.multiply(1.0 / slices)
+				proj["STD"] = proj["squares"].duplicate()
+				proj["STD"].copyBits(meanSquare, 0, 0, Blitter.SUBTRACT)
+				proj["STD"].multiply(1.0 / (slices - 1))
+				proj["STD"].min(0.0) # rounding can make tiny negative values
+				proj["STD"].sqrt()
+			else:
+				proj["STD"] = FloatProcessor(width, height)
+		for projType in projTypes:
+			projStacks[projType].addSlice(None, proj[projType].getPixels())
+
+	projImps = {}
+	for projType in projTypes:
+		projImp = ImagePlus(projType + "_" + imp.getTitle(), projStacks[projType])
+		projImp.setDimensions(1, 1, frames)
+		projImp.setCalibration(imp.getCalibration().copy())
+		if frames > 1:
+			projImp.setOpenAsHyperStack(True)
+		projImps[projType] = projImp
+	return projImps
+
+# make_MAX checks for multi-z plane images and makes MAX projections if it finds them. The other projections in the projections setting are made in the same pass
+# MAX projections go in directories[x] (rawMAX or filteredMAX), the others go in their own folder next to it (rawAVG, filteredSTD, ...)
+# Returns the list of images to use for LUTs and merging: the MAX projections, or the hyperstacks themselves for single plane data
+# The hyperstacks stay open, so process_scan() can still filter them. process_scan() closes them once they aren't needed
+def make_MAX(imps, directories, x, singleplane): # singleplane is Boolean True/False
+	maxImps = []
+	projTypes = ["MAX"] + [p for p in projections if p != "MAX"] # MAX is always made, the merges and difference movies use it
+	for imp in imps:
 		if singleplane == False: # If the data is not single z-plane, runs max projection
-			IJ.run(imp, "Z Project...", "projection=[Max Intensity] all")
-			imp = WindowManager.getImage("MAX_" + i)
-			windowName = imp.getTitle()
-			IJ.saveAsTiff(imp, os.path.join(directories[x], windowName)) #saves to appropriate MAX directory (rawMAX or filteredMAX). Passed from run_it()
-			imp = WindowManager.getImage(i) # Gets the original hyperstack
-			imp.changes = False # Answers "no" to the dialog asking if you want to save any changes
-			imp.close() # Closes the hyperstack
+			projImps = project_stack(imp, projTypes)
+			maxImp = projImps["MAX"]
+			save_tiff(maxImp, directories[x]) #saves to appropriate MAX directory (rawMAX or filteredMAX). Passed from process_scan()
+			for projType in projTypes[1:]:
+				projDirectory = os.path.join(os.path.dirname(directories[x]), os.path.basename(directories[x]).replace("MAX", projType)) # e.g. MAX/rawAVG next to MAX/rawMAX
+				if not os.path.exists(projDirectory):
+					os.makedirs(projDirectory)
+				save_tiff(projImps[projType], projDirectory)
+				close_images([projImps[projType]])
+			maxImps.append(maxImp)
 
 		# If the data is single plane, it skipes projection and moves to LUT setting
 		elif singleplane == True:
 			windowName = imp.getTitle()
 			print "Single plane data detected. Skipping Z-projection for ", windowName
+			maxImps.append(imp)
+
+	return maxImps
+
+# set_lut gives an image one of the LUTs from the dialogue box, on the image itself (not with IJ.run) so it works without a display. "Select" leaves it gray
+def set_lut(imp, color):
+	if color == "Select":
+		print "No color picked for", imp.getTitle(), "- leaving it gray"
+		return
+	imp.setLut(LutLoader.getLut(color.lower()))
 
 # apply_LUT applies the LUT specified in the dialogue window and applies it to the appropriate channel
-def applyLut (channels, ch1color, ch2color, ch3color): # channels var is passed from run_it()
-	image_titles = [WindowManager.getImage(id).getTitle() for id in WindowManager.getIDList()]
+def applyLut (imps, channels, ch1color, ch2color, ch3color): # imps and channels are passed from process_scan()
+	wait_for_writes() # the images might still be waiting to be saved (without a LUT, like the MAX projections) on the writer thread
 	print "Setting LUTs... "
-	windowname = image_titles[0] # The first item in the list should be C1
-	imp = WindowManager.getImage(windowname)
-	IJ.run(imp, ch1color, "") # Applies ch1color (from dialogue box) to the image
-	print "CH1 LUT set for ", image_titles[0]
+	imp = imps[0] # The first item in the list should be C1
+	set_lut(imp, ch1color) # Applies ch1color (from dialogue box) to the image
+	print "CH1 LUT set for ", imp.getTitle()
 
 	if channels ==2: # CH1 already set, so just need to worry about CH2
-		windowname2 = image_titles[1]
-		imp2 = WindowManager.getImage(windowname2)
-		IJ.run(imp2, ch2color, "")
-		print "CH2 LUT set for ", image_titles[1]
+		imp2 = imps[1]
+		set_lut(imp2, ch2color)
+		print "CH2 LUT set for ", imp2.getTitle()
 
 	elif channels == 3: # CH1 already set, so just need to worry about CH2 and CH3
-		windowname2 = image_titles[1]
-		imp2 = WindowManager.getImage(windowname2)
-		IJ.run(imp2, ch2color, "")
-		print "CH2 LUT set for ", image_titles[1]
+		imp2 = imps[1]
+		set_lut(imp2, ch2color)
+		print "CH2 LUT set for ", imp2.getTitle()
 
-		windowname3 = image_titles[2]
-		imp3 = WindowManager.getImage(windowname3)
-		IJ.run(imp3, ch3color, "")
-		print "CH3 LUT set for ", image_titles[2]
+		imp3 = imps[2]
+		set_lut(imp3, ch3color)
+		print "CH3 LUT set for ", imp3.getTitle()
 
 	else:
 		print "something went wrong with LUT assignment..."
 
 	print "Done setting LUTs"
 
+# merged_image puts channel images together into a composite hyperstack, C1 in c1, C2 in c2 and C3 in c3 with their LUTs and display ranges (the same as "Merge Channels..." with create and keep)
+# The composite is made of the channels' own planes: the same pixel arrays for images in memory, or a MergedView of virtual stacks, so no channel is copied
+def merged_image(imps, title):
+	sources = [imp.getStack() for imp in imps]
+	if any(source.isVirtual() for source in sources):
+		stack = MergedView(sources)
+	else:
+		stack = ImageStack(imps[0].getWidth(), imps[0].getHeight())
+		for n in range(1, sources[0].getSize() + 1):
+			for source in sources:
+				stack.addSlice(source.getSliceLabel(n), source.getPixels(n))
+	imp = ImagePlus(title, stack)
+	imp.setDimensions(len(imps), imps[0].getNSlices(), imps[0].getNFrames())
+	imp.setCalibration(imps[0].getCalibration().copy())
+	imp.setOpenAsHyperStack(True)
+	luts = []
+	for channelImp in imps:
+		lut = channelImp.getProcessor().getLut()
+		lut.min, lut.max = channelImp.getDisplayRangeMin(), channelImp.getDisplayRangeMax()
+		luts.append(lut)
+	composite = CompositeImage(imp, CompositeImage.COMPOSITE)
+	composite.setLuts(luts)
+	return composite
+
 # merge_channels will merge the channels together after LUT assignment if there are more than 1.
-#If there is only 1 channel, it skips the merge
-def merge_channels(basename, channels, directories, x, suffix):
-	image_titles = [WindowManager.getImage(id).getTitle() for id in WindowManager.getIDList()]
+#If there is only 1 channel, it skips the merge. The channel images are kept open for the difference movies
+def merge_channels(imps, basename, channels, directories, x, suffix):
 	if channels >1:
 		print "Found", channels, "channels...merging them together...."
-		if channels == 2:
-			IJ.run("Merge Channels...", "c1=[" + image_titles[0] + "] c2=[" + image_titles[1] + "] create")
-		if channels == 3:
-			IJ.run("Merge Channels...", "c1=[" + image_titles[0] + "] c2=[" + image_titles[1] + "] c3=[" + image_titles[2] + "] create")
-		imp = IJ.getImage() # gets the resulting image
-		imp.setTitle("Merged_" + basename + suffix)
-		windowName = imp.getTitle()
-		IJ.saveAsTiff(imp, os.path.join(directories[x], windowName)) # saves to output location x. Passed from run_it()
-		IJ.run("Close All")
+		imp = merged_image(imps[:channels], "Merged_" + basename + suffix) # C1 goes in c1, C2 in c2 and C3 in c3
+		save_tiff(imp, directories[x]) # saves to output location x. Passed from process_scan()
+		close_images([imp]) # only lets go of the composite, the channels' pixels stay with the channel images
 	else:
 		print "Only 1 channel, skipping merge..."
-		IJ.run("Close All")
-	print "Closing all files..."
-
-# median_filter runs a median filter with kernel = 1 on the raw hyperstacks
-def median_filter(rawFiles, directories, x): # all arguments are passed from run_it()
-	for f in rawFiles:
-		if fnmatch.fnmatch(f, "C?*"): # pattern matching to only open the C1, C2 and C3 files (skips merge)
-			IJ.open(os.path.join(directories[1], f))
-
-	image_titles = [WindowManager.getImage(id).getTitle() for id in WindowManager.getIDList()]
-	for i in image_titles:
-		imp = WindowManager.getImage(i)
-		IJ.run(imp, "Median...", "radius=1 stack")
-		windowName = WindowManager.getImage(i).getTitle().replace("raw", "filtered") # save as "*_filtered.tif" extension
-		imp.setTitle(windowName)
-		IJ.saveAsTiff(imp, os.path.join(directories[x], windowName)) # saves to filtered directory. Passed the directory from run_it()
-
-
-# For make_difference, it will remove slices to make a difference movie, based on the number you put in the beginning dialogue box.
-# This function looks in either filteredMAX or filtered, depending on if the data is single plane. You can change what data you want to us in run_it by altering x
-def make_difference(directories, x, differenceNumber, singleplane):
-	for file in os.listdir(directories[x]): # looks in the folder and makes a list of the directories
-		if singleplane == False: # if data is multi-z plane, looks for the MAX projections
-			if fnmatch.fnmatch(file, "MAX*"):
-				IJ.open(os.path.join(directories[x], file))
-		elif singleplane == True: # if singleplane data, looks for C1, C2 and C3 hyperstacks (there are no MAX projections)
-			if fnmatch.fnmatch(file, "C?*"):
-				IJ.open(os.path.join(directories[x], file))
-
-	image_titles = [WindowManager.getImage(id).getTitle() for id in WindowManager.getIDList()]
-
-	for i in image_titles:
-		imp = WindowManager.getImage(i)
-		windowName = imp.getTitle()
-		if imp.getNFrames() == 1: # if it is a single timepoint, will raise exception and quit
-			imp.close()
-			raise Exception("Single timepoint data. Cannot create difference movies.")
-			return
-		else:
-			imp.setT(1) # sets the cursor at the first frame
-			dup = imp.duplicate()
-			dup.show() # shows the duplicate
-			dup.setTitle(windowName + "_dup") # renames the duplicate
 
+# Task lets a Java thread pool call any function with the given arguments
+class Task(Callable):
+	def __init__(self, function, *args):
+		self.function = function
+		self.args = args
 
-		differenceNumberString = str(differenceNumber) # turns the integer input into a string
+	def call(self):
+		return self.function(*self.args)
 
-		# the range is differenceNumber+1 because range goes up to but does not include the last value. So a range of (1,3) Would only check n = 1, 2
-		for n in range(1, differenceNumber+1):
-			if n >= 1:
-				IJ.run(imp, "Delete Slice", "")
+# DaemonThreads makes pool threads that don't keep Fiji running after the script is done
+class DaemonThreads(ThreadFactory):
+	def newThread(self, runnable):
+		thread = Thread(runnable)
+		thread.setDaemon(True)
+		return thread
 
-		dup = WindowManager.getImage(windowName + "_dup")
-		IJ.run(dup,"Reverse", "") # reverse the array so that the slices in the back become the front
+filterPool = [] # the thread pool for median filtering, made the first time it's needed and shared by all scans
+filterPoolLock = threading.Lock()
 
-		for n in range(1, differenceNumber+1):
-			if n >= 1:
-				IJ.run(dup, "Delete Slice", "")
+# filter_pool returns the median filter thread pool (filterThreads threads, or one per core)
+def filter_pool():
+	filterPoolLock.acquire()
+	try:
+		if len(filterPool) == 0:
+			threads = filterThreads
+			if threads < 1:
+				threads = Runtime.getRuntime().availableProcessors()
+			filterPool.append(Executors.newFixedThreadPool(threads, DaemonThreads()))
+		return filterPool[0]
+	finally:
+		filterPoolLock.release()
+
+# same_pixels makes a second processor for the pixel array of ip. Each thread works with its own processor, so they don't share a selection
+def same_pixels(ip):
+	if ip.getBitDepth() == 8:
+		return ByteProcessor(ip.getWidth(), ip.getHeight(), ip.getPixels(), None)
+	elif ip.getBitDepth() == 16:
+		return ShortProcessor(ip.getWidth(), ip.getHeight(), ip.getPixels(), None)
+	return FloatProcessor(ip.getWidth(), ip.getHeight(), ip.getPixels(), None)
+
+# The 19 compare-and-swap steps of a sorting network that puts the median of 9 values in position 4 (Paeth's median of 9)
+median9Network = [(1, 2), (4, 5), (7, 8), (0, 1), (3, 4), (6, 7), (1, 2), (4, 5), (7, 8), (0, 3), (5, 8), (4, 7), (3, 6), (1, 4), (2, 5), (4, 7), (4, 2), (6, 4), (4, 2)]
+
+# median3x3_rows writes the 3x3 median of rows y0 to y1 of ip into the same rows of out (the same as "Median..." with radius=1, including the edges)
+# The 9 neighbours of every pixel are 9 shifted copies of the rows, and the sorting network runs on whole images with MIN and MAX, so every step is a single fast operation
+def median3x3_rows(ip, out, y0, y1):
+	src = same_pixels(ip)
+	width, height, rows = ip.getWidth(), ip.getHeight(), y1 - y0
+
+	# The rows plus one pixel of padding all the way around. Pixels outside the image are copies of the nearest edge pixel
+	padded = src.createProcessor(width + 2, rows + 2)
+	src.setRoi(0, y0, width, rows)
+	padded.insert(src.crop(), 1, 1)
+	src.setRoi(0, max(y0 - 1, 0), width, 1)
+	padded.insert(src.crop(), 1, 0)
+	src.setRoi(0, min(y1, height - 1), width, 1)
+	padded.insert(src.crop(), 1, rows + 1)
+	padded.setRoi(1, 0, 1, rows + 2)
+	padded.insert(padded.crop(), 0, 0)
+	padded.setRoi(width, 0, 1, rows + 2)
+	padded.insert(padded.crop(), width + 1, 0)
+
+	p = []
+	for dy in (0, 1, 2):
+		for dx in (0, 1, 2):
+			padded.setRoi(dx, dy, width, rows)
+			p.append(padded.crop())
+
+	for (a, b) in median9Network: # after each step, p[a] is the smaller and p[b] the larger value of every pixel
+		smaller = p[a].duplicate()
+		smaller.copyBits(p[b], 0, 0, Blitter.MIN)
+		p[b].copyBits(p[a], 0, 0, Blitter.MAX)
+		p[a] = smaller
+
+	same_pixels(out).insert(p[4], 0, y0)
+
+# median_plane median filters a single plane and returns the result as a new processor
+# Radius 1 uses the sorting network, split into horizontal strips that run at the same time if a pool is passed. Other radii use ImageJ's RankFilters
+def median_plane(ip, radius, pool):
+	if radius != 1:
+		out = ip.duplicate()
+		RankFilters().rank(out, radius, RankFilters.MEDIAN)
+		return out
+
+	out = ip.createProcessor(ip.getWidth(), ip.getHeight())
+	if pool is None:
+		median3x3_rows(ip, out, 0, ip.getHeight())
+	else:
+		strips = min(Runtime.getRuntime().availableProcessors(), max(1, ip.getHeight() / 64)) # strips of at least 64 rows
+		bounds = [ip.getHeight() * i / strips for i in range(strips + 1)]
+		futures = [pool.submit(Task(median3x3_rows, ip, out, bounds[i], bounds[i + 1])) for i in range(strips)]
+		for future in futures:
+			future.get()
+	return out
+
+# MedianFilteredStack is a virtual stack that median filters the planes of another stack when they are asked for
+# make_MAX() reads one plane at a time from it, so filteredMAX can be made without keeping (or saving) the whole filtered hyperstack
+class MedianFilteredStack(VirtualStack):
+	def __init__(self, source, radius):
+		VirtualStack.__init__(self, source.getWidth(), source.getHeight(), None, None)
+		self.setBitDepth(source.getBitDepth())
+		self.source = source
+		self.radius = radius
+
+	def getSize(self):
+		return self.source.getSize()
+
+	def getSliceLabel(self, n):
+		return self.source.getSliceLabel(n)
+
+	def getPixels(self, n):
+		return self.getProcessor(n).getPixels()
+
+	def getProcessor(self, n):
+		return median_plane(self.source.getProcessor(n), self.radius, filter_pool()) # the strips of each plane are filtered at the same time
+
+# filtered_image makes an image with the dimensions and calibration of rawImp for a filtered stack, named "*_filtered.tif"
+def filtered_image(rawImp, stack):
+	imp = ImagePlus(rawImp.getTitle().replace("raw", "filtered"), stack)
+	imp.setDimensions(rawImp.getNChannels(), rawImp.getNSlices(), rawImp.getNFrames())
+	imp.setCalibration(rawImp.getCalibration().copy())
+	imp.setOpenAsHyperStack(True)
+	return imp
+
+# median_filter runs a median filter with radius medianRadius on the raw hyperstacks (the ones still in memory from split_channels). Returns the filtered hyperstacks
+# With save = True the filtered hyperstacks are made (all planes of all channels are filtered at the same time, on filterThreads threads) and saved
+# With save = False nothing is filtered yet: it returns virtual stacks that filter each plane when make_MAX() reads it, so only filteredMAX is saved
+def median_filter(rawImps, directories, x, save): # all arguments are passed from process_scan()
+	if not save:
+		return [filtered_image(rawImp, MedianFilteredStack(rawImp.getStack(), medianRadius)) for rawImp in rawImps]
+
+	pool = filter_pool()
+	futures = []
+	for rawImp in rawImps: # every plane of every channel is its own task, so the channels are filtered at the same time too
+		stack = rawImp.getStack()
+		futures.append([pool.submit(Task(median_plane, stack.getProcessor(n), medianRadius, None)) for n in range(1, stack.getSize() + 1)])
+
+	imps = []
+	for rawImp, planeFutures in zip(rawImps, futures):
+		stack = ImageStack(rawImp.getWidth(), rawImp.getHeight())
+		for n, future in enumerate(planeFutures):
+			stack.addSlice(rawImp.getStack().getSliceLabel(n + 1), future.get().getPixels())
+		imp = filtered_image(rawImp, stack)
+		save_tiff(imp, directories[x]) # saves to filtered directory. Passed the directory from process_scan()
+		imps.append(imp)
+
+	return imps
+
+
+# difference_stacks makes difference movies straight from the pixel arrays: each output frame is frame[t+offset] - frame[t] (the same as deleting slices and running "Subtract create stack")
+# It goes through the frames once and makes a movie for every offset in offsets, without duplicating or reversing the stack. Returns a dictionary of offset: difference movie
+# With signed = True the movies are 32-bit, so negative changes are kept instead of being clipped to 0
+def difference_stacks(imp, offsets, signed):
+	stack = imp.getStack()
+	width, height = imp.getWidth(), imp.getHeight()
+	channels, slices, frames = imp.getNChannels(), imp.getNSlices(), imp.getNFrames()
+	offsets = [k for k in offsets if k < frames]
+	diffStacks = dict((k, ImageStack(width, height)) for k in offsets)
+	recent = {} # the frames that are still needed by one of the offsets, so each frame is only read once (this matters for virtual stacks)
+
+	for t in range(1, frames + 1): # frame t is the later frame for every offset
+		for z in range(1, slices + 1):
+			for c in range(1, channels + 1):
+				later = stack.getProcessor(imp.getStackIndex(c, z, t))
+				if signed:
+					later = later.convertToFloat() # 32-bit data is used as is, it is only read
+				recent[(c, z, t)] = later
+				for k in offsets:
+					if t - k < 1: # no earlier frame for this offset yet
+						continue
+					earlier = recent[(c, z, t - k)]
+					ip = later.duplicate()
+					ip.copyBits(earlier, 0, 0, Blitter.SUBTRACT) # later - earlier. 8 and 16-bit results are clipped at 0, just like ImageCalculator
+					diffStacks[k].addSlice(stack.getSliceLabel(imp.getStackIndex(c, z, t)), ip.getPixels()) # only the pixels, so the movie doesn't pick up the channel LUT
+				if len(offsets) > 0:
+					recent.pop((c, z, t - max(offsets)), None) # this frame won't be used by any offset again
+
+	diffImps = {}
+	for k in offsets:
+		impDiff = ImagePlus("Diff" + str(k) + "-" + imp.getTitle(), diffStacks[k])
+		impDiff.setDimensions(channels, slices, frames - k)
+		impDiff.setCalibration(imp.getCalibration().copy())
+		if frames - k > 1:
+			impDiff.setOpenAsHyperStack(True)
+		diffImps[k] = impDiff
+	return diffImps
+
+# For make_difference, it will subtract frames to make a difference movie, based on the number you put in the beginning dialogue box (plus any extra differenceOffsets).
+# It is passed either the MAX projections or the hyperstacks (if the data is single plane) that are still in memory. You can change what data you want to use in process_scan
+def make_difference(imps, directories, differenceNumber):
+	offsets = sorted(set([k for k in [differenceNumber] + list(differenceOffsets) if k > 0])) # every offset gets its own Diff movie
+	for imp in imps:
+		if imp.getNFrames() == 1: # if it is a single timepoint, will raise exception and quit
+			raise Exception("Single timepoint data. Cannot create difference movies.")
+			return
 
-		IJ.run(dup, "Reverse", "") # reverse the array back to native orientation
-		calc = ImageCalculator()
-		impDiff = calc.calculate("Subtract create stack", imp, dup) # subtract the imp - dup
-		impDiff = WindowManager.getImage("Result of "+ windowName) # selects the result
-		windowName = impDiff.getTitle().replace("Result of ", "Diff" + differenceNumberString + "-")
-		impDiff.setTitle(windowName) # renames it to include the differenceNumber
+		for k in offsets:
+			if k >= imp.getNFrames():
+				print "Only", imp.getNFrames(), "frames in", imp.getTitle(), "- skipping Diff" + str(k)
 
-		IJ.saveAsTiff(impDiff, os.path.join(directories[2], windowName)) # saves in diff folder
-		impDiff.changes = False # Answers "no" to the dialog asking if you want to save any changes
-		imp.changes = False # Answers "no" to the dialog asking if you want to save any changes
-		dup.changes = False # Answers "no" to the dialog asking if you want to save any changes
-		impDiff.close()
-		imp.close()
-		dup.close()
+		diffImps = difference_stacks(imp, offsets, differenceOutput == "signed")
+		for k in sorted(diffImps):
+			impDiff = diffImps[k]
+			save_tiff(impDiff, directories[2]) # saves in diff folder. The title includes the offset, e.g. Diff4-MAX_C1-...
+			close_images([impDiff])
 
 # A script to move files around and delete things you don't want
 def clean_up(directories, singleplane):
@@ -336,8 +2013,8 @@ def clean_up(directories, singleplane):
 		else:
 			print "Directory ", d, "is not empty"
 
-	# Additionally, if the data is z-stacks, delete the "filtered" directory (because filtered data will be in filteredMAX)
-	if singleplane == False and os.path.exists(directories[5]):
+	# Additionally, if the data is z-stacks, delete the "filtered" directory (because filtered data will be in filteredMAX), unless the filtered hyperstacks were saved there on purpose (saveFilteredStacks)
+	if singleplane == False and not saveFilteredStacks and os.path.exists(directories[5]):
 		print "Deleting " + directories[5]
 		shutil.rmtree(directories[5])
 
@@ -354,103 +2031,960 @@ def clean_up(directories, singleplane):
 	# if os.path.exists(directories[4]): # this checks for rawMAX
 	# 	shutil.rmtree(directories[4]) # this removes rawMAX
 
-# run_it is the main function that calls all the other functions
+# read_chunk reads timepoints t0 to t1 of a hyperstack into memory, split into channels. The images have the same titles as the channels split_channels() makes, so every output gets its usual name
+def read_chunk(imp, t0, t1):
+	stack = imp.getStack()
+	channels, slices = imp.getNChannels(), imp.getNSlices()
+	stacks = [ImageStack(imp.getWidth(), imp.getHeight()) for c in range(channels)]
+	for t in range(t0, t1 + 1):
+		for z in range(1, slices + 1):
+			for c in range(1, channels + 1): # in the order the planes are stored, channels first
+				n = imp.getStackIndex(c, z, t)
+				stacks[c - 1].addSlice(stack.getSliceLabel(n), stack.getProcessor(n).getPixels())
+	chunkImps = []
+	for c in range(channels):
+		chunkImp = ImagePlus("C" + str(c + 1) + "-" + imp.getTitle(), stacks[c])
+		chunkImp.setDimensions(1, slices, t1 - t0 + 1)
+		chunkImp.setCalibration(imp.getCalibration().copy())
+		chunkImp.setOpenAsHyperStack(True)
+		chunkImps.append(chunkImp)
+	return chunkImps
+
+# frame_planes returns the pixel arrays of every frame of a single channel, single z-plane image (a MAX projection, or single plane data), as a list per frame
+def frame_planes(imp):
+	stack = imp.getStack()
+	return [stack.getPixels(n) for n in range(1, stack.getSize() + 1)]
+
+# chunk_difference makes the difference movies of one block of a MAX projection (or single plane hyperstack) and adds them to the Diff movies
+# carry holds the last frames of the blocks before this one, so every frame is subtracted from the frame that many timepoints earlier, even if that was in an earlier block. The result is the same as make_difference() on the whole movie
+def chunk_difference(maxImp, carry, offsets, directories):
+	stack = ImageStack(maxImp.getWidth(), maxImp.getHeight())
+	for pixels in carry + frame_planes(maxImp):
+		stack.addSlice(None, pixels)
+	combined = ImagePlus(maxImp.getTitle(), stack)
+	combined.setDimensions(1, 1, stack.getSize())
+	combined.setCalibration(maxImp.getCalibration().copy())
+
+	diffImps = difference_stacks(combined, offsets, differenceOutput == "signed")
+	for k in sorted(diffImps):
+		skip = max(len(carry) - k, 0) # these frames were already made from the block before
+		impDiff = diffImps[k]
+		if impDiff.getStackSize() > skip:
+			diffStack = ImageStack(impDiff.getWidth(), impDiff.getHeight())
+			for n in range(skip + 1, impDiff.getStackSize() + 1):
+				diffStack.addSlice(None, impDiff.getStack().getPixels(n))
+			blockDiff = ImagePlus(impDiff.getTitle(), diffStack)
+			blockDiff.setDimensions(1, 1, diffStack.getSize())
+			blockDiff.setCalibration(impDiff.getCalibration().copy())
+			save_tiff(blockDiff, directories[2]) # added to the Diff movie in the diff folder
+	return (carry + frame_planes(maxImp))[-max(offsets):]
+
+# process_chunked runs the stages in todo on blocks of chunkSize timepoints of a (virtual) hyperstack, instead of on the whole scan at once (see processingMode at the top)
+# Each block goes through the same functions as process_scan() uses (split, projections, LUTs and merges, filtering and difference movies), and save_tiff() adds it to the end of the output files
+# Only one block (plus the one being written) is in memory at a time, so the memory needed depends on chunkSize, not on the length of the acquisition. Returns singleplane
+def process_chunked(imp, basename, directories, manifest, todo, chunkSize):
+	channels, slices, frames = imp.getNChannels(), imp.getNSlices(), imp.getNFrames()
+	singleplane = slices == 1
+	manifest["channels"] = channels
+	manifest["singleplane"] = singleplane
+	offsets = sorted(set([k for k in [differenceNumber] + list(differenceOffsets) if k > 0]))
+	makeDiff = "diff" in todo and len(offsets) > 0
+	if makeDiff and frames == 1:
+		raise Exception("Single timepoint data. Cannot create difference movies.")
+	for k in offsets:
+		if makeDiff and k >= frames:
+			print "Only", frames, "frames in", basename, "- skipping Diff" + str(k)
+
+	stages = [stage for stage in stageOrder if stage in todo]
+	stageOutputs = {}
+	for stage in stages:
+		start_stage(manifest, directories, stage)
+		stageOutputs[stage] = []
+	scanState.appending = {}
+	carry = [[] for c in range(channels)]
+	paths = channel_plane_paths(imp)
+	linkRaw = "split" in todo and rawOutput == "links" and paths is not None
+	if linkRaw: # the links cover the whole scan, so they are written once instead of block by block
+		scanState.outputs = stageOutputs["split"]
+		save_raw([channel_image(imp, c) for c in range(1, channels + 1)], directories, paths)
+
+	for t0 in range(1, frames + 1, chunkSize):
+		t1 = min(t0 + chunkSize - 1, frames)
+		print "Processing timepoints", t0, "to", t1, "of", frames
+		chunkImps = read_chunk(imp, t0, t1)
+		wait_for_writes() # the block before this one was written while this one was read
+
+		if "split" in todo and not linkRaw:
+			scanState.outputs = stageOutputs["split"]
+			for chunkImp in chunkImps:
+				save_tiff(chunkImp, directories[1]) # added to the raw channel hyperstacks
+		if "MAX" in todo:
+			scanState.outputs = stageOutputs["MAX"]
+			maxImps = make_MAX(chunkImps, directories, 4, singleplane)
+		elif singleplane:
+			maxImps = chunkImps
+		else:
+			maxImps = [project_stack(chunkImp, ["MAX"])["MAX"] for chunkImp in chunkImps] # the MAX projections are needed for the merges and difference movies, but are already saved
+		if "merge" in todo:
+			scanState.outputs = stageOutputs["merge"]
+			applyLut(maxImps, channels, ch1color, ch2color, ch3color)
+			if singleplane == False:
+				merge_channels(maxImps, basename, channels, directories, 4, "_raw")
+			elif singleplane == True:
+				merge_channels(maxImps, basename, channels, directories, 1, "_raw")
+		if "filtered" in todo and makeFiltered:
+			scanState.outputs = stageOutputs["filtered"]
+			filteredImps = median_filter(chunkImps, directories, 5, singleplane or saveFilteredStacks)
+			filteredMaxImps = make_MAX(filteredImps, directories, 3, singleplane)
+			applyLut(filteredMaxImps, channels, ch1color, ch2color, ch3color)
+			if singleplane == False:
+				merge_channels(filteredMaxImps, basename, channels, directories, 3, "_filtered")
+			elif singleplane == True:
+				merge_channels(filteredMaxImps, basename, channels, directories, 5, "_filtered")
+			close_images(filteredImps + filteredMaxImps)
+		if makeDiff:
+			scanState.outputs = stageOutputs["diff"]
+			for c in range(channels):
+				carry[c] = chunk_difference(maxImps[c], carry[c], offsets, directories)
+		close_images(chunkImps + maxImps)
+
+	for path in sorted(scanState.appending):
+		in_writer(scanState.appending[path].close)
+	wait_for_writes()
+	scanState.appending = None
+	for stage in reversed(stages): # the stages ran together, so they finish together (the last one started is finished first)
+		scanState.outputs = stageOutputs[stage]
+		finish_stage(manifest, directories, stage)
+	return singleplane
+
+# close_images frees the memory of images that are no longer needed. Images that are in the list more than once (like single plane hyperstacks, which are also the "MAX" images) are only closed once
+# With asyncWrites, the images are closed on the writer thread, after the saves that were waiting there
+def close_images(imps):
+	closed = []
+	for imp in imps:
+		if not any(imp is c for c in closed):
+			closed.append(imp)
+	in_writer(flush_images, closed)
+
+def flush_images(imps):
+	for imp in imps:
+		imp.flush()
+
+# process_scan calls all the processing functions for a single scan, and returns the text that goes in the errorFile for that scan
+# Every scan gets its own images (nothing is looked up by window title), so several scans can run at the same time. See parallelWorkers at the top.
 # This is the place to comment out certain function calls if you don't have a need for them
+# prefetched is the background import of this scan (see prefetch_scan()), and imported is set once the scan is imported (or doesn't need to be), so the next scan can be prefetched
+def process_scan(scan, microscopeType, prefetched = None, imported = None):
+	if imported is None:
+		imported = threading.Event()
+	log = StringIO() # Collects the errorFile lines for this scan. run_it() writes them once the scan is done, so scans don't get mixed up in the file
+	basename = os.path.basename(scan) # get the scan name (basename)
+	scanState.scan = basename
+	scanState.dims = None
+	scanState.events = []
+	scanState.outputs = []
+	scanState.scanBytes = 0 # what the finished stages saved, for the scan's event
+	scanState.writes = []
+	scanState.writer = None
+	scanState.appending = None
+	scanState.status = "done" # how the scan went, for the shared queue's progress record: "done", "upToDate" or "failed"
+	reserved = 0 # MB of the memory budget this scan has taken
+	begin_event("scan")
+	try:
+		# Check the manifest to see what still needs to be made for this scan
+		inputs = input_files(scan, microscopeType)
+		manifest = None
+		if resumeScans:
+			manifest = read_manifest(scan)
+		fresh = manifest is None or manifest["inputs"] != inputs # new or changed raw data is processed from scratch
+		if fresh:
+			manifest = {"inputs": inputs, "stages": {}}
+		scanState.dims = manifest.get("probe") # the dimensions from the last time the scan was probed, if it was
+
+		directories = make_directories(scan, fresh) # make the directories
+		todo = stages_to_run(manifest, directories)
+		if "split" not in todo:
+			imported.set()
+		if len(todo) == 0:
+			print basename, "is already up to date, skipping..."
+			scanState.status = "upToDate"
+			log.write("\n \n -- " + basename + " is already up to date, skipping --" + "\n")
+			end_event()
+			return log.getvalue()
+		log.write("\n \n -- Processing " + basename + " --" + "\n")
+		if asyncWrites:
+			scanState.writer = Executors.newSingleThreadExecutor(DaemonThreads())
+		if not fresh:
+			log.write("Picking up from the " + todo[0] + " stage\n")
+
+		# Probe the scan (if it will be imported) and plan how it is processed, before any pixels are read
+		background = None
+		if "split" in todo:
+			if prefetched is not None:
+				begin_event("prefetch wait")
+				background = prefetched.get() # waits for the background import to finish, if it hasn't yet
+				end_event()
+			if background is not None:
+				print basename, "was imported in the background"
+				manifest["probe"] = background[0]
+			else:
+				begin_event("probe")
+				manifest["probe"] = probe_scan(scan, microscopeType) # reads the metadata only, so bad scans are caught before any pixels are imported
+				end_event()
+			scanState.dims = manifest["probe"]
+		probe = manifest.get("probe")
+		plan = plan_scan(probe)
+		if background is not None:
+			plan["mode"] = "memory" # it is already in memory
+		if plan["mode"] == "chunked" and probe is None: # chunked was asked for, but the scan wasn't probed (it was started before probing was added)
+			probe = manifest["probe"] = probe_scan(scan, microscopeType)
+			scanState.dims = probe
+			plan = plan_scan(probe)
+		virtual = plan["mode"] != "memory"
+		print basename, "will be processed as", plan["mode"], "(about %.0f MB of %.0f MB)" % (plan["footprint"] / 1048576.0, plan["budget"] / 1048576.0)
+		log.write("Processed as " + plan["mode"] + "\n")
+		begin_event("memory wait")
+		reserved = reserve_memory(plan["footprint"]) # waits for scans running at the same time to finish, if there isn't enough memory left for this one
+		end_event()
+
+		if plan["mode"] == "chunked": # the stages run on a block of timepoints at a time, straight from the raw data
+			print "Processing", basename, "in blocks of", chunk_frames(probe), "timepoints"
+			begin_event("import")
+			imp = make_hyperstack(basename, scan, microscopeType, True, probe) # a virtual stack, the blocks are read by process_chunked()
+			end_event()
+			imported.set()
+			singleplane = process_chunked(imp, basename, directories, manifest, todo, chunk_frames(probe))
+		else:
+			if "split" in todo:
+				start_stage(manifest, directories, "split")
+				if background is not None:
+					imp = background[1]
+				else:
+					begin_event("import")
+					imp = make_hyperstack(basename, scan, microscopeType, virtual, probe) # open the hyperstack
+					if virtual:
+						end_event() # the pixels of a virtual stack are read later, by the stages that use them
+					else:
+						end_event(bytesRead = probe["bytes"])
+				imported.set()
+				channels = imp.getNChannels() #gets the number of channels
+				print "The number of channels is", channels
+				singleplane = single_plane_check(imp)
+				print "The returned value of singleplane is ", singleplane
+				manifest["channels"] = channels
+				manifest["singleplane"] = singleplane
+				channelImps = split_channels(imp, directories, channels) # split the hyperstack into channels (skips if channels == 1)
+				imp = background = prefetched = None # the channels share the hyperstack's pixels, so once these are let go, closing the channels frees the raw data
+				finish_stage(manifest, directories, "split")
+			else:
+				channels = manifest["channels"] # these were saved the first time the scan was imported
+				singleplane = manifest["singleplane"]
+				channelImps = []
+				if "MAX" in todo or "filtered" in todo or (singleplane and ("merge" in todo or "diff" in todo)):
+					channelImps = open_outputs(manifest, directories, "split", "C", virtual) # reopens the raw channel hyperstacks instead of importing again
+
+			if "MAX" in todo:
+				start_stage(manifest, directories, "MAX")
+				maxImps = make_MAX(channelImps, directories, 4, singleplane) # make max projection (skips if singleplane == True)
+				finish_stage(manifest, directories, "MAX")
+			elif singleplane:
+				maxImps = channelImps
+			elif "merge" in todo or "diff" in todo:
+				maxImps = open_outputs(manifest, directories, "MAX", "MAX_", False) # reopens the rawMAX projections
+			else:
+				maxImps = []
+			if singleplane == False and "filtered" not in todo:
+				close_images(channelImps) # the MAX projections are all that's needed from here on
+
+			# calls merge_channels for raw data (skips if singleplane == True)
+			if "merge" in todo:
+				start_stage(manifest, directories, "merge")
+				applyLut(maxImps, channels, ch1color, ch2color, ch3color) # apply the user specified LUT(s)
+				print "Making raw merge..."
+				if singleplane == False:
+					merge_channels(maxImps, basename, channels, directories, 4, "_raw") # makes rawMAX merge (4 = rawMax)
+				elif singleplane == True:
+					merge_channels(maxImps, basename, channels, directories, 1, "_raw") # for single z-plane (1 = raw)
+				finish_stage(manifest, directories, "merge")
+
+			## makes filtered images. Turn on with makeFiltered at the top.
+			if "filtered" in todo:
+				start_stage(manifest, directories, "filtered")
+				if makeFiltered:
+					print "Making filtered movies..."
+					filteredImps = median_filter(channelImps, directories, 5, singleplane or saveFilteredStacks) # saves output in filtered. For z-stacks, filtered hyperstacks are only saved if saveFilteredStacks is True
+					print "making filtered max" # max projection of filtered data
+					filteredMaxImps = make_MAX(filteredImps, directories, 3, singleplane) # makes filteredMAX (3 = filteredMAX)
+					applyLut(filteredMaxImps, channels, ch1color, ch2color, ch3color) # apply the user specified LUT(s)
+					print "Making filtered merge..."
+
+					# calls merge_channels for filtered data (skips if singleplane == True)
+					if singleplane == False:
+						merge_channels(filteredMaxImps, basename, channels, directories, 3, "_filtered") # makes filteredMAX merge
+					elif singleplane == True:
+						merge_channels(filteredMaxImps, basename, channels, directories, 5, "_filtered") # for single z-plane (5 = filtered)
+					close_images(filteredImps + filteredMaxImps)
+				if singleplane == False:
+					close_images(channelImps)
+				finish_stage(manifest, directories, "filtered")
+
+			# Make difference movies. Uses either the raw MAX projections or raw hyperstacks (if singleplane == True). These are still in memory, so nothing is read back from disk
+			if "diff" in todo:
+				start_stage(manifest, directories, "diff")
+				if differenceNumber >0 or len(differenceOffsets) > 0:
+					print "Making difference movies..."
+					make_difference(maxImps, directories, differenceNumber) # maxImps are the rawMAX projections, or the raw hyperstacks if singleplane == True. Pass filteredMaxImps (and close them later) if you want filtered
+				finish_stage(manifest, directories, "diff")
+			close_images(maxImps)
+		wait_for_writes()
+
+		clean_up(directories, singleplane)	# clean up directory structure
+
+		# clean_up() deletes some outputs on purpose (like the filtered hyperstacks of z-stack data), so the manifest only lists what is left
+		for record in manifest["stages"].values():
+			record["outputs"] = [f for f in record["outputs"] if os.path.exists(os.path.join(directories[0], f))]
+		if os.path.exists(directories[0]):
+			write_manifest(directories, manifest)
+
+		log.write("Congrats, it was successful!\n")
+		end_event()
+
+	except:  #if there is an exception to the above code, add the traceback to the errorFile text
+		print "Error with ", basename, "continuing on..."
+		scanState.status = "failed"
+
+		log.write("\n" + datetime.datetime.now().strftime("%Y-%m-%d %H:%M") + "\n") #writes the date and time
+		#log.write("Error detected...\n")
+		log.write("Error with " + basename + "\n" + "\n")
+		traceback.print_exc(file = log) # writes the error traceback to the file
+		end_all_events(traceback.format_exc()) # the stage that failed (and the scan) are logged with the error
+		imported.set()
+
+	release_memory(reserved)
+	if scanState.writer is not None:
+		scanState.writer.shutdown() # the writes that are still waiting (from a scan that failed) are finished, but nothing new is taken
+		scanState.writer = None
+		#clean_up(directories, singleplane)	# clean up directory structure
+		# The images from this scan are only referenced here, so they are released along with it
+
+	IJ.freeMemory() # runs garbage collector
+	return log.getvalue() # returns the errorFile text to run_it()
+
+# recolor_only checks whether the channel colors are the only thing that changed about a finished stage, so its merge can be made again without redoing the rest of it (the median filter, for the filtered stage)
+def recolor_only(manifest, directories, stage):
+	record = manifest["stages"].get(stage)
+	if record is None or not record["done"] or not all(os.path.exists(os.path.join(directories[0], f)) for f in record["outputs"]):
+		return False
+	old = dict(record["parameters"])
+	new = stage_parameters(stage)
+	old.pop("colors", None)
+	new.pop("colors", None)
+	return old == new
+
+# render_scan re-renders a scan from the outputs it already has (see renderOnly at the top). The LUTs and merges are made again from the rawMAX projections (and filteredMAX) if the channel colors changed, and the difference movies if their settings changed
+# Nothing is imported and the raw data isn't looked at. A scan that needs more than that (it was never processed, or its projections or filter settings changed) is left for a normal run. Returns the errorFile text
+def render_scan(scan, microscopeType):
+	log = StringIO()
+	basename = os.path.basename(scan)
+	scanState.scan = basename
+	scanState.dims = None
+	scanState.events = []
+	scanState.outputs = []
+	scanState.scanBytes = 0
+	scanState.writes = []
+	scanState.writer = None
+	scanState.appending = None
+	scanState.status = "done"
+	reserved = 0
+	begin_event("scan")
+	try:
+		manifest = read_manifest(scan)
+		if manifest is None:
+			print basename, "hasn't been processed yet, skipping..."
+			log.write("\n \n -- " + basename + " hasn't been processed yet, it needs a normal run --" + "\n")
+			end_event()
+			return log.getvalue()
+		scanState.dims = manifest.get("probe")
+		directories = make_directories(scan, False)
+		todo = stages_to_run(manifest, directories)
+		blocking = [stage for stage in todo if stage in ("split", "MAX") or (stage == "filtered" and not recolor_only(manifest, directories, stage))]
+		if len(blocking) > 0:
+			print basename, "can't be re-rendered, its", blocking[0], "stage has to be made again first"
+			log.write("\n \n -- " + basename + " needs a normal run (the " + blocking[0] + " stage has to be made again) --" + "\n")
+			end_event()
+			return log.getvalue()
+		if len(todo) == 0:
+			print basename, "is already up to date, skipping..."
+			scanState.status = "upToDate"
+			log.write("\n \n -- " + basename + " is already up to date, skipping --" + "\n")
+			end_event()
+			return log.getvalue()
+		log.write("\n \n -- Re-rendering " + basename + " (" + ", ".join(todo) + ") --" + "\n")
+		if asyncWrites:
+			scanState.writer = Executors.newSingleThreadExecutor(DaemonThreads())
+
+		channels = manifest["channels"]
+		singleplane = manifest["singleplane"]
+		plan = plan_scan(manifest.get("probe"))
+		virtual = singleplane and plan["mode"] != "memory" # single plane scans use their raw hyperstacks, which might not fit in memory
+		begin_event("memory wait")
+		reserved = reserve_memory(plan["footprint"])
+		end_event()
+
+		maxImps = []
+		if "merge" in todo or "diff" in todo:
+			if singleplane:
+				maxImps = open_outputs(manifest, directories, "split", "C", virtual) # the raw hyperstacks, like process_scan() uses
+			else:
+				maxImps = open_outputs(manifest, directories, "MAX", "MAX_", False) # the rawMAX projections
+
+		if "merge" in todo:
+			start_stage(manifest, directories, "merge")
+			applyLut(maxImps, channels, ch1color, ch2color, ch3color)
+			print "Making raw merge..."
+			merge_channels(maxImps, basename, channels, directories, 1 if singleplane else 4, "_raw")
+			finish_stage(manifest, directories, "merge")
+
+		# Only the filtered merge is made again: the filtered movies (or filteredMAX) it is made from are kept, and so is the rest of the stage's record
+		if "filtered" in todo:
+			record = manifest["stages"]["filtered"]
+			merges = [f for f in record["outputs"] if os.path.basename(f).startswith("Merged_")]
+			for f in merges:
+				mergePath = os.path.join(directories[0], f)
+				if os.path.isdir(mergePath): # an OME-Zarr folder
+					shutil.rmtree(mergePath)
+				else:
+					os.remove(mergePath)
+			begin_event("filtered")
+			scanState.outputs = []
+			filteredImps = open_outputs(manifest, directories, "filtered", "C" if singleplane else "MAX_", virtual)
+			if len(filteredImps) > 0:
+				applyLut(filteredImps, channels, ch1color, ch2color, ch3color)
+				print "Making filtered merge..."
+				merge_channels(filteredImps, basename, channels, directories, 5 if singleplane else 3, "_filtered")
+				close_images(filteredImps)
+			record["outputs"] = [f for f in record["outputs"] if f not in merges] + [os.path.relpath(path, directories[0]) for path in scanState.outputs]
+			record["parameters"] = stage_parameters("filtered")
+			record["finished"] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+			wait_for_writes()
+			write_manifest(directories, manifest)
+			scanState.scanBytes += end_event()
+			scanState.outputs = []
+
+		if "diff" in todo:
+			start_stage(manifest, directories, "diff")
+			if differenceNumber >0 or len(differenceOffsets) > 0:
+				print "Making difference movies..."
+				make_difference(maxImps, directories, differenceNumber)
+			finish_stage(manifest, directories, "diff")
+		close_images(maxImps)
+		wait_for_writes()
+
+		clean_up(directories, singleplane) # make_directories() made the folders clean_up() deleted the first time
+		for record in manifest["stages"].values():
+			record["outputs"] = [f for f in record["outputs"] if os.path.exists(os.path.join(directories[0], f))]
+		write_manifest(directories, manifest)
+
+		log.write("Congrats, it was successful!\n")
+		end_event()
+
+	except: # the error goes in the errorFile, like in process_scan()
+		print "Error with ", basename, "continuing on..."
+		scanState.status = "failed"
+		log.write("\n" + datetime.datetime.now().strftime("%Y-%m-%d %H:%M") + "\n")
+		log.write("Error with " + basename + "\n" + "\n")
+		traceback.print_exc(file = log)
+		end_all_events(traceback.format_exc())
+
+	release_memory(reserved)
+	if scanState.writer is not None:
+		scanState.writer.shutdown()
+		scanState.writer = None
+	IJ.freeMemory()
+	return log.getvalue()
+
+# The shared queue (see sharedQueue at the top). A worker claims a scan by creating .anilyze-claim in the scan's folder. Creating a file that doesn't exist yet is atomic (on network shares too), so only one worker can get a claim
+# While a scan is processed, its claim is renewed every claimTimeout / 4 seconds. A claim that is older than claimTimeout was left by a worker that crashed, so another worker takes it over
+# Every worker writes its own progress record (workers/<worker>.json), errorFile and event log in the workers folder of the experiment folder
+claimName = ".anilyze-claim"
+claimsHeld = set() # the scans this worker has claimed
+waitingScans = {} # scan: microscopeType for the scans that were claimed by other workers when this worker got to them
+progress = {} # this worker's progress record
+queueLock = threading.Lock() # for the three above, since parallelWorkers share them
+heartbeatStop = threading.Event()
+
+# worker_name returns this worker's name in the shared queue: workerName, or the computer name and process number
+def worker_name():
+	if workerName != "":
+		return workerName
+	pid, host = ManagementFactory.getRuntimeMXBean().getName().split("@", 1)
+	return host + "-" + pid
+
+# read_claim returns the name of the worker a claim file belongs to
+def read_claim(claimPath):
+	try:
+		claimFile = open(claimPath, "r")
+		try:
+			return json.load(claimFile)["worker"]
+		finally:
+			claimFile.close()
+	except (IOError, ValueError, KeyError): # gone, or the worker that made it hasn't written its name yet
+		return "another worker"
+
+# write_claim writes this worker's name in a claim file
+def write_claim(claimPath):
+	claimFile = open(claimPath, "w")
+	json.dump({"worker": worker_name(), "claimed": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")}, claimFile)
+	claimFile.close()
+
+# claim_unchanged checks that a claim still has the owner and modification time it had when it was judged stale
+def claim_unchanged(claimPath, owner, modified):
+	try:
+		return read_claim(claimPath) == owner and os.path.getmtime(claimPath) == modified
+	except OSError: # released in the meantime
+		return False
+
+# take_over_claim takes over a claim that was judged stale (owner and modified are what it looked like then). Returns True if this worker has the claim now
+# The claim is overwritten, never moved or deleted, so there is no moment without a claim in which another worker could make a new one. Only the worker that makes the takeover lock (.anilyze-claim.takeover-<modified>-<n>) may overwrite it, and only if the claim hasn't changed since it was judged stale
+# A lock older than claimTimeout was left by a worker that crashed during its takeover, so the next one (n + 1) is tried. Locks are only ever made, and only cleaned up once the claim has changed, so no two workers can hold a lock for the same stale claim
+def take_over_claim(claimPath, owner, modified):
+	locks = []
+	while True:
+		lockPath = claimPath + ".takeover-%d-%d" % (int(modified), len(locks))
+		locks.append(lockPath)
+		try:
+			Files.createFile(Paths.get(lockPath))
+			break
+		except FileAlreadyExistsException:
+			try:
+				if time.time() - os.path.getmtime(lockPath) < claimTimeout:
+					return False # another worker is taking it over
+			except OSError: # cleaned up, so the claim was taken over already
+				return False
+	try:
+		if not claim_unchanged(claimPath, owner, modified): # renewed, or taken over by a worker that held a lock before this one
+			return False
+		write_claim(claimPath)
+		return True
+	finally:
+		if not claim_unchanged(claimPath, owner, modified):
+			for lockPath in locks:
+				try:
+					os.remove(lockPath)
+				except OSError:
+					pass
+
+# claim_scan tries to claim a scan for this worker. Returns None if it got the claim, or the name of the worker that has it
+def claim_scan(scan):
+	claimPath = os.path.join(scan, claimName)
+	for attempt in range(3):
+		try:
+			Files.createFile(Paths.get(claimPath))
+			write_claim(claimPath)
+		except FileAlreadyExistsException:
+			owner = read_claim(claimPath)
+			try:
+				modified = os.path.getmtime(claimPath)
+			except OSError: # released in the meantime
+				continue
+			age = time.time() - modified
+			if age < claimTimeout:
+				return owner
+			if not take_over_claim(claimPath, owner, modified):
+				return read_claim(claimPath)
+			print "Taking over", os.path.basename(scan), "from", owner, "(its claim wasn't renewed for %.0f s)" % age
+		queueLock.acquire()
+		try:
+			claimsHeld.add(scan)
+		finally:
+			queueLock.release()
+		return None
+	return read_claim(claimPath)
+
+# release_claim deletes this worker's claim on a scan, unless another worker has taken it over in the meantime
+def release_claim(scan):
+	queueLock.acquire()
+	try:
+		claimsHeld.discard(scan)
+	finally:
+		queueLock.release()
+	claimPath = os.path.join(scan, claimName)
+	if read_claim(claimPath) == worker_name():
+		os.remove(claimPath)
+
+# write_progress saves this worker's progress record: which scans it is working on, which it finished (done, up to date or failed) and which were claimed by other workers
+# It is written to a temporary file first, so whoever is looking at it never reads half a record
+def write_progress():
+	queueLock.acquire()
+	try:
+		progress["updated"] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+		progress["current"] = sorted([os.path.relpath(scan, experimentFolder) for scan in claimsHeld])
+		progress["waiting"] = sorted([os.path.relpath(scan, experimentFolder) for scan in waitingScans])
+		progressPath = os.path.join(experimentFolder, "workers", worker_name() + ".json")
+		progressFile = open(progressPath + ".tmp", "w")
+		json.dump(progress, progressFile, indent = 1, sort_keys = True)
+		progressFile.close()
+		if os.path.exists(progressPath):
+			os.remove(progressPath)
+		os.rename(progressPath + ".tmp", progressPath)
+	finally:
+		queueLock.release()
+
+# renew_claims renews the claims this worker holds (and its progress record) every claimTimeout / 4 seconds, until heartbeatStop is set. It runs on its own thread
+def renew_claims():
+	while not heartbeatStop.isSet():
+		heartbeatStop.wait(claimTimeout / 4.0)
+		queueLock.acquire()
+		try:
+			held = list(claimsHeld)
+		finally:
+			queueLock.release()
+		for scan in held:
+			claimPath = os.path.join(scan, claimName)
+			if read_claim(claimPath) != worker_name(): # only this worker's own claims are renewed
+				print "The claim on", os.path.basename(scan), "isn't this worker's anymore"
+				continue
+			try:
+				os.utime(claimPath, None)
+			except OSError:
+				print "The claim on", os.path.basename(scan), "is gone"
+		write_progress()
+
+# start_worker sets up this worker's progress record and starts renewing its claims. Returns the folder its errorFile and event log go in
+def start_worker():
+	if not resumeScans:
+		raise SystemExit("sharedQueue needs resumeScans = True, the manifests are how workers know which scans are already done")
+	workers = os.path.join(experimentFolder, "workers")
+	if not os.path.isdir(workers):
+		try:
+			os.makedirs(workers)
+		except OSError: # another worker made it at the same time
+			pass
+	progress.update({"worker": worker_name(), "started": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "finished": None,
+		"done": [], "upToDate": [], "failed": [], "claimedElsewhere": []})
+	write_progress()
+	heartbeatStop.clear()
+	heartbeat = threading.Thread(target = renew_claims)
+	heartbeat.setDaemon(True)
+	heartbeat.start()
+	print "Working as", worker_name(), "in the shared queue"
+	return workers
+
+# queue_scan processes a scan if this worker can claim it, and keeps the progress record up to date. Returns the errorFile text
+# A scan that another worker has claimed is put in waitingScans, so finish_queue() can come back to it
+def queue_scan(scan, microscopeType):
+	relative = os.path.relpath(scan, experimentFolder)
+	owner = claim_scan(scan)
+	if owner is not None:
+		print os.path.basename(scan), "is claimed by", owner + ", skipping for now..."
+		queueLock.acquire()
+		try:
+			first = scan not in waitingScans
+			waitingScans[scan] = microscopeType
+			if first:
+				progress["claimedElsewhere"].append(relative)
+		finally:
+			queueLock.release()
+		write_progress()
+		if first:
+			return "\n \n -- " + os.path.basename(scan) + " is claimed by " + owner + " --" + "\n"
+		return ""
+
+	queueLock.acquire()
+	try:
+		waitingScans.pop(scan, None)
+	finally:
+		queueLock.release()
+	write_progress()
+	try:
+		scanLog = process_scan(scan, microscopeType)
+	finally:
+		release_claim(scan)
+	queueLock.acquire()
+	try:
+		progress[scanState.status].append(relative)
+	finally:
+		queueLock.release()
+	write_progress()
+	return scanLog
+
+# finish_queue comes back to the scans that were claimed by other workers until every one of them has been claimed by this worker (and found to be up to date), or taken over from a worker that crashed
+# So the last worker only stops once every scan has been processed. Then the progress record is closed
+def finish_queue(errorFile):
+	while len(waitingScans) > 0:
+		print "Waiting for", len(waitingScans), "scan(s) claimed by other workers..."
+		time.sleep(min(claimTimeout / 4.0, 60))
+		for scan, microscopeType in sorted(waitingScans.items()):
+			errorFile.write(queue_scan(scan, microscopeType))
+			errorFile.flush()
+	heartbeatStop.set()
+	progress["finished"] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+	write_progress()
+
+# bruker_xml_closed checks whether PrairieView has finished writing the .xml of a scan. It closes it with </PVScan> once the acquisition is over
+def bruker_xml_closed(scan, basename):
+	xmlPath = os.path.join(scan, basename + ".xml")
+	if not os.path.exists(xmlPath):
+		return False
+	xmlFile = open(xmlPath, "rb")
+	xmlFile.seek(max(os.path.getsize(xmlPath) - 256, 0)) # only the end is read, the .xml of a long scan is big
+	tail = xmlFile.read()
+	xmlFile.close()
+	return "</PVScan>" in tail
+
+# scan_finished checks whether a scan that watch mode is following is done being acquired (see scanQuietTime at the top)
+# watched remembers what the scan's files looked like the last time, and since when they have looked like that
+# A Bruker scan whose .xml never gets closed (PrairieView crashed) counts as finished once its files have stayed the same for ten times as long
+def scan_finished(scan, microscopeType, watched):
+	try:
+		inputs = input_files(scan, microscopeType)
+	except OSError: # the .oif isn't there yet, or a file was renamed while it was listed
+		return False
+	now = time.time()
+	if watched.get("inputs") != inputs or len(inputs) == 0:
+		watched["inputs"] = inputs
+		watched["since"] = now
+		return False
+	quiet = now - watched["since"]
+	if quiet < scanQuietTime:
+		return False
+	if microscopeType == "Bruker":
+		return bruker_xml_closed(scan, os.path.basename(scan)) or quiet > 10 * scanQuietTime
+	return True
+
+# live_timepoints lists the timepoints of a scan that is being acquired that have a TIF for every channel and z-slice, each as a list of the z-slice TIFs of every channel
+# The newest timepoint is left out, since its last TIF might still be being written
+def live_timepoints(scan, microscopeType):
+	if microscopeType == "Bruker":
+		files, header, channelList, timepoints, complete = bruker_layout(scan, os.path.basename(scan))
+		return [[[os.path.join(scan, files[(cycle, c, p)]) for (cycle, p) in t] for c in channelList] for t in complete if t != timepoints[-1]]
+
+	planes = {}
+	for f in os.listdir(scan):
+		match = olympusPlaneNames.match(f)
+		if match:
+			planes[(int(match.group(3) or 1), int(match.group(1)), int(match.group(2) or 1))] = os.path.join(scan, f)
+	frames = sorted(set([key[0] for key in planes]))
+	channelList = sorted(set([key[1] for key in planes]))
+	sliceList = sorted(set([key[2] for key in planes]))
+	complete = [t for t in frames[:-1] if all((t, c, z) in planes for c in channelList for z in sliceList)]
+	return [[[planes[(t, c, z)] for z in sliceList] for c in channelList] for t in complete]
+
+# read_plane reads a single plane TIF into a processor, straight from the file if it can (see read_tiff_plane()) and with ImageJ's opener if not
+def read_plane(path):
+	try:
+		width, height, pixels, nBytes = read_tiff_plane(path)
+	except ValueError: # compressed, RGB or 32-bit
+		return IJ.openImage(path).getProcessor()
+	if nBytes == 2 * width * height:
+		return ShortProcessor(width, height, pixels, None)
+	return ByteProcessor(width, height, pixels, None)
+
+# update_live_max adds the MAX projections of the timepoints that came in since the last time to a scan's live MAX movies (see liveMAX at the top) in processed/live
+# watched keeps the live movies open (as AppendableTiffs), so only the new timepoints are read and projected, and only their planes are added to the files. Single plane scans have nothing to project, so they are left alone
+def update_live_max(scan, microscopeType, watched):
+	try:
+		timepoints = live_timepoints(scan, microscopeType)
+	except (ValueError, OSError, IOError): # nothing that can be read yet
+		return
+	done = watched.get("liveFrames", 0)
+	if len(timepoints) <= done or len(timepoints[0][0]) < 2:
+		return
+	basename = os.path.basename(scan)
+	live = os.path.join(scan, "processed", "live")
+	if not os.path.isdir(live):
+		os.makedirs(live)
+	colors = [ch1color, ch2color, ch3color]
+	writers = watched.setdefault("liveWriters", [None] * len(timepoints[0]))
+	for t in timepoints[done:]:
+		for c, paths in enumerate(t[:len(writers)]):
+			ip = read_plane(paths[0])
+			for path in paths[1:]:
+				ip.copyBits(read_plane(path), 0, 0, Blitter.MAX)
+			imp = ImagePlus("MAX_C" + str(c + 1) + "-" + basename, ip)
+			if writers[c] is None:
+				set_lut(imp, colors[c] if c < len(colors) else "Select")
+				writers[c] = AppendableTiff(os.path.join(live, imp.getTitle() + ".tif"), imp)
+			writers[c].append(imp)
+	for writer in writers:
+		writer.write_directories()
+	watched["liveFrames"] = len(timepoints)
+	print basename, "live MAX is up to timepoint", len(timepoints)
+
+# close_live_max closes a scan's live MAX movies, once it is finished or watching stops
+def close_live_max(watched):
+	for writer in watched.pop("liveWriters", []):
+		if writer is not None:
+			writer.close()
+
+# watch_scan processes a scan that watch mode found finished. Returns the errorFile text and whether the scan failed, so it can be tried again
+def watch_scan(work, scan, microscopeType):
+	scanState.status = None # queue_scan() leaves it alone for scans that another worker has claimed
+	log = work(scan, microscopeType)
+	return log, scanState.status == "failed"
+
+# watch_folder is run_it()'s loop for watch mode (see watchFolder at the top). Every watchInterval seconds it lists the scans, processes the ones that have finished and (with liveMAX) projects the new timepoints of the ones that haven't
+# Scans that were already processed are skipped as usual (see resumeScans), so watching can be stopped and started again. With parallelWorkers > 1, that many finished scans are processed at the same time while watching goes on
+def watch_folder(errorFile):
+	stopPath = os.path.join(experimentFolder, "stop-watching")
+	pool = None
+	if parallelWorkers > 1:
+		pool = Executors.newFixedThreadPool(parallelWorkers, DaemonThreads())
+	watched = {} # scan: what its files looked like the last time
+	finished = set()
+	failures = {} # scan: how many times it failed
+	running = [] # (scan, future)
+	lastFinished = time.time()
+	print "Watching", experimentFolder, "for new scans. Put a file called stop-watching in it to stop"
+
+	while True:
+		results = [] # (scan, (errorFile text, failed)) of the scans that were processed since the last time
+		for scan, microscopeType in find_scans(experimentFolder, False):
+			if scan in finished:
+				continue
+			state = watched.setdefault(scan, {})
+			if scan_finished(scan, microscopeType, state):
+				print os.path.basename(scan), "is finished"
+				finished.add(scan)
+				close_live_max(watched.pop(scan))
+				lastFinished = time.time()
+				work = process_scan
+				if sharedQueue:
+					work = queue_scan
+				if pool is not None:
+					running.append((scan, pool.submit(Task(watch_scan, work, scan, microscopeType))))
+				else:
+					results.append((scan, watch_scan(work, scan, microscopeType)))
+			elif liveMAX:
+				update_live_max(scan, microscopeType, state)
+
+		for scan, future in [r for r in running if r[1].isDone()]:
+			running.remove((scan, future))
+			results.append((scan, future.get()))
+		# A scan that failed is taken off the finished list, so it is processed again once its files have stayed the same for scanQuietTime (it might have failed because it wasn't all there yet), up to watchRetries times
+		for scan, (log, failed) in results:
+			errorFile.write(log)
+			if failed:
+				failures[scan] = failures.get(scan, 0) + 1
+				if failures[scan] <= watchRetries:
+					print os.path.basename(scan), "failed, it will be tried again"
+					finished.discard(scan)
+		errorFile.flush()
+
+		if os.path.exists(stopPath):
+			os.remove(stopPath) # so the next run doesn't stop right away
+			print "Found stop-watching, stopping"
+			break
+		lastChange = max([lastFinished] + [w["since"] for w in watched.values() if "since" in w])
+		if watchTimeout > 0 and len(running) == 0 and time.time() - lastChange > watchTimeout:
+			print "No new data for", watchTimeout, "seconds, stopping"
+			break
+		time.sleep(watchInterval)
+
+	for scan, future in running: # waits for the scans that are still being processed
+		errorFile.write(future.get()[0])
+	for state in watched.values():
+		close_live_max(state)
+	if pool is not None:
+		pool.shutdown()
+
+# run_it is the main function that calls all the other functions
 def run_it():
+	# With sharedQueue, every worker has its own errorFile and event log in the workers folder (workers/<worker>-errorFile.txt)
+	logFolder = experimentFolder
+	logPrefix = ""
+	if sharedQueue and not renderOnly:
+		logFolder = start_worker()
+		logPrefix = worker_name() + "-"
+
 	# Make an error log file that can be written to
-	errorFilePath = os.path.join(experimentFolder, "errorFile.txt")
+	errorFilePath = os.path.join(logFolder, logPrefix + "errorFile.txt")
 	now = datetime.datetime.now()
-	errorFile = open(errorFilePath, "w")
+	errorFile = open(errorFilePath, "w") # stays open for the whole run
 	errorFile.write("\n" + now.strftime("%Y-%m-%d %H:%M") + "\n")
 	errorFile.write("#### anilyze-data  ####" + "\n")
 	#errorFile.write("Here we go...\n")
-	errorFile.close()
-
-	#Runs microscope_check and defines the scanList accordingly
-	microscopeType = microscope_check(experimentFolder)
-
-	# Call list_scans and pass it the microscopeType variable. Gets the scanList
-	if microscopeType == "Olympus":
-		scanList = list_scans(experimentFolder, microscopeType)
-		print "The returned scanList is", len(scanList), "item(s) long"
-
-	elif microscopeType == "Bruker":
-		scanList = list_scans(experimentFolder, microscopeType)
+	errorFile.flush()
+
+	# The event log is added to by every run, so runs can be compared. Each record has the time the run started
+	eventLog["file"] = open(os.path.join(logFolder, logPrefix + "events.jsonl"), "a")
+	eventLog["run"] = now.strftime("%Y-%m-%d %H:%M:%S")
+	eventLog["records"] = []
+
+	# With renderOnly, the scans are re-rendered from their outputs, renderWorkers at a time (see render_scan())
+	if renderOnly:
+		scanList = find_scans(experimentFolder)
+		workers = renderWorkers
+		if workers < 1:
+			workers = Runtime.getRuntime().availableProcessors()
+		print "Re-rendering", len(scanList), "scan(s),", workers, "at a time"
+		pool = Executors.newFixedThreadPool(workers, DaemonThreads())
+		futures = [pool.submit(Task(render_scan, scan, microscopeType)) for scan, microscopeType in scanList]
+		for future in futures: # written in scanList order
+			errorFile.write(future.get())
+			errorFile.flush()
+		pool.shutdown()
+
+	# In watch mode, scans are processed as they finish being acquired
+	elif watchFolder:
+		watch_folder(errorFile)
+	else:
+		# Find the scans (in any subfolder) and which microscope each one is from. Gets the scanList of (scan, microscopeType)
+		scanList = find_scans(experimentFolder)
 		print "The returned scanList is", len(scanList), "item(s) long"
 
-	# For each scan in the scanList, call the following functions
-	for scan in scanList:
-		try:
-			directories = make_directories(scan) # make the directories
-			basename = os.path.basename(scan) # get the scan name (basename)
-
-			errorFile = open(errorFilePath, "a")
-			errorFile.write("\n \n -- Processing " + basename + " --" + "\n")
-			errorFile.close()
-
-			make_hyperstack(basename, scan, microscopeType) # open the hyperstack
-			imp = IJ.getImage() # select the open image
-			channels = imp.getNChannels() #gets the number of channels
-			print "The number of channels is", channels
-			singleplane = single_plane_check()
-			print "The returned value of singleplane is ", singleplane
-			split_channels(directories, channels) # split the hyperstack into channels (skips if channels == 1)
-			make_MAX(directories, 4, singleplane) # make max projection (skips if singleplane == True)
-			applyLut(channels, ch1color, ch2color, ch3color) # apply the user specified LUT(s)
-
-			# calls merge_channels for raw data (skips if singleplane == True)
-			print "Making raw merge..."
-			if singleplane == False:
-				merge_channels(basename, channels, directories, 4, "_raw") # makes rawMAX merge (4 = rawMax)
-			elif singleplane == True:
-				merge_channels(basename, channels, directories, 1, "_raw") # for single z-plane (1 = raw)
-
-			## makes filtered images. Comment out if you dont want to make any.
-			#print "Making filtered movies..."
-			#rawFiles = os.listdir(directories[1]) # makes a list of the files in "raw"
-			#median_filter(rawFiles, directories, 5) # saves output in filtered
-			#print "making filtered max" # max projection of filtered data
-			#make_MAX(directories, 3, singleplane) # makes filteredMAX (3 = filteredMAX)
-			#applyLut(channels, ch1color, ch2color, ch3color) # apply the user specified LUT(s)
-			#print "Making filtered merge..."
-
-			## # calls merge_channels for filtered data (skips if singleplane == True)
-			#if singleplane == False:
-			#	merge_channels(basename, channels, directories, 3, "_filtered") # makes filteredMAX merge
-			#elif singleplane == True:
-			#	merge_channels(basename, channels, directories, 5, "_filtered") # for single z-plane (5 = filtered)
-
-			# Make difference movies. Uses either filtered MAX projections or filtered hyperstacks (if singleplane == True)
-			if differenceNumber >0:
-				print "Making difference movies..."
-				if singleplane == False:
-					make_difference(directories, 4, differenceNumber, singleplane) # passes rawMAX directory. Change to 3 if you want filteredMAX
-				elif singleplane == True:
-					make_difference(directories, 1, differenceNumber, singleplane) # passes raw directory for raw hyperstacks. Change to 5 if you want filtered
-
-			clean_up(directories, singleplane)	# clean up directory structure
-
-			errorFile = open(errorFilePath, "a")
-			errorFile.write("Congrats, it was successful!\n")
-			errorFile.close()
-			IJ.freeMemory() # runs garbage collector
-
-		except:  #if there is an exception to the above code, create or append to an errorFile with the traceback
-			print "Error with ", basename, "continuing on..."
-
-			errorFile = open(errorFilePath, "a")
-			errorFile.write("\n" + now.strftime("%Y-%m-%d %H:%M") + "\n") #writes the date and time
-			#errorFile.write("Error detected...\n")
-			errorFile.write("Error with " + basename + "\n" + "\n")
-			traceback.print_exc(file = errorFile) # writes the error traceback to the file
-			errorFile.close()
-			IJ.run("Close All")
-			#clean_up(directories, singleplane)	# clean up directory structure
-			IJ.freeMemory() # runs garbage collector
-			continue # continue on with the next scan, even if the current one threw an error
-
-	errorFile = open(errorFilePath, "a")
+		# For each scan in the scanList, call process_scan (or queue_scan, which claims the scan first). With parallelWorkers > 1, that many scans are processed at the same time
+		work = process_scan
+		if sharedQueue:
+			work = queue_scan
+		if parallelWorkers > 1:
+			print "Processing", parallelWorkers, "scans at a time"
+			pool = Executors.newFixedThreadPool(parallelWorkers)
+			futures = [pool.submit(Task(work, scan, microscopeType)) for scan, microscopeType in scanList]
+		else:
+			futures = None
+
+		# With prefetchScans, the next scans are imported on a background thread while the current one is processed
+		# Not in the shared queue, where the next scan might be claimed by another worker
+		prefetcher = None
+		prefetches = {}
+		importedEvents = [threading.Event() for scan in scanList]
+		if futures is None and prefetchScans > 0 and not sharedQueue:
+			prefetcher = Executors.newSingleThreadExecutor(DaemonThreads())
+
+		for i, (scan, microscopeType) in enumerate(scanList):
+			if futures is not None:
+				scanLog = futures[i].get() # waits for this scan to finish. Results are written in scanList order, even if a later scan finishes first
+			else:
+				if prefetcher is not None:
+					for j in range(i + 1, min(i + 1 + prefetchScans, len(scanList))):
+						if j not in prefetches:
+							prefetches[j] = prefetcher.submit(Task(prefetch_scan, scanList[j][0], scanList[j][1], importedEvents[j - 1], importedEvents[j]))
+				if sharedQueue:
+					scanLog = queue_scan(scan, microscopeType)
+				else:
+					scanLog = process_scan(scan, microscopeType, prefetches.pop(i, None), importedEvents[i])
+
+			errorFile.write(scanLog)
+			errorFile.flush()
+
+		if futures is not None:
+			pool.shutdown()
+		if prefetcher is not None:
+			prefetcher.shutdown()
+
+	# Come back to the scans other workers had claimed, in case one of them crashed
+	if sharedQueue and not renderOnly:
+		finish_queue(errorFile)
+
+	summary = event_summary(eventLog["records"], 5) # the slowest scans and stages of this run
+	print summary
+	errorFile.write("\n" + summary)
 	errorFile.write("\nDone with script.\n")
 	errorFile.close()
-run_it()
-print "Done with script"
+	eventLog["file"].close()
+	eventLog["file"] = None
+
+if not globals().get("loadFunctionsOnly", False): # benchmark.py loads the functions in this file without running the pipeline
+	run_it()
+	print "Done with script"
@@ -3,7 +3,7 @@
 """
 ##AUTHOR: Ani Michaud (Varjabedian)
 
-## DESCRIPTION: This script is for automating opening MAX projection files after running the anilyzer. It will make a list of all the scans and then find the MAXs for each channel and open them. IF YOU WANT TO OPEN A DIFFERENT DIRECTORY, CHANGE RUN_IT() TO LOOK IN A DIFFERENT FOLDER (LINE 95)
+## DESCRIPTION: This script is for reviewing the MAX projection files after running the anilyzer. It will make a list of all the scans and show a small preview of each one on a contact sheet, and double-clicking a scan opens its full size MAXs for each channel (see reviewMode). IF YOU WANT TO OPEN A DIFFERENT DIRECTORY, CHANGE MAX_SOURCES() TO LOOK IN A DIFFERENT FOLDER
 
 The organization of this code is as follows:
 
@@ -16,49 +16,49 @@ The organization of this code is as follows:
 
 """
 
-import os, sys, shutil, glob, fnmatch
+import os, sys, shutil, glob, fnmatch, time, json
 from java.io import File
+from java.util.concurrent import Executors, ExecutionException
+from java.awt import Color, Font
+from java.awt.event import MouseAdapter
 from ij.gui import GenericDialog
-from ij import IJ
+from ij import IJ, ImagePlus, ImageStack, VirtualStack
+from ij.plugin import ContrastEnhancer, LutLoader
+from ij.process import Blitter, ColorProcessor, ImageProcessor
+from ij.io import FileSaver, OpenDialog
+import threading
 
 experimentFolder = str(experimentFolder) # Converts the input directory you chose to a path string that can be used later on
 
-# Microscope_check assesses the file structure of the experimentFolder and assigns a "microscope type" which gets passed to other functions. This helps with determining where certain files and directories should be located.
-def microscope_check(experimentFolder):
-	#If it finds .oif files inside the main folder, it calls the microscope "Olympus"
-	if any(File.endswith(".oif") for File in os.listdir(experimentFolder)):
-		print(".oif files present, running Olympus pipeline")
-		microscopeType = "Olympus"
-		return microscopeType #returns microscopeType to run_it()
-	else:
-		#If there are no .oif files in the main folder, it calls the microscope "Bruker"
-		print("No .oif files present, running Bruker pipeline")
-		microscopeType = "Bruker"
-		return microscopeType #returns microscopeType to run_it()
-
-# list_scans gets a list of all scan folders inside the experimentFolder you selected, and saves them as a list called scanList.
-def list_scans(experimentFolder, microscopeType):
-	scanList = [] # Makes an empty list
-
-	# This section screens out text files and other things that might be in the main experimentFolder, and only makes a list of the actual scan directories
-	# For Bruker microscopes, the scan directories are plain, so os.isdir is used to look for them
-	if microscopeType == "Bruker":
-		for File in sorted(os.listdir(experimentFolder)):
-			dirpath = os.path.join(experimentFolder, File) # Makes a complete path to the file
-			if os.path.isdir(dirpath): # If the dirpath is a directory, print it and add it to scanList. If it's a file, do not add it.
-				print "dirpath is " + dirpath
-				scanList.append(dirpath)
-		return scanList # Returns scanList to run_it()
-
-	# If the microscope is "Olympus" type, the directories end in .oif.files, so .endswith needs to be used to find them
-	if microscopeType == "Olympus":
-		oifList = [] # This doesn't look like it was used, so I should delete it in the future once I have verified this.
-		for File in sorted(os.listdir(experimentFolder)):
-			if File.endswith(".oif.files"): # If the item ends with .oif.files, make the complete path and append it to scanList
-				dirpath = os.path.join(experimentFolder, File)
-				#print "dirpath is " + dirpath
-				scanList.append(dirpath)
-		return scanList # Returns scanList to run_it()
+# Settings for finding the scans (the same as in anilyze-data.py)
+scanIndex = True # Uses the scan-index.json that anilyze-data.py made (or makes one), so only the folders that changed since are searched again. False searches the whole experiment folder every time
+discoveryThreads = 16 # How many folders are looked at the same time when searching for scans
+
+# Settings for reviewing the scans
+reviewMode = "sheet" # "sheet" shows a preview of every scan on a contact sheet, and double-clicking a scan opens its full size MAX projections. "open" opens the full size MAX_C1 projection of every scan, like before
+previewSize = 192 # Previews are shrunk (by averaging) until they fit in previewSize x previewSize pixels
+previewFrames = 24 # How many timepoints (spread evenly over the scan) a preview keeps
+sheetColumns = 6 # Scans per row of the contact sheet
+sheetRows = 4 # Rows of scans per page of the contact sheet
+previewThreads = 4 # How many previews are made at the same time
+
+# The functions this script shares with anilyze-data.py (finding scans, the thread pool helpers, and opening OME-Zarr outputs and linked raw hyperstacks) are loaded from it without running its pipeline, like benchmark.py does, so there is only one copy of them
+# Loading it only defines its settings and functions. anilyze-data.py is looked for next to this script, and only if it isn't there (or Fiji doesn't say where this script is) you are asked where it is
+anilyzeScript = os.path.join(os.path.dirname(os.path.abspath(globals().get("__file__", ""))), "anilyze-data.py")
+if not os.path.isfile(anilyzeScript):
+	openDialog = OpenDialog("Where is anilyze-data.py?", None)
+	if openDialog.getFileName() is None:
+		raise SystemExit("batch-opener.py needs anilyze-data.py")
+	anilyzeScript = os.path.join(openDialog.getDirectory(), openDialog.getFileName())
+anilyze = {"loadFunctionsOnly": True, "experimentFolder": experimentFolder, "differenceNumber": 0, "ch1color": "Select", "ch2color": "Select", "ch3color": "Select"}
+execfile(anilyzeScript, anilyze)
+anilyze.update({"scanIndex": scanIndex, "discoveryThreads": discoveryThreads}) # the settings above, for find_scans()
+find_scans = anilyze["find_scans"]
+Task = anilyze["Task"]
+DaemonThreads = anilyze["DaemonThreads"]
+read_json = anilyze["read_json"]
+open_zarr = anilyze["open_zarr"] # for outputFormat = "zarr"
+open_plane_links = anilyze["open_plane_links"] # for rawOutput = "links"
 
 # make_directories takes an individual scan (passed from the run_it() function) and checks to see if a "processed" directory already exist inside the scan folder. If so, it overwrites it.
 def define_directories(scan):
@@ -73,30 +73,271 @@ def define_directories(scan):
 
 	return directories # defines directory structure returns directories list to run_it()
 
-def run_it():
-	#Runs microscope_check and defines the scanList accordingly
-	microscopeType = microscope_check(experimentFolder)
 
-	# Call list_scans and pass it the microscopeType variable. Gets the scanList
-	if microscopeType == "Olympus":
-		scanList = list_scans(experimentFolder, microscopeType)
-		print "The returned scanList is", len(scanList), "item(s) long"
+# Reviewing the scans (see reviewMode at the top). Every scan gets a small preview of its MAX projections in processed/preview: previewFrames timepoints, shrunk to fit previewSize and merged into one RGB movie with the channel colors
+# preview.json records the sizes and dates of the MAX projections it was made from, so a preview is only made again when they change. The contact sheet only ever reads the previews, and a scan's full size files are only opened when it is double-clicked
+
+# max_sources returns the full size MAX projections of a scan, one per channel (TIFs or OME-Zarr folders in rawMAX). Single plane scans have no MAX projections, so their raw channel hyperstacks are used instead (which can be links to the scan's TIFs, see rawOutput in anilyze-data.py)
+def max_sources(scan):
+	directories = define_directories(scan)
+	for directory, prefix in ((directories[4], "MAX_C"), (directories[1], "C")):
+		if os.path.isdir(directory):
+			sources = [os.path.join(directory, f) for f in sorted(os.listdir(directory)) if f.startswith(prefix) and f.endswith((".tif", ".ome.zarr", ".planes.json"))]
+			if len(sources) > 0:
+				return sources
+	return []
+
+# source_signature returns the size and date of a MAX projection. An OME-Zarr folder's .zattrs is written last, once every chunk is on disk, so its date is the folder's
+def source_signature(path):
+	if os.path.isdir(path):
+		path = os.path.join(path, ".zattrs")
+	stat = os.stat(path)
+	return [stat.st_size, int(stat.st_mtime)]
+
+# preview_level picks the smallest level of an OME-Zarr output that is still at least previewSize across, so a preview doesn't have to read the full size planes
+def preview_level(path):
+	level = 0
+	while os.path.exists(os.path.join(path, str(level + 1), ".zarray")):
+		shape = read_json(os.path.join(path, str(level + 1), ".zarray"))["shape"]
+		if max(shape[3], shape[4]) < previewSize:
+			break
+		level += 1
+	return level
+
+# open_source opens a MAX projection (a TIF or an OME-Zarr folder) or a raw channel hyperstack as a virtual stack, so only the planes that are asked for are read
+def open_source(path, level = 0):
+	if path.endswith(".ome.zarr"):
+		return open_zarr(path, level, True)
+	if path.endswith(".planes.json"):
+		return open_plane_links(path)
+	return IJ.openVirtual(path)
+
+# channel_colors returns the colors a scan's channels were merged with (the merge stage's colors in processed/manifest.json, like ["Green", "Magenta", "Select"]), or [] if it hasn't been merged yet
+# The MAX projections are saved gray (the colors are only set for the merge), so the preview takes its colors from here
+def channel_colors(scan):
+	try:
+		return read_json(os.path.join(scan, "processed", "manifest.json"))["stages"]["merge"]["parameters"]["colors"]
+	except (IOError, ValueError, KeyError, TypeError): # no manifest, or a scan that hasn't been merged
+		return []
+
+# channel_lut returns the LUT for a MAX projection or raw channel hyperstack (MAX_C2-..., C2-...) in its channel's merge color. Channels without a color keep the LUT they were opened with
+def channel_lut(path, imp, colors):
+	name = os.path.basename(path)
+	if name.startswith("MAX_"):
+		name = name[len("MAX_"):]
+	try:
+		color = colors[int(name[1:name.index("-")]) - 1]
+	except (ValueError, IndexError):
+		color = "Select"
+	if color == "Select":
+		return imp.getProcessor().getLut()
+	return LutLoader.getLut(color.lower())
+
+# make_preview makes a scan's preview, or reuses the one in processed/preview if its MAX projections (and the preview settings) haven't changed since
+# Returns the preview's path and how many timepoints it has, or (None, 0) if the scan has nothing to preview yet
+def make_preview(scan):
+	sources = max_sources(scan)
+	if len(sources) == 0:
+		return None, 0
+	previewFolder = os.path.join(scan, "processed", "preview")
+	previewPath = os.path.join(previewFolder, "preview.tif")
+	recordPath = os.path.join(previewFolder, "preview.json")
+	colors = channel_colors(scan)
+	record = {"sources": dict((os.path.relpath(path, scan), source_signature(path)) for path in sources), "previewSize": previewSize, "previewFrames": previewFrames, "colors": colors} # so recoloring a scan makes its preview again
+	try:
+		saved = read_json(recordPath)
+		if os.path.exists(previewPath) and dict((key, saved.get(key)) for key in record) == record:
+			return previewPath, saved["frames"]
+	except (IOError, ValueError, KeyError, AttributeError): # no preview yet, or one that can't be read
+		pass
+
+	planes = None
+	for path in sources:
+		imp = open_source(path, preview_level(path) if path.endswith(".ome.zarr") else 0)
+		stack = imp.getStack()
+		count = min(previewFrames, stack.getSize())
+		shrink = max(1, (max(imp.getWidth(), imp.getHeight()) + previewSize - 1) / previewSize)
+		channelPlanes = []
+		for i in range(count):
+			ip = stack.getProcessor(1 + i * stack.getSize() / count) # timepoints spread evenly over the scan
+			if shrink > 1:
+				ip.setInterpolationMethod(ImageProcessor.BILINEAR)
+				ip = ip.resize(imp.getWidth() / shrink, imp.getHeight() / shrink, True) # averages the pixels it shrinks together
+			channelPlanes.append(ip)
+		# The brightness is set like Auto in Brightness/Contrast, from the middle timepoint, and used for the whole preview so it doesn't flicker
+		middle = channelPlanes[len(channelPlanes) / 2]
+		ContrastEnhancer().stretchHistogram(middle, 0.35, middle.getStats())
+		low, high = middle.getMin(), middle.getMax()
+		lut = channel_lut(path, imp, colors)
+		imp.close()
+		rgbPlanes = []
+		for ip in channelPlanes:
+			ip.setLut(lut)
+			ip.setMinAndMax(low, high)
+			rgbPlanes.append(ip.convertToRGB())
+		if planes is None:
+			planes = rgbPlanes
+		else:
+			planes = planes[:len(rgbPlanes)]
+			for plane, rgb in zip(planes, rgbPlanes):
+				plane.copyBits(rgb, 0, 0, Blitter.ADD) # like a composite image, the channel colors add up
+
+	previewStack = ImageStack(planes[0].getWidth(), planes[0].getHeight())
+	for plane in planes:
+		previewStack.addSlice(None, plane)
+	if not os.path.isdir(previewFolder):
+		os.makedirs(previewFolder)
+	if not FileSaver(ImagePlus(os.path.basename(scan), previewStack)).saveAsTiff(previewPath):
+		raise IOError("Could not save " + previewPath)
+	record["frames"] = len(planes)
+	jsonFile = open(recordPath, "w")
+	json.dump(record, jsonFile, indent = 1, sort_keys = True)
+	jsonFile.close()
+	return previewPath, len(planes)
+
+# make_previews makes (or reuses) the previews of all the scans, previewThreads at a time. Returns a list of (preview path, timepoints) in the same order as scanList
+def make_previews(scanList):
+	start = time.time()
+	pool = Executors.newFixedThreadPool(max(previewThreads, 1), DaemonThreads())
+	try:
+		futures = [pool.submit(Task(make_preview, scan)) for scan, microscopeType in scanList]
+		previews = []
+		for (scan, microscopeType), future in zip(scanList, futures):
+			try:
+				previews.append(future.get())
+			except ExecutionException as e: # one scan that can't be read doesn't stop the others
+				print "Couldn't make a preview of", os.path.basename(scan) + ":", e.getCause()
+				previews.append((None, 0))
+	finally:
+		pool.shutdown()
+	print "Previews of", len([p for p in previews if p[0] is not None]), "scan(s) are ready, in %.1f s" % (time.time() - start)
+	return previews
+
+# ContactSheet is a virtual stack of pages of previews, sheetColumns x sheetRows scans to a page with their names under them. It is shown as a hyperstack: the z slider turns the pages and the t slider plays the previews
+# A page is only put together when it is shown, and only the previews of the page that is showing are kept in memory
+class ContactSheet(VirtualStack):
+	labelHeight = 16
 
-	elif microscopeType == "Bruker":
-		scanList = list_scans(experimentFolder, microscopeType)
-		print "The returned scanList is", len(scanList), "item(s) long"
+	def __init__(self, scanList, previews):
+		VirtualStack.__init__(self, sheetColumns * previewSize, sheetRows * (previewSize + self.labelHeight), None, None)
+		self.setBitDepth(24)
+		self.scans = [scan for scan, microscopeType in scanList]
+		self.previews = previews
+		self.perPage = sheetColumns * sheetRows
+		self.pages = max((len(self.scans) + self.perPage - 1) / self.perPage, 1)
+		self.frames = max([frames for path, frames in previews] + [1])
+		self.page = None
+		self.opened = {} # preview path: the preview, for the page that is showing
+
+	def getSize(self):
+		return self.pages * self.frames
+
+	def getSliceLabel(self, n):
+		return "page " + str((n - 1) % self.pages + 1) + " of " + str(self.pages)
+
+	# scan_at returns the scan shown at (x, y) on a page, or None
+	def scan_at(self, page, x, y):
+		if x < 0 or y < 0 or x >= self.getWidth() or y >= self.getHeight():
+			return None
+		i = page * self.perPage + (y / (previewSize + self.labelHeight)) * sheetColumns + x / previewSize
+		if i < len(self.scans):
+			return self.scans[i]
+		return None
+
+	def getProcessor(self, n):
+		page = (n - 1) % self.pages
+		frame = (n - 1) / self.pages
+		if page != self.page:
+			self.page = page
+			self.opened = {}
+		sheet = ColorProcessor(self.getWidth(), self.getHeight())
+		sheet.setColor(Color.white)
+		sheet.setFont(Font("SansSerif", Font.PLAIN, 12))
+		sheet.setAntialiasedText(True)
+		for i in range(page * self.perPage, min((page + 1) * self.perPage, len(self.scans))):
+			cell = i - page * self.perPage
+			x = (cell % sheetColumns) * previewSize
+			y = (cell / sheetColumns) * (previewSize + self.labelHeight)
+			path, frames = self.previews[i]
+			if path is None:
+				sheet.drawString("no MAX yet", x + 4, y + previewSize / 2)
+			else:
+				if path not in self.opened:
+					self.opened[path] = IJ.openImage(path)
+				preview = self.opened[path]
+				ip = preview.getStack().getProcessor(min(frame + 1, preview.getStackSize())) # previews with fewer timepoints stay on their last one
+				sheet.insert(ip, x + (previewSize - ip.getWidth()) / 2, y + (previewSize - ip.getHeight()) / 2)
+			label = os.path.relpath(self.scans[i], experimentFolder)
+			while len(label) > 1 and sheet.getStringWidth(label) > previewSize - 4: # long names lose their start, the scan name is at the end
+				label = label[1:]
+			sheet.drawString(label, x + 2, y + previewSize + self.labelHeight - 2)
+		return sheet
+
+	def getPixels(self, n):
+		return self.getProcessor(n).getPixels()
+
+# open_scan opens a scan's full size MAX projections, one window per channel. OME-Zarr outputs (and links) are opened as virtual stacks, so only the planes that are looked at are read
+def open_scan(scan):
+	print "Opening " + os.path.basename(scan)
+	for path in max_sources(scan):
+		if path.endswith(".tif"):
+			imp = IJ.openImage(path)
+		else:
+			imp = open_source(path)
+		imp.show()
+		IJ.run(imp, "Out [-]", "") # zoom out one level
+
+# SheetClicks opens a scan's full size MAX projections (see open_scan()) when it is double-clicked on the contact sheet. They are opened on their own thread, so the sheet can still be scrolled meanwhile
+class SheetClicks(MouseAdapter):
+	def __init__(self, imp, sheet):
+		self.imp = imp
+		self.sheet = sheet
+
+	def mouseClicked(self, event):
+		if event.getClickCount() != 2:
+			return
+		canvas = self.imp.getCanvas()
+		scan = self.sheet.scan_at(self.imp.getZ() - 1, canvas.offScreenX(event.getX()), canvas.offScreenY(event.getY()))
+		if scan is not None:
+			opener = threading.Thread(target = open_scan, args = (scan,))
+			opener.setDaemon(True)
+			opener.start()
+
+# show_sheet shows the contact sheet of all the scans
+def show_sheet(scanList, previews):
+	sheet = ContactSheet(scanList, previews)
+	imp = ImagePlus("Contact sheet - " + os.path.basename(experimentFolder), sheet)
+	imp.setDimensions(1, sheet.pages, sheet.frames)
+	imp.setOpenAsHyperStack(True)
+	imp.show()
+	imp.getCanvas().addMouseListener(SheetClicks(imp, sheet))
+	print "Double-click a scan on the contact sheet to open its full size MAX projections"
+
+def run_it():
+	# Find the scans (in any subfolder), from the scan index if anilyze-data.py already made one. Gets the scanList of (scan, microscopeType)
+	scanList = find_scans(experimentFolder)
+	print "The returned scanList is", len(scanList), "item(s) long"
+
+	if reviewMode == "sheet":
+		show_sheet(scanList, make_previews(scanList))
+		return
 
 	# For each scan in the scanList, call the following functions
-	for scan in scanList:
+	for scan, microscopeType in scanList:
 		directories = define_directories(scan) # get paths to the directories
 		basename = os.path.basename(scan) # get the scan name (basename)
 		print "Opening " + basename
+		if not os.path.isdir(directories[4]):
+			print basename, "has no rawMAX folder, skipping..."
+			continue
 		files = os.listdir(directories[4]) # makes a list of all the files in rawMAX directory
 		for f in files: # finds the MAX projections and only opens them (skips merged)
 			if fnmatch.fnmatch(f, "MAX_C1*"): #finds MAX projections. change if you only want 1 channel
-				IJ.open(os.path.join(directories[4], f))
+				if f.endswith(".ome.zarr"):
+					open_zarr(os.path.join(directories[4], f), 0, True).show() # only the planes that are looked at are read
+				else:
+					IJ.open(os.path.join(directories[4], f))
 				IJ.run("Out [-]", f) #zoom out one level
 
-
 run_it()
 print "Done with script."
@@ -0,0 +1,314 @@
+# @File(label = "Benchmark directory (synthetic data is made here)", style = "directory") benchmarkFolder
+# @File(label = "anilyze-data.py", style = "file") anilyzeScript
+# @String(label = "Label for this run (e.g. the branch or change you are testing)", value = "") runLabel
+
+"""
+##AUTHOR: Ani Michaud (Varjabedian)
+
+## DESCRIPTION: This script benchmarks the stages of anilyze-data.py on synthetic data. It makes Bruker style (_CycleNNNNN_ChN_NNNNNN.ome.tif + .xml) experiment folders of the sizes listed in datasets (below),
+then runs the pipeline on them one stage at a time and records the wall time, peak heap and bytes read/written of every stage. The results are added to benchmark-results.jsonl in the benchmark directory,
+and each run is compared to the run before it, so you can see if a change made things faster or slower.
+
+The organization of this code is as follows:
+
+1. Script parameters (at the top, preceded by a "#@") that gather information for the dialogue box
+2. Import statements for all the modules needed, followed by the datasets to make and the pipeline settings to use
+3. The functions that make the synthetic experiment folders
+4. The functions that time the pipeline stages and compare runs
+5. The run_it() function, which makes the data, runs the benchmark and writes the results
+
+The synthetic data is only made once (it is kept in the benchmark directory and reused by later runs, as long as the dataset settings stay the same), so run the script once before you start measuring if you want a warm disk cache.
+
+"""
+
+import os, sys, traceback, shutil, time, json, datetime
+from ij import IJ, ImagePlus
+from ij.process import ShortProcessor, ByteProcessor
+from ij.io import FileSaver
+from java.lang.management import ManagementFactory, MemoryType
+
+# command_line_parameters reads the dialogue box parameters from the command line, as name=value pairs (like anilyze-data.py)
+# For example: ImageJ-linux64 --headless benchmark.py benchmarkFolder=/scratch/bench runLabel=my-change
+def command_line_parameters(args):
+	parameters = {"benchmarkFolder": None, "anilyzeScript": os.path.join(os.path.dirname(os.path.abspath(sys.argv[0])), "anilyze-data.py"), "runLabel": ""}
+	for arg in args:
+		name, equals, value = arg.partition("=")
+		if name not in parameters or equals == "":
+			raise SystemExit("Unknown argument " + arg + ". Use name=value with any of: " + ", ".join(sorted(parameters)))
+		parameters[name] = value.strip('"')
+	if parameters["benchmarkFolder"] is None:
+		raise SystemExit("Please give the benchmark directory as benchmarkFolder=/path/to/folder")
+	return parameters["benchmarkFolder"], parameters["anilyzeScript"], parameters["runLabel"]
+
+try:
+	benchmarkFolder # set by the dialogue box
+except NameError:
+	benchmarkFolder, anilyzeScript, runLabel = command_line_parameters(sys.argv[1:])
+
+benchmarkFolder = str(benchmarkFolder)
+anilyzeScript = str(anilyzeScript)
+
+# The synthetic datasets to benchmark. Each one is an experiment folder with a single scan. extraPlanes adds that many planes of an incomplete timepoint at the end (like stopping an acquisition early)
+datasets = [
+	{"microscope": "Bruker", "channels": 2, "slices": 10, "frames": 20, "width": 512, "height": 512, "bitDepth": 16, "extraPlanes": 0},
+	{"microscope": "Bruker", "channels": 2, "slices": 1, "frames": 200, "width": 512, "height": 512, "bitDepth": 16, "extraPlanes": 0},
+]
+
+# The dialogue box parameters and settings of anilyze-data.py to benchmark with. Settings that aren't listed keep the values at the top of anilyze-data.py
+differenceNumber = 4
+channelColors = ["Green", "Magenta", "Blue"]
+pipelineSettings = {"streamingProjection": False, "makeFiltered": True} # makeFiltered is off by default, but the filtered stage is benchmarked too
+
+regressionThreshold = 1.2 # stages that take this many times longer than in the last run are flagged in the summary
+resultsName = "benchmark-results.jsonl"
+
+
+# dataset_name makes a folder name that describes a dataset, e.g. Bruker_C2Z10T20_512x512_16bit
+def dataset_name(dataset):
+	return "%(microscope)s_C%(channels)dZ%(slices)dT%(frames)d_%(width)dx%(height)d_%(bitDepth)dbit" % dataset + ("_extra%d" % dataset["extraPlanes"] if dataset["extraPlanes"] else "")
+
+# synthetic_plane makes one plane of synthetic data: a dim background, a bright square that moves over time (so the difference movies have something in them) and noise
+def synthetic_plane(dataset, c, z, t):
+	width, height = dataset["width"], dataset["height"]
+	if dataset["bitDepth"] == 16:
+		ip = ShortProcessor(width, height)
+		bright = 1000
+	else:
+		ip = ByteProcessor(width, height)
+		bright = 200
+	ip.setValue(20 + 10 * c)
+	ip.fill()
+	size = max(width / 16, 2)
+	ip.setValue(bright)
+	ip.setRoi((t * size / 2) % (width - size), (height / 2 + z * 2) % (height - size), size, size)
+	ip.fill()
+	ip.resetRoi()
+	ip.noise(8)
+	return ip
+
+# save_plane saves a synthetic plane as a single plane TIF
+def save_plane(ip, path):
+	FileSaver(ImagePlus(os.path.basename(path), ip)).saveAsTiff(path)
+
+# planes_to_write lists the (channel, z, t) of every plane of a dataset, in acquisition order, including the planes of the incomplete timepoint
+def planes_to_write(dataset):
+	planes = [(c, z, t) for t in range(1, dataset["frames"] + 1) for z in range(1, dataset["slices"] + 1) for c in range(1, dataset["channels"] + 1)]
+	extra = [(c, z, dataset["frames"] + 1) for z in range(1, dataset["slices"] + 1) for c in range(1, dataset["channels"] + 1)]
+	return planes + extra[:dataset["extraPlanes"]]
+
+# make_bruker writes a PrairieView style scan folder: basename_Cycle00001_Ch1_000001.ome.tif files and a basename.xml with the sequence type, pixel size and one Frame entry per plane
+# For z-stacks every cycle is a timepoint and the plane number is the z-slice. For single plane data there is one cycle and the plane number is the timepoint
+def make_bruker(experiment, dataset):
+	basename = "TSeries-001"
+	scan = os.path.join(experiment, basename)
+	os.makedirs(scan)
+	zSeries = dataset["slices"] > 1
+	sequences = {}
+	for (c, z, t) in planes_to_write(dataset):
+		if zSeries:
+			cycle, plane = t, z
+		else:
+			cycle, plane = 1, t
+		name = "%s_Cycle%05d_Ch%d_%06d.ome.tif" % (basename, cycle, c, plane)
+		save_plane(synthetic_plane(dataset, c, z, t), os.path.join(scan, name))
+		sequences.setdefault(cycle, {}).setdefault(plane, []).append((c, name))
+
+	if zSeries:
+		sequenceType = "TSeries ZSeries Element"
+	else:
+		sequenceType = "TSeries Timed Element"
+	lines = ['<?xml version="1.0" encoding="utf-8"?>', '<PVScan version="5.4.64.100" date="%s" notes="synthetic">' % datetime.datetime.now().strftime("%m/%d/%Y %I:%M:%S %p"), '  <PVStateShard>']
+	lines.append('    <PVStateValue key="bitDepth" value="%d" />' % dataset["bitDepth"])
+	lines.append('    <PVStateValue key="linesPerFrame" value="%d" />' % dataset["height"])
+	lines.append('    <PVStateValue key="pixelsPerLine" value="%d" />' % dataset["width"])
+	lines.append('    <PVStateValue key="micronsPerPixel">')
+	lines.append('      <IndexedValue index="XAxis" value="0.5" />')
+	lines.append('      <IndexedValue index="YAxis" value="0.5" />')
+	lines.append('      <IndexedValue index="ZAxis" value="1" />')
+	lines.append('    </PVStateValue>')
+	lines.append('  </PVStateShard>')
+	for cycle in sorted(sequences):
+		lines.append('  <Sequence type="%s" cycle="%d" time="00:00:00.0000000">' % (sequenceType, cycle))
+		for plane in sorted(sequences[cycle]):
+			lines.append('    <Frame relativeTime="0" absoluteTime="0" index="%d" parameterSet="CurrentSettings">' % plane)
+			for (c, name) in sequences[cycle][plane]:
+				lines.append('      <File channel="%d" channelName="Ch%d" page="1" filename="%s" />' % (c, c, name))
+			lines.append('    </Frame>')
+		lines.append('  </Sequence>')
+	lines.append('</PVScan>')
+	xmlFile = open(os.path.join(scan, basename + ".xml"), "w")
+	xmlFile.write("\n".join(lines) + "\n")
+	xmlFile.close()
+
+# make_dataset makes the experiment folder of a dataset, unless it was already made with the same settings. Returns the path to the experiment folder
+def make_dataset(dataset):
+	experiment = os.path.join(benchmarkFolder, dataset_name(dataset))
+	markerPath = os.path.join(experiment, "synthetic.json")
+	if os.path.exists(markerPath):
+		markerFile = open(markerPath, "r")
+		same = json.load(markerFile) == dataset
+		markerFile.close()
+		if same:
+			print "Reusing", experiment
+			return experiment
+	if os.path.exists(experiment):
+		shutil.rmtree(experiment)
+	os.makedirs(experiment)
+
+	print "Making synthetic data in", experiment
+	make_bruker(experiment, dataset)
+	markerFile = open(markerPath, "w") # written last, so a half made dataset is made again next time
+	json.dump(dataset, markerFile, indent = 1, sort_keys = True)
+	markerFile.close()
+	return experiment
+
+
+# StageFailed is raised by run_stage() when a stage has an error, so the stages that need its results are skipped
+class StageFailed(Exception):
+	pass
+
+heapPools = [pool for pool in ManagementFactory.getMemoryPoolMXBeans() if pool.getType() == MemoryType.HEAP]
+
+# peak_heap returns the highest heap use since reset_peak_heap() (the sum of the peaks of each heap pool, so it can be a little higher than the real peak)
+def peak_heap():
+	return sum([pool.getPeakUsage().getUsed() for pool in heapPools])
+
+def reset_peak_heap():
+	IJ.freeMemory() # runs the garbage collector, so garbage from the last stage doesn't count
+	for pool in heapPools:
+		pool.resetPeakUsage()
+
+# io_counters returns the bytes this process has read and written so far. Only Linux keeps track of these (in /proc/self/io), so on other systems it returns None and bytes read are not recorded
+def io_counters():
+	try:
+		ioFile = open("/proc/self/io", "r")
+		counters = dict([line.split(":") for line in ioFile.read().splitlines() if ":" in line])
+		ioFile.close()
+		return int(counters["rchar"]), int(counters["wchar"])
+	except (IOError, KeyError, ValueError):
+		return None
+
+# run_stage runs one pipeline stage and returns a result record with its wall time, peak heap and bytes read/written
+# Bytes written are the sizes of the files the stage saved (anilyze-data.py keeps a list of them), bytes read come from the operating system
+def run_stage(anilyze, results, record, stage, function, *args):
+	anilyze["scanState"].outputs = []
+	reset_peak_heap()
+	ioBefore = io_counters()
+	start = time.time()
+	result = None
+	error = None
+	try:
+		result = function(*args)
+	except:
+		error = traceback.format_exc()
+		print "Error in the", stage, "stage:"
+		print error
+	seconds = time.time() - start
+	ioAfter = io_counters()
+
+	entry = dict(record)
+	entry["stage"] = stage
+	entry["seconds"] = round(seconds, 3)
+	entry["peakHeapBytes"] = peak_heap()
+	entry["bytesWritten"] = sum([anilyze["output_size"](path) for path in anilyze["scanState"].outputs]) # OME-Zarr outputs are folders
+	entry["bytesRead"] = None
+	if ioBefore is not None and ioAfter is not None:
+		entry["bytesRead"] = ioAfter[0] - ioBefore[0]
+	entry["error"] = error
+	results.append(entry)
+	print "%-9s %8.2f s  peak heap %7.1f MB  written %7.1f MB" % (stage, seconds, entry["peakHeapBytes"] / 1048576.0, entry["bytesWritten"] / 1048576.0)
+	if error is not None:
+		raise StageFailed(stage)
+	return result
+
+# benchmark_scan runs the stages of process_scan() in anilyze-data.py one at a time on a scan, the same way process_scan() calls them
+def benchmark_scan(anilyze, results, record, scan, microscopeType):
+	basename = os.path.basename(scan)
+	a = anilyze
+	directories = a["make_directories"](scan, True)
+	try:
+		probe = run_stage(a, results, record, "probe", a["probe_scan"], scan, microscopeType)
+		imp = run_stage(a, results, record, "import", a["make_hyperstack"], basename, scan, microscopeType, a["streamingProjection"], probe)
+		channels = imp.getNChannels()
+		singleplane = imp.getNSlices() == 1
+		channelImps = run_stage(a, results, record, "split", a["split_channels"], imp, directories, channels)
+		maxImps = run_stage(a, results, record, "MAX", a["make_MAX"], channelImps, directories, 4, singleplane)
+
+		def merge(imps, x, suffix):
+			a["applyLut"](imps, channels, channelColors[0], channelColors[1], channelColors[2])
+			a["merge_channels"](imps, basename, channels, directories, x, suffix)
+		run_stage(a, results, record, "merge", merge, maxImps, 1 if singleplane else 4, "_raw")
+
+		def filtered():
+			filteredImps = a["median_filter"](channelImps, directories, 5, singleplane or a["saveFilteredStacks"])
+			filteredMaxImps = a["make_MAX"](filteredImps, directories, 3, singleplane)
+			merge(filteredMaxImps, 5 if singleplane else 3, "_filtered")
+			a["close_images"](filteredImps + filteredMaxImps)
+		if a["makeFiltered"]:
+			run_stage(a, results, record, "filtered", filtered)
+
+		if differenceNumber > 0:
+			run_stage(a, results, record, "diff", a["make_difference"], maxImps, directories, differenceNumber)
+		a["close_images"](maxImps + channelImps)
+	except StageFailed:
+		print "Skipping the rest of", basename
+	IJ.freeMemory()
+
+# read_results loads the records of earlier runs from the results file
+def read_results(resultsPath):
+	records = []
+	if os.path.exists(resultsPath):
+		resultsFile = open(resultsPath, "r")
+		for line in resultsFile:
+			if line.strip():
+				records.append(json.loads(line))
+		resultsFile.close()
+	return records
+
+# compare prints how long every stage took in this run next to the last run before it, and flags the stages that got slower by more than regressionThreshold
+def compare(results, earlier):
+	previous = {}
+	if len(earlier) > 0:
+		lastRun = earlier[-1]["run"]
+		previous = dict([((r["dataset"], r["stage"]), r) for r in earlier if r["run"] == lastRun])
+		print "\nCompared to run", lastRun, earlier[-1].get("label", "")
+	print "%-40s %-9s %9s %9s" % ("dataset", "stage", "seconds", "before")
+	for r in results:
+		before = previous.get((r["dataset"], r["stage"]))
+		line = "%-40s %-9s %9.2f" % (r["dataset"], r["stage"], r["seconds"])
+		if before is not None and before["error"] is None:
+			line += " %9.2f" % before["seconds"]
+			if r["seconds"] > regressionThreshold * before["seconds"] and r["seconds"] - before["seconds"] > 0.1:
+				line += "  SLOWER (x%.2f)" % (r["seconds"] / max(before["seconds"], 0.001))
+		if r["error"] is not None:
+			line += "  ERROR"
+		print line
+
+def run_it():
+	# Loads the functions of anilyze-data.py without running the pipeline
+	anilyze = {"loadFunctionsOnly": True, "experimentFolder": benchmarkFolder, "differenceNumber": differenceNumber,
+		"ch1color": channelColors[0], "ch2color": channelColors[1], "ch3color": channelColors[2]}
+	execfile(anilyzeScript, anilyze)
+	anilyze.update(pipelineSettings)
+
+	runId = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+	results = []
+	for dataset in datasets:
+		experiment = make_dataset(dataset)
+		for scan, microscopeType in anilyze["find_scans"](experiment):
+			print "\nBenchmarking", dataset_name(dataset)
+			record = {"run": runId, "label": runLabel, "dataset": dataset_name(dataset), "settings": pipelineSettings, "maxHeapBytes": IJ.maxMemory()}
+			record.update(dataset)
+			benchmark_scan(anilyze, results, record, scan, microscopeType)
+
+	resultsPath = os.path.join(benchmarkFolder, resultsName)
+	earlier = read_results(resultsPath)
+	resultsFile = open(resultsPath, "a")
+	for r in results:
+		resultsFile.write(json.dumps(r, sort_keys = True) + "\n")
+	resultsFile.close()
+	compare(results, earlier)
+	print "\nResults added to", resultsPath
+
+run_it()
+print "Done with benchmark"